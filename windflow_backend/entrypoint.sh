@@ -8,6 +8,7 @@ done
 # Apply migrations
 python manage.py makemigrations
 python manage.py migrate
+python manage.py maintain_weather_storage --convert
 python manage.py collectstatic --noinput
 
 # Create superuser if it doesn't already exist
@@ -21,10 +22,15 @@ if not User.objects.filter(username='${DJANGO_SUPERUSER_USERNAME}').exists():
 python manage.py setup_defaults
 python manage.py backfill_daily_summary
 
+# Metrics of daphne and every Celery worker process are collected here; samples of a previous run are dropped
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/windflow_metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Start Celery worker and beat in the background
 celery -A windflow_backend worker --loglevel=info &
 celery -A windflow_backend beat --loglevel=info &
 
-# Start the Daphne ASGI server
-exec daphne -b 0.0.0.0 -p 8000 windflow_backend.asgi:application
+# Start the Daphne ASGI server, with permessage-deflate for WebSocket clients that offer it
+exec python -m windflow_backend.asgi_server -b 0.0.0.0 -p 8000 windflow_backend.asgi:application
 
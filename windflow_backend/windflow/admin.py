@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import WeatherData, DailySummary, City, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from .models import WeatherData, LatestWeatherData, HourlyWeatherData, DailySummary, City, ProviderHealth, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
 
 @admin.register(WeatherData)
 class WeatherDataAdmin(admin.ModelAdmin):
@@ -7,6 +7,17 @@ class WeatherDataAdmin(admin.ModelAdmin):
     list_filter = ('city', 'dominant_condition', 'dt')
     search_fields = ('city', 'dominant_condition')
 
+@admin.register(LatestWeatherData)
+class LatestWeatherDataAdmin(admin.ModelAdmin):
+    list_display = ('city', 'dominant_condition', 'temp', 'feels_like', 'dt', 'humidity', 'wind_speed', 'wind_deg', 'clouds')
+    search_fields = ('city', 'dominant_condition')
+
+@admin.register(HourlyWeatherData)
+class HourlyWeatherDataAdmin(admin.ModelAdmin):
+    list_display = ('city', 'hour', 'sample_count', 'avg_temp', 'max_temp', 'min_temp', 'dominant_condition')
+    list_filter = ('city', 'hour', 'dominant_condition')
+    search_fields = ('city', 'dominant_condition')
+
 @admin.register(DailySummary)
 class DailySummaryAdmin(admin.ModelAdmin):
     list_display = ('city', 'date', 'avg_temp', 'max_temp', 'min_temp', 'dominant_condition')
@@ -38,3 +49,8 @@ class ConditionAdmin(admin.ModelAdmin):
     list_display = ('city', 'condition', 'consecutive_updates')
     search_fields = ('city',)
 
+@admin.register(ProviderHealth)
+class ProviderHealthAdmin(admin.ModelAdmin):
+    list_display = ('provider', 'city', 'consecutive_failures', 'last_success', 'last_failure', 'retry_at', 'skipped_calls')
+    list_filter = ('provider',)
+    search_fields = ('provider', 'city', 'last_error')
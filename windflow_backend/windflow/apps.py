@@ -3,3 +3,6 @@ from django.apps import AppConfig
 class WindflowConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'windflow'
+
+    def ready(self):
+        from . import signals
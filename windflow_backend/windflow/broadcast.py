@@ -0,0 +1,190 @@
+import hashlib
+import json
+import re
+import time
+from functools import lru_cache
+import msgpack
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.utils import timezone
+from .cache import increment
+from .stream import append_cycle, cycles_since
+from .tracing import span
+from .metrics import group_send_duration
+
+# Clients that never subscribe get every update in one combined message, as before
+ALL_GROUP = 'notifications'
+# Clients on the delta protocol get a snapshot on connect and then only what changed
+DELTA_GROUP = 'notifications.delta'
+TOPICS = ['weather', 'roll_ups', 'alerts']
+PROTOCOLS = ['full', 'delta']
+ENCODINGS = ['json', 'msgpack']
+
+STATE_KEY = 'windflow:broadcast:state'
+SEQ_KEY = 'windflow:broadcast:seq'
+
+
+def city_group(topic, city):
+    # Group names only allow ASCII letters, digits, hyphens, underscores and periods
+    slug = re.sub(r'[^A-Za-z0-9_-]', '-', city)[:60]
+    digest = hashlib.sha1(city.encode()).hexdigest()[:8]
+    return f"{topic}.{slug}.{digest}"
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':'))
+
+@lru_cache(maxsize=256)
+def transcode(text):
+    # msgpack clients get the same frame re-encoded once per worker process, not once per socket
+    return msgpack.packb(json.loads(text))
+
+def city_messages(data):
+    # Splits a cycle into one message per city and topic
+    weather = data.get('weather') or []
+    roll_ups = data.get('roll_ups') or {}
+    alerts = data.get('alerts') or []
+
+    messages = {}
+    for row in weather:
+        messages[('weather', row['city'])] = row
+    for city, summary in roll_ups.items():
+        messages[('roll_ups', city)] = summary
+    # Every city in the cycle gets its active alerts, an empty list clears them
+    cities = {row['city'] for row in weather} | set(roll_ups)
+    for city in sorted(cities):
+        messages[('alerts', city)] = []
+    for alert in alerts:
+        messages.setdefault(('alerts', alert['city']), []).append(alert)
+    return messages
+
+def next_state(previous, data):
+    # The latest weather, roll-up and alerts of every city, with this cycle applied on top
+    cities = {city: dict(topics) for city, topics in previous.items()}
+    for (topic, city), message in city_messages(data).items():
+        cities.setdefault(city, {})[topic] = message
+    if data.get('alerts') is not None:
+        # Alerts are the full active set, so cities missing from it have none left
+        for city, topics in cities.items():
+            topics['alerts'] = [alert for alert in data['alerts'] if alert['city'] == city]
+    return cities
+
+def diff_state(previous, current):
+    # Per city and topic: the fields of a record that changed, or the whole alert list when it did
+    changes = {}
+    for city, topics in current.items():
+        before = previous.get(city, {})
+        for topic, value in topics.items():
+            old = before.get(topic)
+            if value == old:
+                continue
+            if isinstance(value, dict) and isinstance(old, dict):
+                value = {field: field_value for field, field_value in value.items() if old.get(field) != field_value}
+            elif value == [] and old is None:
+                continue
+            changes.setdefault(city, {})[topic] = value
+    return changes
+
+def state_from_database():
+    # Rebuilt from the snapshot tables when Redis lost the broadcast state
+    from .models import LatestWeatherData, DailySummary
+    from .serializers import LatestWeatherDataSerializer, DailySummarySerializer
+    from .thresholds import active_alerts
+    return next_state({}, {
+        'weather': LatestWeatherDataSerializer(LatestWeatherData.objects.all(), many=True).data,
+        'roll_ups': {row['city']: row for row in DailySummarySerializer(DailySummary.objects.filter(date=timezone.localdate()), many=True).data},
+        'alerts': active_alerts(),
+    })
+
+def load_state():
+    state = cache.get(STATE_KEY)
+    if state is None:
+        state = {'seq': cache.get(SEQ_KEY, 0), 'cities': state_from_database(), 'rebuilt': True}
+    return state
+
+def snapshot_frame(state):
+    return encode({'type': 'snapshot', 'seq': state['seq'], 'cities': state['cities']})
+
+def merge_frames(first, second):
+    # Folds a delta into the snapshot or delta still waiting to be sent, so a slow client
+    # gets one frame that takes it straight to the newer state
+    merged = json.loads(first)
+    newer = json.loads(second)
+    if newer['type'] == 'snapshot':
+        return second
+    merged['seq'] = newer['seq']
+    for city, topics in newer['cities'].items():
+        current = merged['cities'].setdefault(city, {})
+        for topic, value in topics.items():
+            if isinstance(value, dict) and isinstance(current.get(topic), dict):
+                current[topic].update(value)
+            else:
+                current[topic] = value
+    return encode(merged)
+
+def city_frame(seq, topic, city, message):
+    return encode({'type': 'city_update', 'seq': seq, 'topic': topic, 'city': city, 'message': message})
+
+def cycle_frames(data):
+    # 'key' says which pending frame a newer one replaces when a client falls behind
+    previous = load_state()
+    cities = next_state(previous['cities'], data)
+    seq = increment(SEQ_KEY)
+    cache.set(STATE_KEY, {'seq': seq, 'cities': cities}, timeout=None)
+
+    full = encode({'type': 'weather', 'seq': seq, 'message': data})
+    if previous.get('rebuilt'):
+        # The previous state was read back after this cycle was ingested, so a diff against it would
+        # come out empty: delta clients start over from a snapshot instead
+        delta = snapshot_frame({'seq': seq, 'cities': cities})
+        delta_event = {'key': 'delta', 'text': delta, 'seq': seq, 'snapshot': True}
+    else:
+        delta = encode({'type': 'delta', 'seq': seq, 'prev_seq': previous['seq'], 'cities': diff_state(previous['cities'], cities)})
+        delta_event = {'key': 'delta', 'text': delta, 'seq': seq, 'prev_seq': previous['seq']}
+    append_cycle(seq, full, delta)
+
+    frames = [(ALL_GROUP, {'key': 'all', 'text': full, 'seq': seq})]
+    for (topic, city), message in city_messages(data).items():
+        frames.append((city_group(topic, city), {'key': f'{topic}:{city}', 'text': city_frame(seq, topic, city, message), 'seq': seq}))
+    frames.append((DELTA_GROUP, delta_event))
+    return frames
+
+def replay_frames(last_seq, subscriptions, protocol):
+    # What a client that last saw last_seq missed, as (key, text) pairs for its subscriptions,
+    # or a snapshot of them when the stream no longer holds everything it missed
+    state = load_state()
+    cycles = cycles_since(last_seq, state['seq'])
+    if cycles is None:
+        if '*' not in subscriptions:
+            state = {'seq': state['seq'], 'cities': {
+                city: {topic: value for topic, value in topics.items() if (topic, city) in subscriptions}
+                for city, topics in state['cities'].items()
+                if any((topic, city) in subscriptions for topic in topics)
+            }}
+        return state['seq'], [('delta', snapshot_frame(state))]
+
+    frames = []
+    for seq, entry in cycles:
+        if '*' in subscriptions:
+            frames.append(('delta', entry['delta']) if protocol == 'delta' else ('all', entry['full']))
+            continue
+        data = json.loads(entry['full'])['message']
+        for (topic, city), message in city_messages(data).items():
+            if (topic, city) in subscriptions:
+                frames.append((f'{topic}:{city}', city_frame(seq, topic, city, message)))
+    return state['seq'], frames
+
+async def send_frames(frames):
+    channel_layer = get_channel_layer()
+    for group, event in frames:
+        started = time.perf_counter()
+        await channel_layer.group_send(group, {'type': 'forward', **event})
+        group_send_duration.observe(time.perf_counter() - started)
+
+def broadcast_cycle(data):
+    # Each message is encoded once here; consumers forward the text as is
+    with span('encode') as encoding:
+        frames = cycle_frames(data)
+        encoding.set(frames=len(frames), payload_bytes=sum(len(event['text']) for _, event in frames))
+    with span('group_send', frames=len(frames)):
+        async_to_sync(send_frames)(frames)
@@ -0,0 +1,104 @@
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+# Names of the views wrapped in cached_response, for reporting
+CACHED_VIEWS = []
+
+
+def version_key(name):
+    return f'windflow:version:{name}'
+
+def new_version():
+    # A version key that was evicted starts again above any value it held before, so responses
+    # still cached under an old version are never served again
+    return time.time_ns()
+
+def get_version(name):
+    # Shared across the web and Celery processes; None when Redis cannot be reached
+    try:
+        return cache.get_or_set(version_key(name), new_version, timeout=None)
+    except Exception as e:
+        print(f"Could not read the {name} version: {e}")
+        return None
+
+def get_versions(names):
+    versions = cache.get_many([version_key(name) for name in names])
+    return [versions.get(version_key(name)) or get_version(name) for name in names]
+
+def increment(key, start=0):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, start, timeout=None)
+        return cache.incr(key)
+
+def bump_version(name):
+    try:
+        return increment(version_key(name), start=new_version())
+    except Exception as e:
+        print(f"Could not bump the {name} version: {e}")
+        return None
+
+def stats_key(view_name, outcome):
+    return f'windflow:response:{outcome}:{view_name}'
+
+def record_lookup(view_name, outcome):
+    try:
+        increment(stats_key(view_name, outcome))
+    except Exception as e:
+        print(f"Could not record a response cache {outcome} for {view_name}: {e}")
+
+def cached_response(*versions):
+    # Caches a view's successful responses under the current versions of the data it reads,
+    # so bumping a version invalidates every cached response built from the old data at once
+    def decorator(view):
+        CACHED_VIEWS.append(view.__name__)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                current = get_versions(versions)
+                # Paginated bodies hold absolute links, so the scheme and host are part of the key
+                path_hash = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+                key = f"windflow:response:{view.__name__}:{':'.join(str(version) for version in current)}:{path_hash}"
+                cached = cache.get(key)
+            except Exception as e:
+                print(f"Response cache unavailable for {view.__name__}: {e}")
+                return view(request, *args, **kwargs)
+
+            if cached is not None:
+                record_lookup(view.__name__, 'hits')
+                response = Response(cached, status=status.HTTP_200_OK)
+                response['X-Cache'] = 'HIT'
+                return response
+
+            record_lookup(view.__name__, 'misses')
+            response = view(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                try:
+                    cache.set(key, response.data, timeout=settings.RESPONSE_CACHE_TIMEOUT)
+                except Exception as e:
+                    print(f"Could not cache the {view.__name__} response: {e}")
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+def response_cache_stats():
+    view_names = sorted(CACHED_VIEWS)
+    counters = cache.get_many([stats_key(name, outcome) for name in view_names for outcome in ('hits', 'misses')])
+    stats = {}
+    for name in view_names:
+        hits = counters.get(stats_key(name, 'hits'), 0)
+        misses = counters.get(stats_key(name, 'misses'), 0)
+        stats[name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+        }
+    return stats
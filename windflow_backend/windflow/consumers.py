@@ -1,24 +1,269 @@
+import asyncio
 import json
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .metrics import websocket_connections
+from .broadcast import ALL_GROUP, DELTA_GROUP, TOPICS, PROTOCOLS, ENCODINGS, city_group, encode, transcode, load_state, snapshot_frame, merge_frames, replay_frames
+
+MAX_SUBSCRIPTIONS = 1000
+# Close code for clients that could not keep up
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+
+class FanoutStats:
+    # Kept per process: each Daphne worker reports on its own sockets
+    def __init__(self):
+        self.consumers = set()
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self.send_count = 0
+        self.send_seconds = 0.0
+        self.send_seconds_max = 0.0
+
+    def record_send(self, seconds):
+        self.sent += 1
+        self.send_count += 1
+        self.send_seconds += seconds
+        self.send_seconds_max = max(self.send_seconds_max, seconds)
+
+    def report(self):
+        depths = [len(consumer.pending) for consumer in self.consumers]
+        return {
+            'connections': len(self.consumers),
+            'queued': sum(depths),
+            'queue_depth': max(depths, default=0),
+            'max_queue_depth': self.max_queue_depth,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'slow_disconnects': self.slow_disconnects,
+            'send_latency_avg': self.send_seconds / self.send_count if self.send_count else None,
+            'send_latency_max': self.send_seconds_max,
+        }
+
+fanout_stats = FanoutStats()
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
+    # Starts out subscribed to everything. Clients can narrow that down with
+    # {"action": "subscribe", "cities": [...], "topics": [...]} and {"action": "unsubscribe", ...},
+    # or go back to everything with {"action": "subscribe", "cities": "*"}.
+    # ?protocol=delta swaps the combined message for a snapshot followed by per-cycle deltas,
+    # and ?encoding=msgpack sends binary msgpack frames instead of JSON text.
+    # Frames wait in a bounded per-socket queue where a newer frame for the same city and topic
+    # replaces the pending one, so a slow client skips ahead instead of piling up; a client that
+    # stays behind for longer than WS_SLOW_CLIENT_TIMEOUT is told so and disconnected.
+    # Every frame carries the seq of its broadcast cycle. A client that reconnects with ?last_seq=<seq>,
+    # or sends {"action": "resume", "last_seq": <seq>} after subscribing, gets the cycles it missed
+    # replayed from the notification stream, or a snapshot when it has been away too long
     async def connect(self):
         print("connected", flush=True)
-        await self.channel_layer.group_add("notifications", self.channel_name)
+        self.seq = None
+        self.subscriptions = set()
+        self.groups_joined = set()
+        self.pending = OrderedDict()
+        self.replies = 0
+        self.behind_since = None
+        self.wakeup = asyncio.Event()
+        self.sender = None
+        self.replayed_from = None
+        self.replayed_to = None
+        options = parse_qs(self.scope.get('query_string', b'').decode())
+        self.protocol = options.get('protocol', ['full'])[0]
+        self.encoding = options.get('encoding', ['json'])[0]
+        last_seq = options.get('last_seq', [None])[0]
+        if self.protocol not in PROTOCOLS or self.encoding not in ENCODINGS or not (last_seq is None or last_seq.isdigit()):
+            await self.close(code=4400)
+            return
+
+        self.subscriptions = {'*'}
+        await self.sync_groups()
         await self.accept()
+        fanout_stats.consumers.add(self)
+        websocket_connections.inc()
+        self.sender = asyncio.create_task(self.drain())
+        if last_seq is not None:
+            await self.resume(int(last_seq))
+        elif self.protocol == 'delta':
+            await self.queue_snapshot()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard("notifications", self.channel_name)
+        if self in fanout_stats.consumers:
+            websocket_connections.dec()
+        fanout_stats.consumers.discard(self)
+        if self.sender is not None:
+            self.sender.cancel()
+        self.subscriptions = set()
+        await self.sync_groups()
+
+    async def sync_groups(self):
+        everything = DELTA_GROUP if self.protocol == 'delta' else ALL_GROUP
+        groups = {everything if key == '*' else city_group(*key) for key in self.subscriptions}
+        for group in groups - self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        for group in self.groups_joined - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.groups_joined = groups
+
+    def enqueue(self, key, text):
+        if key in self.pending:
+            # Deltas only carry what changed, so they are folded together rather than replaced
+            if key == 'delta':
+                text = merge_frames(self.pending[key], text)
+            del self.pending[key]
+            fanout_stats.coalesced += 1
+        elif len(self.pending) >= settings.WS_QUEUE_SIZE:
+            self.pending.popitem(last=False)
+            fanout_stats.dropped += 1
+        self.pending[key] = text
+        fanout_stats.max_queue_depth = max(fanout_stats.max_queue_depth, len(self.pending))
+        if self.behind_since is None:
+            self.behind_since = time.monotonic()
+        self.wakeup.set()
+
+    def queue_reply(self, message):
+        # Replies to the client itself are never coalesced
+        self.replies += 1
+        self.enqueue(f'reply:{self.replies}', encode(message))
+
+    async def queue_snapshot(self):
+        state = await database_sync_to_async(load_state)()
+        self.seq = state['seq']
+        # The snapshot already covers any delta still waiting
+        self.pending.pop('delta', None)
+        self.enqueue('delta', snapshot_frame(state))
+
+    async def resume(self, last_seq):
+        seq, frames = await database_sync_to_async(replay_frames)(last_seq, self.subscriptions, self.protocol)
+        # Whatever delta is still waiting is replayed again from last_seq
+        self.pending.pop('delta', None)
+        for key, text in frames:
+            self.enqueue(key, text)
+        self.replayed_from = last_seq
+        self.replayed_to = seq
+        if self.protocol == 'delta':
+            self.seq = seq
+
+    async def drain(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                if time.monotonic() - self.behind_since > settings.WS_SLOW_CLIENT_TIMEOUT:
+                    await self.close_slow_client()
+                    return
+                _, text = self.pending.popitem(last=False)
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(self.send_frame(text), timeout=settings.WS_SEND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self.close_slow_client()
+                    return
+                fanout_stats.record_send(time.monotonic() - started)
+            self.behind_since = None
+
+    async def close_slow_client(self):
+        fanout_stats.slow_disconnects += 1
+        self.pending.clear()
+        try:
+            await asyncio.wait_for(
+                self.send_frame(encode({'type': 'error', 'message': 'client is too far behind, reconnect to resume'})),
+                timeout=settings.WS_SEND_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            pass
+        await self.close(code=SLOW_CLIENT_CLOSE_CODE)
+
+    async def send_frame(self, text):
+        if self.encoding == 'msgpack':
+            await self.send(bytes_data=transcode(text))
+        else:
+            await self.send(text_data=text)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            request = json.loads(text_data or bytes_data)
+            action = request.get('action')
+            if action == 'resume':
+                last_seq = request.get('last_seq')
+                if not isinstance(last_seq, int) or isinstance(last_seq, bool) or last_seq < 0:
+                    raise ValueError('last_seq must be the seq of the last message received')
+                await self.resume(last_seq)
+                return
+            cities = request.get('cities', [])
+            topics = request.get('topics') or TOPICS
+            if action not in ('subscribe', 'unsubscribe'):
+                raise ValueError('action must be subscribe, unsubscribe or resume')
+            if cities != '*' and (not isinstance(cities, list) or not all(isinstance(city, str) for city in cities)):
+                raise ValueError('cities must be a list of city names or "*"')
+            if not isinstance(topics, list) or any(topic not in TOPICS for topic in topics):
+                raise ValueError(f'topics must be a list of {", ".join(TOPICS)}')
+            if cities != '*' and len(cities) * len(topics) > MAX_SUBSCRIPTIONS:
+                raise ValueError(f'at most {MAX_SUBSCRIPTIONS} city topics can be subscribed to')
+        except (TypeError, ValueError, AttributeError) as e:
+            self.queue_reply({'type': 'error', 'message': str(e)})
+            return
+
+        if cities == '*':
+            wanted = {'*'}
+        else:
+            wanted = {(topic, city) for topic in topics for city in cities}
+
+        resubscribed = cities == '*' and action == 'subscribe' and '*' not in self.subscriptions
+        if action == 'subscribe':
+            # Per-city subscriptions replace the catch-all one, and the other way round
+            if cities == '*':
+                self.subscriptions = wanted
+            else:
+                self.subscriptions = (self.subscriptions - {'*'}) | wanted
+        else:
+            self.subscriptions -= wanted
+        await self.sync_groups()
 
-    async def receive(self, text_data):
-        pass
+        self.queue_reply({
+            'type': 'subscriptions',
+            'all': '*' in self.subscriptions,
+            'subscriptions': sorted([topic, city] for topic, city in self.subscriptions - {'*'}),
+        })
+        if resubscribed and self.protocol == 'delta':
+            await self.queue_snapshot()
 
-    async def weather(self, event):
+    async def forward(self, event):
+        # Already encoded by the broadcaster
         try:
-            message = event['message']
-            await self.send(text_data=json.dumps({
-                'type': 'weather',
-                'message': message,
-            }))
+            seq = event.get('seq', 0)
+            if self.replayed_to is not None:
+                if seq > self.replayed_to:
+                    self.replayed_to = None
+                elif seq > self.replayed_from:
+                    # Already sent as part of a replay
+                    return
+                else:
+                    # Older than what was replayed: the sequence was reset, so the frame is not a repeat
+                    self.replayed_to = None
+            if event.get('snapshot'):
+                # Sent when the broadcast state had to be rebuilt, in place of a delta
+                self.seq = seq
+                self.pending.pop('delta', None)
+            elif 'prev_seq' in event:
+                if self.seq is not None and seq < self.seq:
+                    # The sequence went backwards (its Redis key was lost): start over from the stored state
+                    await self.queue_snapshot()
+                    return
+                if seq == self.seq:
+                    return
+                if event['prev_seq'] != self.seq:
+                    # Missed a delta: start over from the stored state instead
+                    await self.queue_snapshot()
+                    return
+                self.seq = seq
+            self.enqueue(event['key'], event['text'])
         except Exception as e:
-            print("error", e, flush=True)
\ No newline at end of file
+            print("error", e, flush=True)
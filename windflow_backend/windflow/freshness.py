@@ -0,0 +1,130 @@
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_celery_beat.models import IntervalSchedule
+from rest_framework import status
+from rest_framework.response import Response
+from .models import City, ConnectionStatus, ProviderHealth
+from .serializers import ConnectionStatusSerializer, ProviderHealthSerializer
+from .health import PROVIDER_WIDE
+
+CONNECTION_STATUS_KEY = 'windflow:connection-status'
+REFRESH_LOCK_KEY = 'windflow:refresh-lock'
+# Used when the fetch schedule has not been set up, matching setup_defaults
+DEFAULT_FETCH_INTERVAL = 600
+
+
+def build_snapshot(connection_status):
+    # Read on every current weather request, so it stays the same size whatever the number of cities
+    return {
+        **ConnectionStatusSerializer(connection_status).data,
+        'interval': fetch_interval_seconds(),
+    }
+
+def provider_health():
+    # Circuit breaker state of each provider and of each city, only for the connection status endpoint
+    cities = City.objects.values('name')
+    health = ProviderHealth.objects.filter(Q(city=PROVIDER_WIDE) | Q(city__in=cities)).order_by('provider', 'city')
+    providers, per_city = {}, {}
+    for row in ProviderHealthSerializer(health, many=True).data:
+        provider, city = row.pop('provider'), row.pop('city')
+        if city == PROVIDER_WIDE:
+            providers[provider] = row
+        else:
+            per_city.setdefault(city, {})[provider] = row
+    return {'providers': providers, 'cities': per_city}
+
+def remember_connection_status(connection_status):
+    # Written by the fetch task, so request handlers can tell how fresh the data is without a query
+    snapshot = build_snapshot(connection_status)
+    try:
+        cache.set(CONNECTION_STATUS_KEY, snapshot, timeout=None)
+    except Exception as e:
+        print(f"Could not cache the connection status: {e}")
+    return snapshot
+
+def forget_connection_status():
+    try:
+        cache.delete(CONNECTION_STATUS_KEY)
+    except Exception as e:
+        print(f"Could not clear the cached connection status: {e}")
+
+def fetch_interval_seconds():
+    schedule = IntervalSchedule.objects.filter(pk=1).first()
+    if schedule is None:
+        return None
+    return schedule.schedule.run_every.total_seconds()
+
+def connection_snapshot():
+    try:
+        snapshot = cache.get(CONNECTION_STATUS_KEY)
+    except Exception as e:
+        print(f"Could not read the cached connection status: {e}")
+        snapshot = None
+    if snapshot is None:
+        connection_status, _ = ConnectionStatus.objects.get_or_create(id=1)
+        snapshot = remember_connection_status(connection_status)
+    return snapshot
+
+def request_refresh():
+    # Single flight: only the first caller in a cooldown window queues a fetch, everyone else keeps serving what is stored
+    try:
+        acquired = cache.add(REFRESH_LOCK_KEY, timezone.now().isoformat(), timeout=settings.WEATHER_REFRESH_COOLDOWN)
+    except Exception as e:
+        print(f"Could not take the refresh lock: {e}")
+        return False
+    if not acquired:
+        return False
+    try:
+        from .tasks import fetch_weather_data_task
+        fetch_weather_data_task.delay()
+    except Exception as e:
+        print(f"Could not queue a weather data refresh: {e}")
+        return False
+    return True
+
+def data_freshness():
+    snapshot = connection_snapshot()
+    last_success = snapshot.get('last_successful_connection')
+    last_success = parse_datetime(last_success) if last_success else None
+    age = (timezone.now() - last_success).total_seconds() if last_success else None
+
+    interval = snapshot.get('interval') or DEFAULT_FETCH_INTERVAL
+    stale = not snapshot.get('status') or age is None or age > interval * settings.WEATHER_DATA_STALE_INTERVALS
+    return {
+        'connected': bool(snapshot.get('status')),
+        'last_successful_connection': snapshot.get('last_successful_connection'),
+        'data_age': age,
+        'stale': stale,
+        'refreshing': request_refresh() if stale else False,
+        'status_snapshot': {key: value for key, value in snapshot.items() if key != 'interval'},
+    }
+
+def serve_stale_while_revalidate(view):
+    # Answers from whatever is stored, queueing at most one background refresh when it is out of date.
+    # Freshness travels in headers so the response body keeps its shape
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            freshness = data_freshness()
+        except Exception as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+        response = view(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK and not response.data and not freshness['connected']:
+            response = Response(
+                {'error': f"server is not connected to the weather station {freshness['connected']}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        response['X-Data-Age'] = '' if freshness['data_age'] is None else f"{freshness['data_age']:.0f}"
+        response['X-Data-Stale'] = 'true' if freshness['stale'] else 'false'
+        response['X-Data-Refreshing'] = 'true' if freshness['refreshing'] else 'false'
+        return response
+    return wrapper
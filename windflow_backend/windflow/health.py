@@ -0,0 +1,89 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import ProviderHealth
+
+HEALTH_FIELDS = ['consecutive_failures', 'last_success', 'last_failure', 'last_error', 'retry_at', 'skipped_calls']
+# The empty city is the provider-wide breaker
+PROVIDER_WIDE = ''
+
+
+def circuit_state(health, now=None):
+    # closed: calls go through; open: calls are skipped until retry_at; half_open: one probe call is let through
+    if health.consecutive_failures < settings.WEATHER_CIRCUIT_FAILURE_THRESHOLD:
+        return 'closed'
+    if health.retry_at is not None and (now or timezone.now()) < health.retry_at:
+        return 'open'
+    return 'half_open'
+
+def backoff(consecutive_failures):
+    # Doubles with every failure past the threshold, up to the cap
+    exponent = min(consecutive_failures - settings.WEATHER_CIRCUIT_FAILURE_THRESHOLD, 32)
+    seconds = settings.WEATHER_CIRCUIT_BACKOFF_BASE * 2 ** max(exponent, 0)
+    return timedelta(seconds=min(seconds, settings.WEATHER_CIRCUIT_BACKOFF_MAX))
+
+def record_success(health, now):
+    health.consecutive_failures = 0
+    health.last_success = now
+    health.retry_at = None
+
+def record_failure(health, now, error):
+    health.consecutive_failures += 1
+    health.last_failure = now
+    health.last_error = str(error)[:1000]
+    if health.consecutive_failures >= settings.WEATHER_CIRCUIT_FAILURE_THRESHOLD:
+        health.retry_at = now + backoff(health.consecutive_failures)
+
+def load_health(provider, cities):
+    names = [PROVIDER_WIDE] + list(cities)
+    existing = {health.city: health for health in ProviderHealth.objects.filter(provider=provider, city__in=names)}
+    return {name: existing.get(name) or ProviderHealth(provider=provider, city=name) for name in names}
+
+def plan_calls(health, cities, now):
+    # Splits the cities into the ones to call this cycle and the ones skipped behind an open breaker
+    provider_state = circuit_state(health[PROVIDER_WIDE], now)
+    if provider_state == 'open':
+        return [], list(cities)
+
+    calls, skipped = [], []
+    for city in cities:
+        (skipped if circuit_state(health[city], now) == 'open' else calls).append(city)
+
+    if provider_state == 'half_open' and calls:
+        # The whole provider has been failing: probe it with a single city that is healthy on its own
+        probe = next((city for city in calls if circuit_state(health[city], now) == 'closed'), calls[0])
+        skipped += [city for city in calls if city != probe]
+        calls = [probe]
+    return calls, skipped
+
+def settle_provider(provider, succeeded, error, skipped, now):
+    # The provider-wide breaker closes as soon as any city got an answer
+    if succeeded:
+        record_success(provider, now)
+    elif error is not None:
+        record_failure(provider, now, error)
+    provider.skipped_calls += skipped
+
+def save_health(rows):
+    ProviderHealth.objects.bulk_create(
+        list(rows),
+        update_conflicts=True,
+        unique_fields=['provider', 'city'],
+        update_fields=HEALTH_FIELDS,
+    )
+
+def settle_cycle(health, results, skipped, now, provider_wide=True):
+    # results maps each called city to None on success or to the error it failed with.
+    # Shards of a fanned out cycle leave the provider-wide row to the step that joins them
+    for city, error in results.items():
+        if error is None:
+            record_success(health[city], now)
+        else:
+            record_failure(health[city], now, error)
+    for city in skipped:
+        health[city].skipped_calls += 1
+
+    if provider_wide:
+        errors = [error for error in results.values() if error is not None]
+        settle_provider(health[PROVIDER_WIDE], len(errors) < len(results), errors[0] if errors else None, len(skipped), now)
+    save_health(row for city, row in health.items() if provider_wide or city != PROVIDER_WIDE)
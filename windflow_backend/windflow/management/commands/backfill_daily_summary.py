@@ -1,118 +1,165 @@
-from django.core.management.base import BaseCommand
+import json
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date as date_cls, timedelta
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
+from windflow.cache import bump_version
 from windflow.models import DailySummary, City
-from collections import Counter
-
-from datetime import timedelta, datetime
-import requests
-import os
+from windflow.providers import get_provider
+from windflow.utils import provider_rate_limiter, get_http_session, dominant_condition, save_daily_summaries, SUMMARY_METRICS, SUMMARY_EXTREMA_METRICS, DAILY_SUMMARY_FIELDS, DAILY_SUMMARY_ACCUMULATOR_FIELDS
+
+# Mirrored rows carry no observations, so they never touch the running accumulators
+MIRRORED_SUMMARY_FIELDS = [field for field in DAILY_SUMMARY_FIELDS if field not in DAILY_SUMMARY_ACCUMULATOR_FIELDS]
+
+
+def parse_date(value):
+    try:
+        return date_cls.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'{value} is not a YYYY-MM-DD date')
+
+def mirrored_summaries(city, forecast, today, start, end):
+    # Summaries of the days before today, mirrored from the forecast: tomorrow's readings fill yesterday and so on.
+    # The running accumulators are left empty, so a day that gets live observations is rebuilt from the raw rows
+    days = defaultdict(list)
+    for item in forecast:
+        day = timezone.localtime(item['dt']).date()
+        fill_date = today - timedelta(days=(day - today).days)
+        if (start is None or fill_date >= start) and (end is None or fill_date <= end):
+            days[fill_date].append(item)
+
+    summaries = []
+    for fill_date, items in sorted(days.items()):
+        values = {f'avg_{metric}': sum(item[metric] for item in items) / len(items) for metric in SUMMARY_METRICS}
+        for metric in SUMMARY_EXTREMA_METRICS:
+            values[f'max_{metric}'] = max(item[metric] for item in items)
+            values[f'min_{metric}'] = min(item[metric] for item in items)
+        conditions = Counter(item['dominant_condition'] for item in items)
+        summaries.append(DailySummary(city=city.name, date=fill_date, dominant_condition=dominant_condition(conditions), **values))
+    return summaries
 
 
-
-def kelvin_to_celsius(kelvin):
-    return kelvin - 273.15
-
 class Command(BaseCommand):
-    help = 'Using 5 days forecast as previous 5 days data as archive api is not available for free'
-
-    def handle(self, *args, **kwargs):
-
-        DailySummary.objects.all().delete()
-
-        api_key = os.getenv('OPENWEATHERMAP_API_KEY')
-        base_url = "http://api.openweathermap.org/data/2.5/forecast"
-
-
-
-        cities = City.objects.all()
-        weather_data = {}
-        for city in cities:
-
-            weather_data[city] = {}
-            
-            params = {
-                'lat': city.latitude,
-                'lon': city.longitude,
-                'appid': api_key
-            }
-            response = requests.get(base_url, params=params)
-            data = response.json()
-
-            try:
-                response.raise_for_status()
-                for item in data['list']:
-                    date = timezone.make_aware(datetime.fromtimestamp(item['dt']), timezone.get_current_timezone()).date()
-                    if date not in weather_data:
-                        weather_data[city][date] = {
-                            'temp': [],
-                            'feels_like': [],
-                            'humidity': [],
-                            'wind_speed': [],
-                            'wind_deg': [],
-                            'clouds': [],
-                            'dominant_condition': []
-                        }
-
-                    weather_data[city][date]['temp'].append(kelvin_to_celsius(item['main']['temp']))
-                    weather_data[city][date]['feels_like'].append(kelvin_to_celsius(item['main']['feels_like']))
-                    weather_data[city][date]['humidity'].append(item['main']['humidity'])
-                    weather_data[city][date]['wind_speed'].append(item['wind']['speed'])
-                    weather_data[city][date]['wind_deg'].append(item['wind']['deg'])
-                    weather_data[city][date]['clouds'].append(item['clouds']['all'])
-                    weather_data[city][date]['dominant_condition'].append(item['weather'][0]['main'])
-
-            except requests.exceptions.HTTPError as http_err:
-                print(f"HTTP error occurred for {city.name}: {http_err}")
-                return
-            except Exception as err:
-                print(f"An error occurred for {city.name}: {err}")
-                return
-
-        avarege_data = {}
-        for city, data in weather_data.items():
-            avarege_data[city] = {}
-            for date, values in data.items():
-                avarege_data[city][date] = {
-                    'avg_temp': sum(values['temp']) / len(values['temp']),
-                    'max_temp': max(values['temp']),
-                    'min_temp': min(values['temp']),
-                    'avg_feels_like': sum(values['feels_like']) / len(values['feels_like']),
-                    'max_feels_like': max(values['feels_like']),
-                    'min_feels_like': min(values['feels_like']),
-                    'avg_humidity': sum(values['humidity']) / len(values['humidity']),
-                    'avg_wind_speed': sum(values['wind_speed']) / len(values['wind_speed']),
-                    'avg_wind_deg': sum(values['wind_deg']) / len(values['wind_deg']),
-                    'avg_clouds': sum(values['clouds']) / len(values['clouds']),
-                    'dominant_condition': Counter(values['dominant_condition']).most_common(3)[0][0]
-                }
-        
-        for city, data in avarege_data.items():
-            for date, values in data.items():
-                today = timezone.now().date()
-                days_diff = (date - today).days
-                fill_date = today - timedelta(days=days_diff)
-                DailySummary.objects.update_or_create(
-                    city=city,
-                    date=fill_date,
-                    defaults={
-                        'avg_temp': values['avg_temp'],
-                        'max_temp': values['max_temp'],
-                        'min_temp': values['min_temp'],
-                        'avg_feels_like': values['avg_feels_like'],
-                        'max_feels_like': values['max_feels_like'],
-                        'min_feels_like': values['min_feels_like'],
-                        'avg_humidity': values['avg_humidity'],
-                        'avg_wind_speed': values['avg_wind_speed'],
-                        'avg_wind_deg': values['avg_wind_deg'],
-                        'avg_clouds': values['avg_clouds'],
-                        'dominant_condition': values['dominant_condition']
-                    }
-                )
-        print(self.style.SUCCESS('Successfully backfilled daily summaries'))
-
-    
-            
-        
-
-
-
+    help = (
+        'Using 5 days forecast as previous 5 days data as archive api is not available for free. '
+        'Cities are fetched concurrently and their summaries upserted in batches; only the days in the date range '
+        'of the given cities are written. Finished cities are checkpointed, so rerunning an interrupted backfill '
+        'with the same options carries on where it stopped'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', help='Comma separated city names, every city by default')
+        parser.add_argument('--start', type=parse_date, help='First day to write (YYYY-MM-DD)')
+        parser.add_argument('--end', type=parse_date, help='Last day to write (YYYY-MM-DD)')
+        parser.add_argument('--concurrency', type=int, default=settings.WEATHER_FETCH_CONCURRENCY, help='Cities fetched at once')
+        parser.add_argument('--batch-size', type=int, default=50, help='Cities per bulk upsert and checkpoint')
+        parser.add_argument('--checkpoint', default=settings.BACKFILL_CHECKPOINT_FILE, help='File that records the finished cities')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an earlier run and backfill every city again')
+
+    def handle(self, *args, **options):
+        start, end = options['start'], options['end']
+        if start and end and start > end:
+            raise CommandError('--start is after --end')
+        cities = City.objects.order_by('name')
+        if options['cities']:
+            names = [name.strip() for name in options['cities'].split(',') if name.strip()]
+            cities = cities.filter(name__in=names)
+            missing = set(names) - {city.name for city in cities}
+            if missing:
+                raise CommandError(f"Unknown cities {', '.join(sorted(missing))}")
+        cities = list(cities)
+
+        provider = get_provider()
+        run = {
+            'provider': provider.name,
+            'cities': options['cities'],
+            'start': start.isoformat() if start else None,
+            'end': end.isoformat() if end else None,
+        }
+        done = set() if options['restart'] else self.load_checkpoint(options['checkpoint'], run)
+        todo = [city for city in cities if city.name not in done]
+        if done:
+            self.stdout.write(f'Resuming: {len(cities) - len(todo)} of {len(cities)} cities already backfilled')
+
+        session = get_http_session()
+        limiter = provider_rate_limiter(provider)
+        today = timezone.localdate()
+
+        def fetch(city):
+            # Shares the provider quota with the fetch workers
+            limiter.acquire()
+            return provider.fetch_forecast(session, city)
+
+        failed, written, pending, pending_cities = [], 0, [], []
+        # Forecasts are fetched concurrently; the database is only written from this thread
+        executor = ThreadPoolExecutor(max_workers=max(1, options['concurrency']))
+        try:
+            futures = {executor.submit(fetch, city): city for city in todo}
+            for future in as_completed(futures):
+                city = futures[future]
+                try:
+                    pending.extend(mirrored_summaries(city, future.result(), today, start, end))
+                    pending_cities.append(city.name)
+                except requests.exceptions.HTTPError as http_err:
+                    failed.append(city.name)
+                    print(f"HTTP error occurred for {city.name}: {http_err}")
+                except Exception as err:
+                    failed.append(city.name)
+                    print(f"An error occurred for {city.name}: {err}")
+
+                if len(pending_cities) >= options['batch_size']:
+                    written += self.flush(pending, pending_cities, done, options['checkpoint'], run)
+                    pending, pending_cities = [], []
+            written += self.flush(pending, pending_cities, done, options['checkpoint'], run)
+        finally:
+            # An interrupted run stops fetching right away; what was flushed stays checkpointed
+            executor.shutdown(cancel_futures=True)
+
+        if written:
+            # Cached rollup responses are built from the summaries
+            bump_version('data')
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                f"{written} daily summaries written; {len(failed)} cities failed ({', '.join(sorted(failed))}), "
+                f"run the command again with the same options to retry them"
+            ))
+            return
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully backfilled {written} daily summaries for {len(todo)} cities'))
+
+    def load_checkpoint(self, path, run):
+        try:
+            with open(path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return set()
+        except ValueError:
+            self.stdout.write(self.style.WARNING(f'Ignoring the unreadable checkpoint {path}'))
+            return set()
+        if checkpoint.get('run') != run:
+            self.stdout.write(self.style.WARNING(f'Ignoring the checkpoint {path} of a backfill with other options'))
+            return set()
+        return set(checkpoint['done'])
+
+    def flush(self, summaries, city_names, done, path, run):
+        # Upserts the summaries of the finished cities, then records them as done
+        if not city_names:
+            return 0
+        # Days that already have live observations keep the summary built from them
+        live = set(
+            DailySummary.objects.filter(city__in=city_names, date__in={summary.date for summary in summaries}, sample_count__gt=0)
+            .values_list('city', 'date')
+        )
+        summaries = [summary for summary in summaries if (summary.city, summary.date) not in live]
+        save_daily_summaries(summaries, update_fields=MIRRORED_SUMMARY_FIELDS)
+        done.update(city_names)
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump({'run': run, 'done': sorted(done)}, checkpoint_file)
+        os.replace(temporary, path)
+        return len(summaries)
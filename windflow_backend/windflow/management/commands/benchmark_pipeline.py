@@ -0,0 +1,252 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import timedelta
+import django
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from windflow.cache import bump_version
+from windflow.models import City, WeatherData, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from windflow.providers import SyntheticProvider
+from windflow.storage import is_partitioned, ensure_partitions
+from windflow.tasks import fetch_weather_data_task
+from windflow.utils import fetch_weather_data, update_daily_summary_for_today, check_thresholds, copy_weather_data, update_latest_weather, compute_daily_summaries, save_daily_summaries
+from windflow.views import get_rollups, get_current_weather
+
+STAGES = ['fetch_weather_data_task', 'fetch_weather_data', 'update_daily_summary_for_today', 'check_thresholds', 'get_rollups', 'get_current_weather']
+HISTORY_CHUNK = 50000
+# Everything the benchmark touches outside the database stays in this process
+ISOLATED_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'windflow-benchmark'}},
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'WEATHER_PROVIDER': 'synthetic',
+    'WEATHER_SYNTHETIC_INTERVAL': 1,
+    'NOTIFICATION_STREAM_LENGTH': 0,
+    'WEATHER_TRACE_FILE': '',
+    'ALLOWED_HOSTS': ['testserver'],
+}
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the ingestion pipeline and read endpoints against the synthetic provider: wall time, queries '
+        'and peak Python memory per stage, for each number of cities and days of history. Runs in a transaction '
+        'that is rolled back, on a database without cities of its own'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int_list, default=[10, 100, 1000, 10000], help='Comma separated city counts')
+        parser.add_argument('--history-days', type=int_list, default=[0, 7], help='Comma separated days of stored history')
+        parser.add_argument('--history-step', type=int, default=60, help='Minutes between stored history observations')
+        parser.add_argument('--thresholds-per-city', type=int, default=2, help='Threshold rules per city, spread over the four kinds')
+        parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages to run')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage, the median is reported')
+        parser.add_argument('--no-memory', action='store_true', help='Skip the extra run per stage that traces peak memory')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='Results file of an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown ratio above which --compare reports a regression')
+
+    def handle(self, *args, **options):
+        stages = [stage for stage in options['stages'].split(',') if stage]
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise CommandError(f"Unknown stages {', '.join(sorted(unknown))}, expected some of {', '.join(STAGES)}")
+        if City.objects.exists():
+            raise CommandError('The benchmark fetches every city, run it against a database without cities of its own')
+
+        self.provider = SyntheticProvider()
+        self.factory = RequestFactory()
+        results = []
+        eager = current_app.conf.task_always_eager
+        current_app.conf.task_always_eager = True
+        try:
+            with override_settings(**ISOLATED_SETTINGS):
+                for city_count in options['cities']:
+                    for history_days in options['history_days']:
+                        results.extend(self.run_case(city_count, history_days, stages, options))
+        finally:
+            current_app.conf.task_always_eager = eager
+
+        report = {
+            'commit': current_commit(),
+            'recorded_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'repeat': options['repeat'],
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['compare']:
+            self.compare(results, options['compare'], options['tolerance'])
+
+    def run_case(self, city_count, history_days, stages, options):
+        self.stdout.write(f'{city_count} cities, {history_days} days of history')
+        results = []
+        with transaction.atomic():
+            self.populate(city_count, history_days, options)
+            for stage in stages:
+                result = self.measure(stage, options)
+                result.update({'stage': stage, 'cities': city_count, 'history_days': history_days})
+                results.append(result)
+                peak = '' if result['peak_memory_kb'] is None else f"{result['peak_memory_kb']:10.0f} KiB peak"
+                self.stdout.write(f"  {stage:32} {result['wall_ms']['median']:10.1f} ms {result['queries']:7} queries {peak}")
+            transaction.set_rollback(True)
+        cache.clear()
+        bump_version('thresholds')
+        return results
+
+    def populate(self, city_count, history_days, options):
+        width = len(str(city_count))
+        cities = City.objects.bulk_create([
+            City(name=f'Benchmark {number:0{width}}', latitude=-55 + 125 * number / city_count, longitude=-180 + 360 * (number * 7919 % city_count) / city_count)
+            for number in range(city_count)
+        ])
+        bump_version('cities')
+
+        kinds = [
+            lambda city, index: TemperatureThreshold(city=city.name, min_threshold=-5 + index, max_threshold=30 - index, consecutive_updates=2),
+            lambda city, index: HumidityThreshold(city=city.name, max_threshold=85, consecutive_updates=3),
+            lambda city, index: WindSpeedThreshold(city=city.name, max_threshold=6 + index, consecutive_updates=2),
+            lambda city, index: ConditionThreshold(city=city.name, condition='Rain', consecutive_updates=1),
+        ]
+        rules = {}
+        for city in cities:
+            for index in range(options['thresholds_per_city']):
+                rule = kinds[index % len(kinds)](city, index // len(kinds))
+                rules.setdefault(type(rule), []).append(rule)
+        for model, model_rules in rules.items():
+            model.objects.bulk_create(model_rules, batch_size=5000)
+        bump_version('thresholds')
+
+        if not history_days:
+            return
+        now = timezone.now()
+        start = now - timedelta(days=history_days)
+        if is_partitioned():
+            ensure_partitions(start, now)
+        step = timedelta(minutes=options['history_step'])
+        moments = []
+        moment = start
+        while moment < now - step:
+            moments.append(moment)
+            moment += step
+        if not moments:
+            return
+
+        chunk = []
+        for moment in moments:
+            for city in cities:
+                chunk.append(WeatherData(city=city.name, **self.provider.reading(city, moment)))
+            if len(chunk) >= HISTORY_CHUNK or moment is moments[-1]:
+                rows = copy_weather_data(chunk) if connection.vendor == 'postgresql' else WeatherData.objects.bulk_create(chunk)
+                chunk = []
+        update_latest_weather(rows[-len(cities):])
+        day = timezone.localdate(start)
+        while day <= timezone.localdate(now):
+            save_daily_summaries(compute_daily_summaries(day))
+            day += timedelta(days=1)
+
+    def next_slot(self):
+        # The synthetic provider gives each city a new reading once per WEATHER_SYNTHETIC_INTERVAL,
+        # so every run fetches observations that are not stored yet
+        interval = settings.WEATHER_SYNTHETIC_INTERVAL
+        time.sleep(interval - time.time() % interval)
+
+    def fresh_rows(self):
+        self.next_slot()
+        rows, _ = fetch_weather_data()
+        return rows
+
+    def call_view(self, view, path):
+        # Cold: the response cache is emptied first, and the rendering to JSON is included
+        cache.clear()
+        return lambda: view(self.factory.get(path)).render()
+
+    def stage_run(self, stage):
+        # Returns the call to time, after whatever preparation it needs
+        if stage == 'fetch_weather_data_task':
+            self.next_slot()
+            return fetch_weather_data_task
+        if stage == 'fetch_weather_data':
+            self.next_slot()
+            return fetch_weather_data
+        if stage == 'update_daily_summary_for_today':
+            rows = self.fresh_rows()
+            return lambda: update_daily_summary_for_today(rows)
+        if stage == 'check_thresholds':
+            rows = self.fresh_rows()
+            return lambda: check_thresholds(rows)
+        if stage == 'get_rollups':
+            return self.call_view(get_rollups, '/api/get-rollups/')
+        return self.call_view(get_current_weather, '/api/current-weather/')
+
+    def measure(self, stage, options):
+        timings, queries = [], []
+        for _ in range(max(1, options['repeat'])):
+            run = self.stage_run(stage)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                run()
+                timings.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+
+        peak = None
+        if not options['no_memory']:
+            # Separate run, tracing allocations slows everything down
+            run = self.stage_run(stage)
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+
+        return {
+            'wall_ms': {'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)},
+            'queries': statistics.median_low(queries),
+            'peak_memory_kb': peak,
+        }
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        earlier = {(row['stage'], row['cities'], row['history_days']): row for row in baseline['results']}
+        self.stdout.write(f"Compared with {baseline.get('commit') or baseline_path}")
+        regressions = 0
+        for row in results:
+            before = earlier.get((row['stage'], row['cities'], row['history_days']))
+            if before is None:
+                continue
+            ratio = row['wall_ms']['median'] / before['wall_ms']['median'] if before['wall_ms']['median'] else 1
+            query_change = row['queries'] - before['queries']
+            slower = ratio > 1 + tolerance or query_change > 0
+            regressions += slower
+            line = (
+                f"  {row['stage']:32} {row['cities']:6} cities {row['history_days']:3} days  "
+                f"{ratio:6.2f}x time  {query_change:+5} queries"
+            )
+            self.stdout.write(self.style.ERROR(line) if slower else line)
+        if regressions:
+            raise CommandError(f'{regressions} stages regressed')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
@@ -0,0 +1,76 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from windflow.models import TemperatureThreshold
+from windflow.thresholds import RuleIndex
+
+
+def linear_breached(rules, city, value):
+    # The per-rule check check_thresholds used to run for every rule on every cycle
+    breached = set()
+    for rule in rules:
+        if rule.city != city:
+            continue
+        if (rule.min_threshold and value < rule.min_threshold) or (rule.max_threshold and value > rule.max_threshold):
+            breached.add(rule.id)
+    return breached
+
+
+class Command(BaseCommand):
+    help = 'Compare finding breached temperature thresholds with the rule index against a linear scan over every rule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=20000, help='Number of synthetic temperature thresholds')
+        parser.add_argument('--cities', type=int, default=100, help='Number of cities the thresholds are spread over')
+        parser.add_argument('--readings', type=int, default=1000, help='Number of readings to evaluate')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        cities = [f'City {i}' for i in range(options['cities'])]
+
+        rules = []
+        for rule_id in range(1, options['rules'] + 1):
+            low = rng.uniform(-10, 30)
+            rules.append(TemperatureThreshold(
+                id=rule_id,
+                city=rng.choice(cities),
+                min_threshold=low if rng.random() < 0.8 else None,
+                max_threshold=low + rng.uniform(5, 20) if rng.random() < 0.8 else None,
+                consecutive_updates=3,
+            ))
+        readings = [(rng.choice(cities), rng.uniform(-15, 45)) for _ in range(options['readings'])]
+
+        started = time.perf_counter()
+        index = RuleIndex()
+        for rule in rules:
+            index.add('temperature', rule)
+        build_time = time.perf_counter() - started
+
+        rules_by_city = {}
+        for rule in rules:
+            rules_by_city.setdefault(rule.city, []).append(rule)
+
+        started = time.perf_counter()
+        linear = [linear_breached(rules, city, value) for city, value in readings[:50]]
+        linear_all_time = (time.perf_counter() - started) / min(50, len(readings))
+
+        started = time.perf_counter()
+        per_city = [linear_breached(rules_by_city.get(city, []), city, value) for city, value in readings]
+        per_city_time = (time.perf_counter() - started) / len(readings)
+
+        started = time.perf_counter()
+        indexed = [index.breached('temperature', city, value) for city, value in readings]
+        indexed_time = (time.perf_counter() - started) / len(readings)
+
+        if linear != indexed[:len(linear)] or per_city != indexed:
+            self.stdout.write(self.style.ERROR('Rule index and linear scan disagree on the breached rules'))
+            return
+
+        breaches = sum(len(rules) for rules in indexed) / len(indexed)
+        self.stdout.write(f"{options['rules']} rules over {options['cities']} cities, {breaches:.1f} breached rules per reading")
+        self.stdout.write(f'index build:              {build_time * 1000:10.2f} ms')
+        self.stdout.write(f'linear scan, all rules:   {linear_all_time * 1e6:10.2f} us per reading')
+        self.stdout.write(f'linear scan, city rules:  {per_city_time * 1e6:10.2f} us per reading')
+        self.stdout.write(f'rule index:               {indexed_time * 1e6:10.2f} us per reading')
+        self.stdout.write(self.style.SUCCESS(f'Rule index is {linear_all_time / indexed_time:.0f}x faster than scanning every rule'))
@@ -0,0 +1,34 @@
+import random
+from django.core.management.base import BaseCommand
+from windflow.models import City
+from windflow.cache import bump_version
+
+
+class Command(BaseCommand):
+    help = 'Create any number of made-up cities to fetch from the synthetic weather provider (WEATHER_PROVIDER=synthetic)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='Number of cities to have')
+        parser.add_argument('--prefix', default='Synthetic', help='Name prefix of the created cities')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the city coordinates')
+        parser.add_argument('--remove', action='store_true', help='Delete the cities with this prefix instead')
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if options['remove']:
+            deleted, _ = City.objects.filter(name__startswith=f'{prefix} ').delete()
+            bump_version('cities')
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} cities'))
+            return
+
+        rng = random.Random(options['seed'])
+        width = len(str(options['count']))
+        cities = [
+            City(name=f'{prefix} {number:0{width}}', latitude=round(rng.uniform(-55, 70), 4), longitude=round(rng.uniform(-180, 180), 4))
+            for number in range(1, options['count'] + 1)
+        ]
+        existing = City.objects.count()
+        City.objects.bulk_create(cities, batch_size=1000, ignore_conflicts=True)
+        # bulk_create skips the signals that invalidate cached city lists
+        bump_version('cities')
+        self.stdout.write(self.style.SUCCESS(f'Created {City.objects.count() - existing} cities named "{prefix} ..."'))
@@ -0,0 +1,191 @@
+import contextlib
+import csv
+import gzip
+import json
+import math
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from windflow.cache import bump_version
+from windflow.models import City, WeatherData
+from windflow.storage import is_partitioned, ensure_partitions, month_start
+from windflow.utils import ingest_weather_data, compute_daily_summaries, save_daily_summaries
+
+NUMERIC_FIELDS = ['temp', 'feels_like', 'humidity', 'wind_speed', 'wind_deg', 'clouds']
+BOUNDS = {'humidity': (0, 100), 'clouds': (0, 100), 'wind_deg': (0, 360), 'wind_speed': (0, None)}
+SHOWN_ERRORS = 10
+
+
+def open_source(path):
+    if path == '-':
+        # stdin is not ours to close
+        return contextlib.nullcontext(sys.stdin)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+def read_records(source, file_format):
+    # (record, error) pairs, one line at a time
+    if file_format == 'csv':
+        for record in csv.DictReader(source):
+            yield record, None
+        return
+    for line in source:
+        if line.strip():
+            try:
+                yield json.loads(line), None
+            except ValueError as e:
+                yield None, f'not JSON: {e}'
+
+def parse_dt(value):
+    # ISO 8601, or seconds since the epoch; times without a zone are in TIME_ZONE
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.replace('.', '', 1).isdigit()):
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    # parse_datetime takes a trailing Z, which datetime.fromisoformat only does from Python 3.11
+    dt = parse_datetime(str(value).strip())
+    if dt is None:
+        raise ValueError(value)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_current_timezone())
+    return dt
+
+def observation_from_record(record):
+    # An unsaved WeatherData, or raises ValueError saying what is wrong with the record
+    if not isinstance(record, dict):
+        raise ValueError('not an object')
+    city = str(record.get('city') or '').strip()
+    if not city or len(city) > 100:
+        raise ValueError('city is missing or longer than 100 characters')
+    condition = str(record.get('dominant_condition') or '').strip()
+    if not condition or len(condition) > 100:
+        raise ValueError('dominant_condition is missing or longer than 100 characters')
+    if record.get('dt') in (None, ''):
+        raise ValueError('dt is missing')
+    try:
+        dt = parse_dt(record['dt'])
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"dt {record['dt']!r} is not an ISO 8601 time or epoch seconds")
+
+    values = {}
+    for field in NUMERIC_FIELDS:
+        try:
+            value = float(record.get(field))
+        except (TypeError, ValueError):
+            raise ValueError(f'{field} {record.get(field)!r} is not a number')
+        low, high = BOUNDS.get(field, (None, None))
+        if not math.isfinite(value) or (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError(f'{field} {value} is out of range')
+        values[field] = value
+    return WeatherData(city=city, dominant_condition=condition, dt=dt, **values)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import historical observations into the raw weather data from a CSV file (with a header row) or NDJSON file, '
+        'optionally gzipped, or - for stdin. Fields: city, dt, dominant_condition, temp, feels_like, humidity, wind_speed, '
+        'wind_deg, clouds. The file is streamed and loaded in chunks: COPY on Postgres, batched inserts elsewhere. '
+        'Observations already stored for the same city and dt are skipped'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for stdin')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Guessed from the file name by default')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Observations validated and loaded at a time')
+        parser.add_argument('--rebuild-summaries', action='store_true', help='Rebuild the daily summaries of the days and cities imported')
+        parser.add_argument('--dry-run', action='store_true', help='Only validate the file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format']
+        if file_format is None:
+            name = path[:-3] if path.endswith('.gz') else path
+            if name.endswith('.csv'):
+                file_format = 'csv'
+            elif name.endswith(('.ndjson', '.jsonl')):
+                file_format = 'ndjson'
+            else:
+                raise CommandError('Cannot tell the format from the file name, pass --format')
+        chunk_size = max(1, options['chunk_size'])
+
+        self.partitioned = not options['dry_run'] and is_partitioned()
+        self.months = set()
+        self.days = defaultdict(set)
+        self.totals = {'read': 0, 'invalid': 0, 'inserted': 0, 'skipped': 0, 'failed': 0}
+        self.started = time.perf_counter()
+        errors = []
+        chunk = []
+
+        try:
+            source = open_source(path)
+        except OSError as e:
+            raise CommandError(f'Cannot open {path}: {e}')
+        with source as lines:
+            for number, (record, error) in enumerate(read_records(lines, file_format), start=1):
+                self.totals['read'] += 1
+                if error is None:
+                    try:
+                        chunk.append(observation_from_record(record))
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    self.totals['invalid'] += 1
+                    if len(errors) < SHOWN_ERRORS:
+                        errors.append(f'record {number}: {error}')
+                    continue
+                if len(chunk) >= chunk_size:
+                    self.load(chunk, options['dry_run'])
+                    chunk = []
+            self.load(chunk, options['dry_run'])
+
+        for error in errors:
+            self.stdout.write(self.style.WARNING(f'Invalid {error}'))
+        if self.totals['invalid'] > len(errors):
+            self.stdout.write(self.style.WARNING(f"... and {self.totals['invalid'] - len(errors)} more invalid records"))
+        self.stdout.write(self.progress())
+
+        if self.totals['inserted']:
+            if options['rebuild_summaries']:
+                self.rebuild_summaries()
+            # Cached responses built from the previous data are dropped
+            bump_version('data')
+        self.stdout.write(self.style.SUCCESS(f"Imported {self.totals['inserted']} observations from {path}"))
+
+    def load(self, observations, dry_run):
+        if not observations or dry_run:
+            return
+        if self.partitioned:
+            # Historical rows need their monthly partitions
+            months = {month_start(observation.dt) for observation in observations} - self.months
+            if months:
+                ensure_partitions(min(months), max(months))
+                self.months.update(months)
+
+        rows, report = ingest_weather_data(observations)
+        for count in ('inserted', 'skipped', 'failed'):
+            self.totals[count] += report[count]
+        for row in rows:
+            self.days[timezone.localdate(row.dt)].add(row.city)
+        self.stdout.write(self.progress())
+
+    def progress(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.totals['read'] / elapsed if elapsed else 0
+        return (
+            f"{self.totals['read']} read, {self.totals['inserted']} inserted, {self.totals['skipped']} duplicates, "
+            f"{self.totals['invalid']} invalid, {self.totals['failed']} failed in {elapsed:.1f}s ({rate:.0f} rows/s)"
+        )
+
+    def rebuild_summaries(self):
+        # One pair of grouped queries and one bulk upsert per day
+        started = time.perf_counter()
+        known = set(City.objects.values_list('name', flat=True))
+        written = 0
+        for day, cities in sorted(self.days.items()):
+            cities = cities & known
+            if cities:
+                written += len(save_daily_summaries(compute_daily_summaries(day, sorted(cities))))
+        self.stdout.write(f'Rebuilt {written} daily summaries over {len(self.days)} days in {time.perf_counter() - started:.1f}s')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from windflow.storage import maintain_weather_storage, convert_to_partitioned, is_partitioned
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly weather data partitions and roll expired raw observations up into hourly aggregates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', help='Convert the weather data table to a partitioned table first (Postgres only, one-off)')
+        parser.add_argument('--months-ahead', type=int, help='Number of future monthly partitions to keep ready')
+        parser.add_argument('--retention-days', type=int, help='Days of raw observations to keep, 0 keeps everything')
+
+    def handle(self, *args, **options):
+        if options['convert']:
+            if connection.vendor != 'postgresql':
+                raise CommandError('Partitioning is only supported on Postgres')
+            if is_partitioned():
+                self.stdout.write('Weather data table is already partitioned')
+            else:
+                created = convert_to_partitioned(options['months_ahead'])
+                self.stdout.write(self.style.SUCCESS(f'Converted weather data table to {len(created)} monthly partitions'))
+
+        report = maintain_weather_storage(options['months_ahead'], options['retention_days'])
+        for name in report['partitions_created']:
+            self.stdout.write(f'Created partition {name}')
+        for name in report['partitions_dropped']:
+            self.stdout.write(f'Dropped partition {name}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up {report['rows_expired']} expired rows into {report['hours_rolled_up']} city-hours"
+        ))
@@ -0,0 +1,115 @@
+import json
+import random
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.management.base import BaseCommand
+from windflow.broadcast import encode, transcode, next_state, diff_state
+
+CONDITIONS = ['Clear', 'Clouds', 'Rain', 'Haze', 'Mist']
+
+
+class DeflateStream:
+    # permessage-deflate with context takeover, the browser default: one compressor for the whole connection
+    def __init__(self):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def size(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        # The trailing 00 00 ff ff of every sync flush is not sent
+        return len(self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+class Command(BaseCommand):
+    help = 'Measure the bytes a dashboard client receives per update cycle with each WebSocket protocol and encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int, default=100)
+        parser.add_argument('--cycles', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def synthetic_cycles(self, rng, cities, cycles):
+        started = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        weather = {
+            city: {
+                'id': index, 'city': city, 'dominant_condition': rng.choice(CONDITIONS),
+                'temp': rng.uniform(5, 35), 'feels_like': 0.0, 'dt': None,
+                'humidity': float(rng.randint(20, 90)), 'wind_speed': rng.uniform(0, 10),
+                'wind_deg': float(rng.randint(0, 359)), 'clouds': float(rng.randint(0, 100)),
+            }
+            for index, city in enumerate(cities)
+        }
+        totals = {city: {'count': 0, 'temp': 0.0, 'humidity': 0.0} for city in cities}
+
+        for cycle in range(cycles):
+            # Readings drift a little each cycle; slow-moving fields mostly stay put
+            rows, roll_ups = [], {}
+            for city in cities:
+                row = dict(weather[city])
+                row['id'] += len(cities) * (cycle + 1)
+                row['dt'] = (started + timedelta(minutes=10 * cycle)).isoformat()
+                row['temp'] = round(row['temp'] + rng.uniform(-0.3, 0.3), 2)
+                row['feels_like'] = round(row['temp'] - 1.5, 2)
+                if rng.random() < 0.2:
+                    row['humidity'] = float(rng.randint(20, 90))
+                if rng.random() < 0.3:
+                    row['wind_speed'] = round(rng.uniform(0, 10), 2)
+                if rng.random() < 0.05:
+                    row['dominant_condition'] = rng.choice(CONDITIONS)
+                weather[city] = row
+                rows.append(row)
+
+                total = totals[city]
+                total['count'] += 1
+                total['temp'] += row['temp']
+                total['humidity'] += row['humidity']
+                roll_ups[city] = {
+                    'id': cities.index(city), 'city': city, 'date': started.date().isoformat(),
+                    'avg_temp': total['temp'] / total['count'], 'max_temp': row['temp'], 'min_temp': row['temp'],
+                    'avg_feels_like': total['temp'] / total['count'] - 1.5, 'max_feels_like': row['feels_like'],
+                    'min_feels_like': row['feels_like'], 'avg_humidity': total['humidity'] / total['count'],
+                    'avg_wind_speed': row['wind_speed'], 'avg_wind_deg': row['wind_deg'], 'avg_clouds': row['clouds'],
+                    'dominant_condition': row['dominant_condition'],
+                }
+
+            alerts = [
+                {'type': 'Temperature', 'city': city, 'breach': 'above', 'threshold': 30.0, 'consecutive_updates': 3, 'difference': weather[city]['temp'] - 30}
+                for city in cities if weather[city]['temp'] > 30
+            ]
+            yield {'weather': rows, 'roll_ups': roll_ups, 'alerts': alerts}
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        cities = [f'City {i}' for i in range(options['cities'])]
+
+        variants = ['legacy json', 'full json', 'delta json', 'delta msgpack']
+        raw = {variant: 0 for variant in variants}
+        deflated = {variant: 0 for variant in variants}
+        streams = {variant: DeflateStream() for variant in variants}
+
+        state = {}
+        for seq, data in enumerate(self.synthetic_cycles(rng, cities, options['cycles']), start=1):
+            current = next_state(state, data)
+            delta = encode({'type': 'delta', 'seq': seq, 'prev_seq': seq - 1, 'cities': diff_state(state, current)})
+            state = current
+
+            frames = {
+                # What send_weather used to produce: the cycle as a JSON string inside another JSON document
+                'legacy json': json.dumps({'type': 'weather', 'message': json.dumps(data)}),
+                'full json': encode({'type': 'weather', 'message': data}),
+                'delta json': delta,
+                'delta msgpack': transcode(delta),
+            }
+            for variant, frame in frames.items():
+                raw[variant] += len(frame.encode() if isinstance(frame, str) else frame)
+                deflated[variant] += streams[variant].size(frame)
+
+        cycles = options['cycles']
+        baseline = raw['legacy json'] / cycles
+        self.stdout.write(f"{options['cities']} cities, {cycles} cycles, bytes per client per cycle")
+        self.stdout.write(f"{'':16}{'raw':>12}{'deflate':>12}{'vs legacy raw':>15}")
+        for variant in variants:
+            self.stdout.write(
+                f"{variant:16}{raw[variant] / cycles:12.0f}{deflated[variant] / cycles:12.0f}"
+                f"{baseline / (deflated[variant] / cycles):14.1f}x"
+            )
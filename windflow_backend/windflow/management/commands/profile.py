@@ -0,0 +1,82 @@
+import glob
+import os
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from windflow.profiler import TASK_TARGETS, arm, disarm, load_plans
+from windflow.urls import urlpatterns
+
+
+def view_targets():
+    return [getattr(pattern.callback, 'cls', pattern.callback).__name__ for pattern in urlpatterns]
+
+
+class Command(BaseCommand):
+    help = (
+        'Switch the sampling profiler on for a view or Celery task, for a time window and optionally a number of '
+        'invocations across every process. Collapsed stacks of each profiled call are saved to PROFILER_DIR'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', nargs='?', help='View function or task name to profile')
+        parser.add_argument('--seconds', type=int, default=300, help='How long the target stays armed')
+        parser.add_argument('--count', type=int, help='Only profile this many invocations')
+        parser.add_argument('--interval', type=float, help='Seconds between samples, PROFILER_INTERVAL by default')
+        parser.add_argument('--stop', action='store_true', help='Stop profiling the target')
+        parser.add_argument('--list', action='store_true', help='Show what is being profiled and the saved profiles')
+        parser.add_argument('--merge', help='Add up every saved profile of the target into this one file')
+
+    def handle(self, *args, **options):
+        target = options['target']
+        if options['list']:
+            self.show()
+            return
+        if not target:
+            raise CommandError('Name a target to profile')
+        targets = view_targets() + TASK_TARGETS
+        if target not in targets:
+            raise CommandError(f"Unknown target {target}, expected one of {', '.join(targets)}")
+
+        if options['stop']:
+            disarm(target)
+            self.stdout.write(self.style.SUCCESS(f'Stopped profiling {target}'))
+            return
+        if options['merge']:
+            self.merge(target, options['merge'])
+            return
+
+        if options['seconds'] <= 0 or (options['count'] is not None and options['count'] <= 0):
+            raise CommandError('--seconds and --count must be positive')
+        plan = arm(target, options['seconds'], options['count'], options['interval'])
+        calls = f"the next {plan['count']} calls" if plan['count'] is not None else 'every call'
+        self.stdout.write(self.style.SUCCESS(
+            f"Profiling {calls} of {target} for {options['seconds']} seconds, sampling every {plan['interval']} seconds. "
+            f"Running processes start within {settings.PROFILER_POLL_SECONDS} seconds; profiles go to {settings.PROFILER_DIR}"
+        ))
+
+    def show(self):
+        now = time.time()
+        plans = {target: plan for target, plan in load_plans().items() if plan['until'] > now}
+        if not plans:
+            self.stdout.write('Nothing is being profiled')
+        for target, plan in plans.items():
+            count = f", up to {plan['count']} calls" if plan['count'] is not None else ''
+            self.stdout.write(f"  {target:32} {plan['until'] - now:6.0f} seconds left{count}")
+        profiles = Counter(os.path.basename(path).split('.')[0] for path in glob.glob(os.path.join(settings.PROFILER_DIR, '*.folded')))
+        for target, saved in sorted(profiles.items()):
+            self.stdout.write(f'  {target:32} {saved} profiles saved')
+
+    def merge(self, target, output):
+        stacks = Counter()
+        paths = glob.glob(os.path.join(settings.PROFILER_DIR, f'{target}.*.folded'))
+        if not paths:
+            raise CommandError(f'No saved profiles of {target} in {settings.PROFILER_DIR}')
+        for path in paths:
+            with open(path) as profile:
+                for line in profile:
+                    stack, _, samples = line.rstrip('\n').rpartition(' ')
+                    stacks[stack] += int(samples)
+        with open(output, 'w') as merged:
+            merged.writelines(f'{stack} {samples}\n' for stack, samples in stacks.most_common())
+        self.stdout.write(self.style.SUCCESS(f'{len(paths)} profiles of {target}, {sum(stacks.values())} samples, written to {output}'))
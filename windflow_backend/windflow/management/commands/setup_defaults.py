@@ -22,6 +22,15 @@ class Command(BaseCommand):
             }
         )
 
+        daily, _ = IntervalSchedule.objects.get_or_create(every=1, period=IntervalSchedule.DAYS)
+        PeriodicTask.objects.update_or_create(
+            name='maintain_weather_storage_daily',
+            defaults={
+                'task': 'windflow.tasks.maintain_weather_storage_task',
+                'interval': daily
+            }
+        )
+
         all_cities = City.objects.values_list('name', flat=True)
         cities = [
             {'name': 'Delhi', 'latitude': 28.6667, 'longitude': 77.2167},
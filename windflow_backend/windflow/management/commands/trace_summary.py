@@ -0,0 +1,58 @@
+import os
+import statistics
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from windflow.tracing import read_spans
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = 'Summarise the traced weather fetch cycles: where the time of the last cycles went, stage by stage, and the slowest cities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cycles', type=int, default=20, help='Number of most recent cycles to look at')
+        parser.add_argument('--top', type=int, default=10, help='Number of slowest cities to list')
+        parser.add_argument('--file', help='Trace file, WEATHER_TRACE_FILE by default')
+
+    def handle(self, *args, **options):
+        path = options['file'] or settings.WEATHER_TRACE_FILE
+        if not path or not os.path.exists(path):
+            raise CommandError(f'No trace file at {path!r}, is WEATHER_TRACE_FILE set?')
+        spans = read_spans(path, max(1, options['cycles']))
+        if not spans:
+            raise CommandError(f'{path} holds no traces yet')
+
+        stages = defaultdict(list)
+        for span in spans:
+            stages[span['name']].append(span)
+        cycles = len({span['trace_id'] for span in spans})
+        self.stdout.write(f'{len(spans)} spans over the last {cycles} cycles, slowest stages first')
+        self.stdout.write(f"  {'stage':16} {'count':>6} {'total ms':>11} {'mean ms':>10} {'p95 ms':>10} {'max ms':>10} {'queries':>8} {'KiB':>9}")
+        rows = []
+        for name, stage_spans in stages.items():
+            durations = [span['duration_ms'] for span in stage_spans]
+            rows.append((sum(durations), name, stage_spans, durations))
+        for total, name, stage_spans, durations in sorted(rows, key=lambda row: row[0], reverse=True):
+            queries = sum(span['queries'] or 0 for span in stage_spans)
+            payload = sum(span.get('payload_bytes') or 0 for span in stage_spans) / 1024
+            self.stdout.write(
+                f"  {name:16} {len(stage_spans):6} {total:11.1f} {statistics.mean(durations):10.1f} "
+                f"{percentile(durations, 0.95):10.1f} {max(durations):10.1f} {queries:8} {payload:9.1f}"
+            )
+
+        # One provider call per city unless the provider answers for several cities at once
+        cities = defaultdict(list)
+        for span in stages.get('provider_call', []):
+            if span.get('city'):
+                cities[span['city']].append(span['duration_ms'])
+        if cities:
+            self.stdout.write("Slowest cities by mean provider call")
+            slowest = sorted(cities.items(), key=lambda item: statistics.mean(item[1]), reverse=True)[:options['top']]
+            for city, durations in slowest:
+                self.stdout.write(f"  {city:32} {statistics.mean(durations):10.1f} ms mean {max(durations):10.1f} ms max over {len(durations)} calls")
+        self.stdout.write(self.style.SUCCESS('Done'))
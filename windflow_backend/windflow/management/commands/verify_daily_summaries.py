@@ -0,0 +1,62 @@
+from datetime import date as date_cls
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from windflow.models import DailySummary
+from windflow.utils import compute_daily_summaries, save_daily_summaries, DAILY_SUMMARY_FIELDS
+
+
+class Command(BaseCommand):
+    help = 'Recompute daily summaries from the raw weather data and report drift from the stored running accumulators'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Day to verify (YYYY-MM-DD), defaults to today')
+        parser.add_argument('--city', action='append', dest='cities', help='Only verify this city (repeatable)')
+        parser.add_argument('--tolerance', type=float, default=1e-6, help='Allowed absolute difference for numeric fields')
+        parser.add_argument('--fix', action='store_true', help='Overwrite drifted summaries with the recomputed values')
+
+    def handle(self, *args, **options):
+        try:
+            day = date_cls.fromisoformat(options['date']) if options['date'] else timezone.localdate()
+        except ValueError:
+            raise CommandError('Date must be in YYYY-MM-DD format')
+
+        expected = {summary.city: summary for summary in compute_daily_summaries(day, options['cities'])}
+        stored = DailySummary.objects.filter(date=day)
+        if options['cities']:
+            stored = stored.filter(city__in=options['cities'])
+        stored = {summary.city: summary for summary in stored}
+
+        drifted = []
+        for city, summary in expected.items():
+            current = stored.get(city)
+            if current is None:
+                self.stdout.write(self.style.WARNING(f'{city}: no summary stored for {day}'))
+                drifted.append(summary)
+                continue
+
+            differences = []
+            for field in DAILY_SUMMARY_FIELDS:
+                expected_value = getattr(summary, field)
+                current_value = getattr(current, field)
+                if isinstance(expected_value, float) and isinstance(current_value, (int, float)):
+                    if abs(expected_value - current_value) > options['tolerance']:
+                        differences.append(f'{field} {current_value} != {expected_value}')
+                elif expected_value != current_value:
+                    differences.append(f'{field} {current_value} != {expected_value}')
+
+            if differences:
+                self.stdout.write(self.style.WARNING(f'{city}: ' + ', '.join(differences)))
+                drifted.append(summary)
+
+        for city in stored.keys() - expected.keys():
+            self.stdout.write(self.style.WARNING(f'{city}: summary stored for {day} but no weather data found'))
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(f'{len(expected)} summaries for {day} match the raw weather data'))
+            return
+
+        if options['fix']:
+            save_daily_summaries(drifted)
+            self.stdout.write(self.style.SUCCESS(f'Rewrote {len(drifted)} drifted summaries for {day}'))
+        else:
+            self.stdout.write(self.style.ERROR(f'{len(drifted)} of {len(expected)} summaries for {day} drifted, rerun with --fix to rewrite them'))
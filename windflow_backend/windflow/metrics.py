@@ -0,0 +1,71 @@
+import os
+import time
+from django.db import connection
+from django.http import HttpResponse
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# With PROMETHEUS_MULTIPROC_DIR set before start up, daphne and every Celery worker process write their
+# samples to files in that directory, and /metrics adds them all up. It has to be emptied between runs
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+ROW_BUCKETS = (0, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+request_duration = Histogram('windflow_http_request_duration_seconds', 'Time spent answering API requests', ['view', 'method', 'status'])
+request_queries = Histogram('windflow_http_request_queries', 'Database queries per API request', ['view'], buckets=QUERY_BUCKETS)
+
+cycle_duration = Histogram(
+    'windflow_fetch_cycle_duration_seconds', 'Time from dispatching a fetch cycle to its broadcast',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+# Cities are not a label, that would be a series per city; one call is one city unless the provider batches
+provider_call_duration = Histogram('windflow_provider_call_duration_seconds', 'Time per weather provider call', ['provider'])
+cycle_rows = Histogram('windflow_fetch_cycle_rows_inserted', 'Weather observations stored per fetch cycle', buckets=ROW_BUCKETS)
+rows_total = Counter('windflow_weather_rows', 'Weather observations of fetch cycles by outcome', ['outcome'])
+
+websocket_connections = Gauge('windflow_websocket_connections', 'Open WebSocket connections', multiprocess_mode='livesum')
+group_send_duration = Histogram(
+    'windflow_group_send_duration_seconds', 'Time per channel layer group_send of a broadcast',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    # Views made with @api_view are a class named after the function
+    return match.url_name or getattr(match.func, 'cls', match.func).__name__
+
+class MetricsMiddleware:
+    # Latency and query count of every request, labelled by the view that answered it
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        view = view_name(request)
+        if view != 'metrics':
+            request_duration.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+            request_queries.labels(view).observe(queries[0])
+        return response
+
+
+def metrics(request):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+def mark_process_dead(pid):
+    # Drops the live gauges of a worker process that exited
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -19,9 +19,54 @@ class WeatherData(models.Model):
     wind_deg = models.FloatField()
     clouds = models.FloatField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['city', '-dt'], name='weatherdata_city_dt_idx'),
+            models.Index(fields=['dt'], name='weatherdata_dt_idx'),
+        ]
+
     def __str__(self):
         return f"{self.city} - {self.dominant_condition} at {self.dt}"
 
+class LatestWeatherData(models.Model):
+    # Newest observation of each city, kept up to date at ingest so current weather is a keyed lookup
+    city = models.CharField(max_length=100, unique=True)
+    weather_data_id = models.BigIntegerField()
+    dominant_condition = models.CharField(max_length=100)
+    temp = models.FloatField()
+    feels_like = models.FloatField()
+    dt = models.DateTimeField()
+    humidity = models.FloatField()
+    wind_speed = models.FloatField()
+    wind_deg = models.FloatField()
+    clouds = models.FloatField()
+
+    def __str__(self):
+        return f"{self.city} - {self.dominant_condition} at {self.dt}"
+
+class HourlyWeatherData(models.Model):
+    # Raw observations past the retention window, rolled up per city and hour
+    city = models.CharField(max_length=100)
+    hour = models.DateTimeField()
+    sample_count = models.IntegerField()
+    dominant_condition = models.CharField(max_length=100)
+    avg_temp = models.FloatField()
+    max_temp = models.FloatField()
+    min_temp = models.FloatField()
+    avg_feels_like = models.FloatField()
+    avg_humidity = models.FloatField()
+    avg_wind_speed = models.FloatField()
+    avg_wind_deg = models.FloatField()
+    avg_clouds = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'hour'], name='unique_hourly_weather_city_hour'),
+        ]
+
+    def __str__(self):
+        return f"{self.city} - {self.hour}"
+
 class DailySummary(models.Model):
     city = models.CharField(max_length=100)
     date = models.DateField()
@@ -37,6 +82,25 @@ class DailySummary(models.Model):
     avg_clouds = models.FloatField()
     dominant_condition = models.JSONField(validators=[validate_dominant_condition], null=True, blank=True)
 
+    # Running accumulators the averages and dominant condition are derived from
+    sample_count = models.IntegerField(default=0)
+    sum_temp = models.FloatField(default=0)
+    sum_feels_like = models.FloatField(default=0)
+    sum_humidity = models.FloatField(default=0)
+    sum_wind_speed = models.FloatField(default=0)
+    sum_wind_deg = models.FloatField(default=0)
+    sum_clouds = models.FloatField(default=0)
+    condition_counts = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'date'], name='unique_daily_summary_city_date'),
+        ]
+        indexes = [
+            # Rollups are paged newest day first, then by city
+            models.Index(fields=['-date', 'city'], name='dailysummary_date_city_idx'),
+        ]
+
     def __str__(self):
         return f"{self.city} - {self.date}"
     
@@ -55,6 +119,25 @@ class ConnectionStatus(models.Model):
     def __str__(self):
         return f"Connection Status: {'Connected' if self.status else 'Disconnected'}"
 
+class ProviderHealth(models.Model):
+    # Circuit breaker state per provider and city; the row with an empty city covers the provider as a whole
+    provider = models.CharField(max_length=100)
+    city = models.CharField(max_length=100, blank=True, default='')
+    consecutive_failures = models.IntegerField(default=0)
+    last_success = models.DateTimeField(null=True, blank=True)
+    last_failure = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    retry_at = models.DateTimeField(null=True, blank=True)
+    skipped_calls = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'city'], name='unique_provider_health_provider_city'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} - {self.city or 'all cities'}: {self.consecutive_failures} consecutive failures"
+
 class TemperatureThreshold(models.Model):
     city = models.CharField(max_length=100)
     min_threshold = models.FloatField(null=True, blank=True)
@@ -90,5 +173,25 @@ class ConditionThreshold(models.Model):
     def __str__(self):
         return f"Condition Threshold for {self.city}: Condition = {self.condition}"
 
+class ThresholdState(models.Model):
+    # Incremental evaluation state of one threshold rule: the current breach streaks and the
+    # values of the ongoing breach, enough to answer "were all of the last N updates breached"
+    threshold_type = models.CharField(max_length=20)
+    threshold_id = models.BigIntegerField()
+    city = models.CharField(max_length=100)
+    signature = models.CharField(max_length=255)
+    min_streak = models.IntegerField(default=0)
+    min_values = models.JSONField(default=list, blank=True)
+    max_streak = models.IntegerField(default=0)
+    max_values = models.JSONField(default=list, blank=True)
+    match_streak = models.IntegerField(default=0)
+    last_dt = models.DateTimeField(null=True, blank=True)
+    alert = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['threshold_type', 'threshold_id'], name='unique_threshold_state'),
+        ]
 
-
+    def __str__(self):
+        return f"{self.threshold_type} threshold {self.threshold_id} state for {self.city}"
@@ -0,0 +1,94 @@
+import base64
+import json
+from datetime import date as date_cls
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class RollupCursorPagination(BasePagination):
+    # Keyset pagination over daily summaries ordered newest day first, then by city.
+    # A page is fetched with one indexed range query from the (date, city) cursor,
+    # so its cost doesn't depend on how much history lies before it
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+
+    def encode_cursor(self, summary, reverse):
+        position = {'d': summary.date.isoformat(), 'c': summary.city, 'r': reverse}
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return date_cls.fromisoformat(position['d']), position['c'], bool(position['r'])
+        except (TypeError, ValueError, KeyError):
+            raise ValidationError('Invalid cursor')
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+        if page_size is None:
+            return self.page_size
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ValidationError('Page size must be an integer')
+        if page_size < 1:
+            raise ValidationError('Page size must be greater than 0')
+        return min(page_size, self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+
+        reverse = False
+        if cursor is None:
+            queryset = queryset.order_by('-date', 'city')
+        else:
+            day, city, reverse = cursor
+            if reverse:
+                queryset = queryset.filter(Q(date__gt=day) | Q(date=day, city__lt=city)).order_by('date', '-city')
+            else:
+                queryset = queryset.filter(Q(date__lt=day) | Q(date=day, city__gt=city)).order_by('-date', 'city')
+
+        # One extra row tells whether there is anything past this page
+        page = list(queryset[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if reverse:
+            page.reverse()
+
+        self.has_next = has_more if not reverse else True
+        self.has_previous = cursor is not None if not reverse else has_more
+        self.page = page
+        return page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1], False))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = self.request.build_absolute_uri()
+        if not self.page:
+            return remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[0], True))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
@@ -0,0 +1,144 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+
+# Targets being profiled, shared by every process: {target: {'until': epoch seconds, 'count': N or None, 'interval': seconds}}
+PLANS_KEY = 'windflow:profiler'
+TASK_TARGETS = ['fetch_weather_data_task', 'fetch_weather_shard_task', 'finish_weather_cycle_task']
+
+# Each process only looks the plans up once per PROFILER_POLL_SECONDS, so an idle profiler costs a clock read per call
+_plans = {'checked': None, 'plans': {}}
+
+
+def remaining_key(target):
+    return f'{PLANS_KEY}:{target}:remaining'
+
+def load_plans():
+    try:
+        return cache.get(PLANS_KEY) or {}
+    except Exception as e:
+        print(f"Could not read the profiler plans: {e}")
+        return {}
+
+def arm(target, seconds, count=None, interval=None):
+    plans = load_plans()
+    plans[target] = {'until': time.time() + seconds, 'count': count, 'interval': interval or settings.PROFILER_INTERVAL}
+    if count is not None:
+        cache.set(remaining_key(target), count, timeout=seconds)
+    cache.set(PLANS_KEY, plans, timeout=None)
+    return plans[target]
+
+def disarm(target):
+    plans = load_plans()
+    plans.pop(target, None)
+    cache.delete(remaining_key(target))
+    cache.set(PLANS_KEY, plans, timeout=None)
+
+def armed(target):
+    # The plan of target when this call is to be profiled, None otherwise
+    now = time.monotonic()
+    if _plans['checked'] is None or now - _plans['checked'] > settings.PROFILER_POLL_SECONDS:
+        _plans['plans'] = load_plans()
+        _plans['checked'] = now
+    plan = _plans['plans'].get(target)
+    if plan is None or time.time() > plan['until']:
+        return None
+    if plan['count'] is not None:
+        # Shared countdown, so N invocations are profiled across all processes together
+        try:
+            if cache.decr(remaining_key(target)) < 0:
+                return None
+        except Exception:
+            return None
+    return plan
+
+
+def frame_label(frame):
+    code = frame.f_code
+    # co_qualname is new in Python 3.11; the image runs 3.10
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}:{code.co_firstlineno}"
+
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    # Records the stack of one thread every interval seconds, counted per distinct stack
+    def __init__(self, thread_id, interval):
+        super().__init__(name='windflow-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+
+class ProfileSession:
+    def __init__(self, target, plan):
+        self.target = target
+        self.started_at = datetime.now()
+        self.sampler = Sampler(threading.get_ident(), plan['interval'])
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stopped.set()
+        self.sampler.join()
+        return save_profile(self.target, self.started_at, self.sampler.stacks)
+
+def start_profile(target):
+    plan = armed(target)
+    return ProfileSession(target, plan) if plan is not None else None
+
+@contextmanager
+def profiled(target):
+    session = start_profile(target)
+    try:
+        yield
+    finally:
+        if session is not None:
+            session.stop()
+
+def save_profile(target, started_at, stacks):
+    # Collapsed stacks, one "frame;frame;... samples" line each, as read by flamegraph.pl and speedscope
+    path = os.path.join(settings.PROFILER_DIR, f"{target}.{started_at:%Y%m%dT%H%M%S.%f}.{os.getpid()}.folded")
+    try:
+        os.makedirs(settings.PROFILER_DIR, exist_ok=True)
+        with open(path, 'w') as profile:
+            profile.writelines(f'{stack} {samples}\n' for stack, samples in stacks.items())
+    except OSError as e:
+        print(f"Could not save the profile of {target}: {e}")
+        return None
+    return path
+
+
+class ProfilerMiddleware:
+    # Profiles the views armed with the profile command, from the view up to the rendered response
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        session = getattr(request, 'profile_session', None)
+        if session is not None:
+            session.stop()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Views made with @api_view are a class named after the function
+        request.profile_session = start_profile(getattr(view_func, 'cls', view_func).__name__)
+        return None
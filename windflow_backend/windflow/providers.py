@@ -0,0 +1,140 @@
+import math
+import os
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from .models import WeatherData
+from .tracing import current_span
+
+FORECAST_DAYS = 5
+FORECAST_STEP = timedelta(hours=3)
+
+
+def kelvin_to_celsius(kelvin):
+    return kelvin - 273.15
+
+
+class WeatherProvider:
+    name = None
+    # Cities per call: above 1 when the API answers for several cities at once
+    batch_size = 1
+    # Whether calls count against the shared provider quota
+    rate_limited = True
+
+    def fetch_current(self, session, cities):
+        # The current WeatherData observation of each city, unsaved. Raises when the call fails;
+        # cities missing from the result are counted as failed
+        raise NotImplementedError
+
+    def fetch_forecast(self, session, city):
+        # Upcoming readings as dicts of dt, the WeatherData metrics and dominant_condition
+        raise NotImplementedError
+
+
+class OpenWeatherMapProvider(WeatherProvider):
+    name = 'openweathermap'
+    base_url = 'http://api.openweathermap.org/data/2.5'
+
+    def get(self, session, endpoint, city):
+        params = {
+            'lat': city.latitude,
+            'lon': city.longitude,
+            'appid': os.getenv('OPENWEATHERMAP_API_KEY')
+        }
+        response = session.get(f'{self.base_url}/{endpoint}', params=params, timeout=settings.WEATHER_FETCH_TIMEOUT)
+        response.raise_for_status()
+        current_span().add('payload_bytes', len(response.content))
+        return response.json()
+
+    def reading(self, data):
+        return {
+            'dominant_condition': data['weather'][0]['main'],
+            'temp': kelvin_to_celsius(data['main']['temp']),
+            'feels_like': kelvin_to_celsius(data['main']['feels_like']),
+            'dt': timezone.make_aware(datetime.fromtimestamp(data['dt']), timezone.get_current_timezone()),
+            'humidity': data['main']['humidity'],
+            'wind_speed': data['wind']['speed'],
+            'wind_deg': data['wind']['deg'],
+            'clouds': data['clouds']['all'],
+        }
+
+    def fetch_current(self, session, cities):
+        # The free API has no multi-city lookup by coordinates, so a batch is always one city
+        return [WeatherData(city=city.name, **self.reading(self.get(session, 'weather', city))) for city in cities]
+
+    def fetch_forecast(self, session, city):
+        return [self.reading(item) for item in self.get(session, 'forecast', city)['list']]
+
+
+class SyntheticProvider(WeatherProvider):
+    # Generates plausible weather for any city without the network: a climate from the latitude and
+    # season, a daily temperature cycle from the solar time, and noise seeded by the city and the
+    # time slot, so the same city at the same time always gets the same reading.
+    # A new reading is produced every WEATHER_SYNTHETIC_INTERVAL seconds
+    name = 'synthetic'
+    batch_size = 1000
+    rate_limited = False
+
+    def fetch_current(self, session, cities):
+        now = timezone.now()
+        return [WeatherData(city=city.name, **self.reading(city, now)) for city in cities]
+
+    def fetch_forecast(self, session, city):
+        start = timezone.now()
+        steps = int(timedelta(days=FORECAST_DAYS) / FORECAST_STEP)
+        return [self.reading(city, start + FORECAST_STEP * step) for step in range(steps)]
+
+    def reading(self, city, when):
+        interval = settings.WEATHER_SYNTHETIC_INTERVAL
+        slot = int(when.timestamp() // interval)
+        dt = datetime.fromtimestamp(slot * interval, tz=dt_timezone.utc)
+        noise = random.Random(f'{city.name}:{slot}')
+        climate = random.Random(city.name)
+
+        latitude = max(-90.0, min(90.0, city.latitude))
+        # Warmest around the solstice of the city's hemisphere, more so far from the equator
+        season = math.cos(2 * math.pi * (dt.timetuple().tm_yday - 172) / 365) * (1 if latitude >= 0 else -1)
+        solar_hour = (dt.hour + dt.minute / 60 + city.longitude / 15) % 24
+        daily = math.cos(2 * math.pi * (solar_hour - 15) / 24)
+
+        temp = 28 - 0.4 * abs(latitude) + 14 * season * abs(latitude) / 90 + 5 * daily + climate.gauss(0, 2) + noise.gauss(0, 1)
+        humidity = min(100.0, max(5.0, 60 + climate.gauss(0, 10) - 12 * daily + noise.gauss(0, 6)))
+        clouds = min(100.0, max(0.0, humidity - 35 + noise.gauss(0, 20)))
+        wind_speed = abs(climate.gauss(3.5, 1.5) + noise.gauss(0, 1.5))
+        wind_deg = (climate.uniform(0, 360) + noise.gauss(0, 30)) % 360
+
+        # Steadman's apparent temperature
+        vapour_pressure = humidity / 100 * 6.105 * math.exp(17.27 * temp / (237.7 + temp))
+        feels_like = temp + 0.33 * vapour_pressure - 0.7 * wind_speed - 4
+
+        if humidity > 85 and clouds > 70:
+            condition = 'Thunderstorm' if temp > 25 and noise.random() < 0.2 else 'Rain'
+        elif humidity > 80 and temp < 8:
+            condition = 'Mist'
+        elif clouds > 50:
+            condition = 'Clouds'
+        elif humidity > 70:
+            condition = 'Haze'
+        else:
+            condition = 'Clear'
+
+        return {
+            'dominant_condition': condition,
+            'temp': round(temp, 2),
+            'feels_like': round(feels_like, 2),
+            'dt': dt,
+            'humidity': round(humidity),
+            'wind_speed': round(wind_speed, 2),
+            'wind_deg': round(wind_deg),
+            'clouds': round(clouds),
+        }
+
+
+PROVIDERS = {provider.name: provider for provider in (OpenWeatherMapProvider, SyntheticProvider)}
+
+def get_provider(name=None):
+    name = name or settings.WEATHER_PROVIDER
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown weather provider {name}, expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[name]()
@@ -0,0 +1,103 @@
+import time
+from functools import lru_cache
+import redis
+from django.conf import settings
+
+# Refills the bucket for the time since it was last touched, then hands out as many of the requested
+# tokens as will be available within max_wait seconds. Tokens may go negative: that is the queue of calls
+# already promised to other workers. Redis' own clock is used so every worker agrees on the time
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local granted = math.min(requested, math.max(0, math.floor(tokens + max_wait * rate)))
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - granted), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens + granted) / rate) + 1)
+return {granted, tostring(tokens)}
+"""
+
+UNBOUNDED_WAIT = 10 ** 9
+
+
+@lru_cache(maxsize=1)
+def limiter_client():
+    return redis.Redis.from_url(settings.WEATHER_RATE_LIMIT_URL, decode_responses=True)
+
+
+class TokenBucket:
+    # A token bucket kept in Redis, so every Celery worker and management command draws from the same quota.
+    # Pass a client to run it against something other than the configured Redis
+    def __init__(self, name, per_minute, burst, client=None):
+        self.name = name
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.client = client
+        self.key = f'windflow:ratelimit:{name}'
+        self.stats_key = f'windflow:ratelimit:{name}:stats'
+
+    def get_client(self):
+        return self.client or limiter_client()
+
+    def reserve(self, calls=1, max_wait=None):
+        # Seconds from now at which each granted call may go out. Calls that would have to wait
+        # longer than max_wait are not granted, so the caller can defer them instead
+        if self.rate <= 0 or calls <= 0:
+            return [0.0] * calls
+        max_wait = max_wait if max_wait is not None else settings.WEATHER_RATE_LIMIT_MAX_WAIT
+        try:
+            client = self.get_client()
+            granted, tokens = client.eval(RESERVE_SCRIPT, 1, self.key, self.rate, self.burst, calls, max_wait)
+        except Exception as e:
+            # No shared quota without Redis: let the calls through rather than stop fetching
+            print(f"Rate limiter {self.name} unavailable: {e}")
+            return [0.0] * calls
+        tokens = float(tokens)
+        waits = [max(0.0, (call + 1 - tokens) / self.rate) for call in range(int(granted))]
+        self.record(waits, calls - len(waits))
+        return waits
+
+    def acquire(self):
+        # Waits for a call however long the queue is, for callers with nothing else to do meanwhile
+        waits = self.reserve(1, max_wait=UNBOUNDED_WAIT)
+        time.sleep(waits[0])
+        return waits[0]
+
+    def record(self, waits, deferred):
+        throttled = [wait for wait in waits if wait > 0]
+        try:
+            pipeline = self.get_client().pipeline(transaction=False)
+            pipeline.hincrby(self.stats_key, 'calls', len(waits))
+            pipeline.hincrby(self.stats_key, 'throttled_calls', len(throttled))
+            pipeline.hincrbyfloat(self.stats_key, 'throttled_seconds', sum(throttled))
+            pipeline.hincrby(self.stats_key, 'deferred_calls', deferred)
+            pipeline.execute()
+        except Exception as e:
+            print(f"Could not record rate limiter {self.name} stats: {e}")
+
+    def stats(self):
+        counters = self.get_client().hgetall(self.stats_key)
+        bucket = self.get_client().hgetall(self.key)
+        tokens = float(bucket['tokens']) if bucket else self.burst
+        return {
+            'per_minute': self.rate * 60,
+            'burst': self.burst,
+            # Negative while calls are queued up behind the quota
+            'tokens': tokens,
+            'calls': int(counters.get('calls', 0)),
+            'throttled_calls': int(counters.get('throttled_calls', 0)),
+            'throttled_seconds': float(counters.get('throttled_seconds', 0)),
+            'deferred_calls': int(counters.get('deferred_calls', 0)),
+        }
+
+
+def wait_until(started, wait):
+    remaining = started + wait - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
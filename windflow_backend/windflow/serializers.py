@@ -1,15 +1,46 @@
 from rest_framework import serializers
-from .models import WeatherData, DailySummary, City, ConnectionStatus, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from .health import circuit_state
+from .models import WeatherData, LatestWeatherData, ProviderHealth, DailySummary, City, ConnectionStatus, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
 
 class WeatherDataSerializer(serializers.ModelSerializer):
     class Meta:
         model = WeatherData
         fields = '__all__'
 
+# Same output as WeatherDataSerializer, built straight from the model instance
+# so a whole ingest cycle can be turned into a payload without a serializer pass per row
+_datetime_field = serializers.DateTimeField()
+
+def weather_data_payload(weather_data):
+    return {
+        'id': weather_data.id,
+        'city': weather_data.city,
+        'dominant_condition': weather_data.dominant_condition,
+        'temp': float(weather_data.temp),
+        'feels_like': float(weather_data.feels_like),
+        'dt': _datetime_field.to_representation(weather_data.dt),
+        'humidity': float(weather_data.humidity),
+        'wind_speed': float(weather_data.wind_speed),
+        'wind_deg': float(weather_data.wind_deg),
+        'clouds': float(weather_data.clouds),
+    }
+
+def weather_data_from_payload(payload):
+    # The other way round, for observations handed between Celery tasks
+    return WeatherData(**{**payload, 'dt': _datetime_field.to_internal_value(payload['dt'])})
+
+class LatestWeatherDataSerializer(serializers.ModelSerializer):
+    # Shaped like WeatherDataSerializer, with the id of the observation the snapshot was taken from
+    id = serializers.IntegerField(source='weather_data_id')
+
+    class Meta:
+        model = LatestWeatherData
+        fields = ['id', 'city', 'dominant_condition', 'temp', 'feels_like', 'dt', 'humidity', 'wind_speed', 'wind_deg', 'clouds']
+
 class DailySummarySerializer(serializers.ModelSerializer):
     class Meta:
         model = DailySummary
-        fields = '__all__'
+        exclude = ['sample_count', 'sum_temp', 'sum_feels_like', 'sum_humidity', 'sum_wind_speed', 'sum_wind_deg', 'sum_clouds', 'condition_counts']
 
 class CitySerializer(serializers.ModelSerializer):
     class Meta:
@@ -21,6 +52,16 @@ class ConnectionStatusSerializer(serializers.ModelSerializer):
         model = ConnectionStatus
         fields = '__all__'
 
+class ProviderHealthSerializer(serializers.ModelSerializer):
+    state = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProviderHealth
+        exclude = ['id']
+
+    def get_state(self, obj):
+        return circuit_state(obj)
+
 class TemperatureThresholdSerializer(serializers.ModelSerializer):
     class Meta:
         model = TemperatureThreshold
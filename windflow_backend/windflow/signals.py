@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import City, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from .thresholds import rule_changed
+from .cache import bump_version
+
+THRESHOLD_SENDERS = {
+    TemperatureThreshold: 'temperature',
+    HumidityThreshold: 'humidity',
+    WindSpeedThreshold: 'wind_speed',
+    ConditionThreshold: 'condition',
+}
+
+
+@receiver(post_save, sender=TemperatureThreshold)
+@receiver(post_save, sender=HumidityThreshold)
+@receiver(post_save, sender=WindSpeedThreshold)
+@receiver(post_save, sender=ConditionThreshold)
+def threshold_saved(sender, instance, **kwargs):
+    # A created or edited rule loses its streak state and is patched into the rule index;
+    # the next evaluation reseeds it from history
+    rule_id = instance.id
+    transaction.on_commit(lambda: rule_changed(THRESHOLD_SENDERS[sender], sender, rule_id))
+
+@receiver(post_delete, sender=TemperatureThreshold)
+@receiver(post_delete, sender=HumidityThreshold)
+@receiver(post_delete, sender=WindSpeedThreshold)
+@receiver(post_delete, sender=ConditionThreshold)
+def threshold_deleted(sender, instance, **kwargs):
+    rule_id = instance.id
+    transaction.on_commit(lambda: rule_changed(THRESHOLD_SENDERS[sender], sender, rule_id, deleted=True))
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def city_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_version('cities'))
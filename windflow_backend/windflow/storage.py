@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Avg, Max, Min, Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from .models import WeatherData, HourlyWeatherData
+from .utils import dominant_condition
+
+EXPIRE_INTERVAL = timedelta(hours=6)
+# DDL on the parent table gives up instead of queueing behind long readers; the next run retries
+LOCK_TIMEOUT = '5s'
+
+HOURLY_AGGREGATES = {
+    'sample_count': Count('id'),
+    'avg_temp': Avg('temp'),
+    'max_temp': Max('temp'),
+    'min_temp': Min('temp'),
+    'avg_feels_like': Avg('feels_like'),
+    'avg_humidity': Avg('humidity'),
+    'avg_wind_speed': Avg('wind_speed'),
+    'avg_wind_deg': Avg('wind_deg'),
+    'avg_clouds': Avg('clouds'),
+}
+HOURLY_AVERAGES = [field for field in HOURLY_AGGREGATES if field.startswith('avg_')]
+
+
+def weather_table():
+    return WeatherData._meta.db_table
+
+def month_start(value):
+    return value.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+def partition_name(start):
+    return f"{weather_table()}_p{start:%Y%m}"
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [weather_table()])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+def list_partitions():
+    # Monthly partitions, by start of month; named <table>_pYYYYMM
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(%s)",
+            [weather_table()],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = {}
+    prefix = f"{weather_table()}_p"
+    for name in names:
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            partitions[name] = datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=dt_timezone.utc)
+    return partitions
+
+def create_partition(start):
+    # Created standalone and then attached, which only needs a SHARE UPDATE EXCLUSIVE lock on the parent
+    table = weather_table()
+    name = partition_name(start)
+    end = add_months(start, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} (LIKE {table} INCLUDING DEFAULTS)")
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+    return name
+
+def ensure_partitions(start, end):
+    existing = list_partitions()
+    created = []
+    month = month_start(start)
+    while month <= end:
+        if partition_name(month) not in existing:
+            created.append(create_partition(month))
+        month = add_months(month, 1)
+    return created
+
+def convert_to_partitioned(months_ahead=None):
+    # One-off: rebuilds the plain weather table as a table partitioned by month on dt.
+    # Rows are copied under an exclusive lock, so run it before starting the workers
+    if months_ahead is None:
+        months_ahead = settings.WEATHER_DATA_PARTITION_MONTHS_AHEAD
+    table = weather_table()
+    legacy = f"{table}_unpartitioned"
+    sequence = f"{table}_pk_seq"
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        cursor.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (dt)")
+        # Identity columns are not supported on partitioned tables before Postgres 17
+        cursor.execute(f"CREATE SEQUENCE {sequence} OWNED BY {table}.id")
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+        cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, dt)")
+
+        cursor.execute(f"SELECT min(dt) FROM {legacy}")
+        oldest = cursor.fetchone()[0] or timezone.now()
+        now = timezone.now()
+        created = ensure_partitions(min(oldest, now), add_months(month_start(now), months_ahead))
+
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+        cursor.execute(f"SELECT setval('{sequence}', COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)")
+        cursor.execute(f"DROP TABLE {legacy}")
+
+        with connection.schema_editor() as editor:
+            for index in WeatherData._meta.indexes:
+                editor.add_index(WeatherData, index)
+    return created
+
+def rollup_range(start, end):
+    expired = WeatherData.objects.filter(dt__gte=start, dt__lt=end).annotate(hour=TruncHour('dt', tzinfo=dt_timezone.utc))
+
+    condition_counts = defaultdict(dict)
+    for row in expired.values('city', 'hour', 'dominant_condition').annotate(occurrences=Count('id')).order_by():
+        condition_counts[(row['city'], row['hour'])][row['dominant_condition']] = row['occurrences']
+
+    hourly = {}
+    for row in expired.values('city', 'hour').annotate(**HOURLY_AGGREGATES).order_by():
+        key = (row['city'], row['hour'])
+        hourly[key] = HourlyWeatherData(dominant_condition=dominant_condition(condition_counts[key]), **row)
+    if not hourly:
+        return 0, 0
+    rows = sum(rolled_up.sample_count for rolled_up in hourly.values())
+
+    # Rows arriving late for an hour that was already rolled up are merged into it
+    existing = HourlyWeatherData.objects.filter(
+        city__in={city for city, _ in hourly},
+        hour__gte=min(hour for _, hour in hourly),
+        hour__lte=max(hour for _, hour in hourly),
+    )
+    for current in existing:
+        rolled_up = hourly.get((current.city, current.hour))
+        if rolled_up is None:
+            continue
+        total = current.sample_count + rolled_up.sample_count
+        for field in HOURLY_AVERAGES:
+            setattr(rolled_up, field, (getattr(current, field) * current.sample_count + getattr(rolled_up, field) * rolled_up.sample_count) / total)
+        rolled_up.max_temp = max(current.max_temp, rolled_up.max_temp)
+        rolled_up.min_temp = min(current.min_temp, rolled_up.min_temp)
+        if current.sample_count > condition_counts[(current.city, current.hour)].get(rolled_up.dominant_condition, 0):
+            rolled_up.dominant_condition = current.dominant_condition
+        rolled_up.sample_count = total
+
+    HourlyWeatherData.objects.bulk_create(
+        list(hourly.values()),
+        update_conflicts=True,
+        unique_fields=['city', 'hour'],
+        update_fields=['sample_count', 'dominant_condition', 'max_temp', 'min_temp'] + HOURLY_AVERAGES,
+    )
+    return len(hourly), rows
+
+def drop_expired_partitions(cutoff):
+    # Each month is rolled up and dropped in one transaction; the exclusive lock DETACH needs
+    # is only taken at the very end, and gives up after LOCK_TIMEOUT
+    table = weather_table()
+    report = {'hours_rolled_up': 0, 'rows_expired': 0, 'partitions_dropped': []}
+    for name, start in sorted(list_partitions().items(), key=lambda item: item[1]):
+        end = add_months(start, 1)
+        if end > cutoff:
+            continue
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                hours, rows = rollup_range(start, end)
+                cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+        except Exception as e:
+            print(f"Could not drop expired partition {name}: {e}")
+            continue
+        report['hours_rolled_up'] += hours
+        report['rows_expired'] += rows
+        report['partitions_dropped'].append(name)
+    return report
+
+def expire_rows(cutoff):
+    # Rolled up and deleted an interval at a time, so every transaction and the row locks it holds stay short
+    report = {'hours_rolled_up': 0, 'rows_expired': 0}
+    oldest = WeatherData.objects.filter(dt__lt=cutoff).aggregate(oldest=Min('dt'))['oldest']
+    if oldest is None:
+        return report
+
+    start = oldest.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    while start < cutoff:
+        end = min(start + EXPIRE_INTERVAL, cutoff)
+        with transaction.atomic():
+            hours, rows = rollup_range(start, end)
+            WeatherData.objects.filter(dt__gte=start, dt__lt=end).delete()
+        report['hours_rolled_up'] += hours
+        report['rows_expired'] += rows
+        start = end
+    return report
+
+def maintain_weather_storage(months_ahead=None, retention_days=None):
+    if months_ahead is None:
+        months_ahead = settings.WEATHER_DATA_PARTITION_MONTHS_AHEAD
+    if retention_days is None:
+        retention_days = settings.WEATHER_DATA_RETENTION_DAYS
+
+    now = timezone.now()
+    partitioned = is_partitioned()
+    report = {'partitions_created': [], 'partitions_dropped': [], 'hours_rolled_up': 0, 'rows_expired': 0}
+
+    if partitioned:
+        report['partitions_created'] = ensure_partitions(now, add_months(month_start(now), months_ahead))
+
+    if retention_days > 0:
+        cutoff = (now - timedelta(days=retention_days)).astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+        steps = [drop_expired_partitions(cutoff)] if partitioned else []
+        steps.append(expire_rows(cutoff))
+        for step in steps:
+            report['partitions_dropped'] += step.get('partitions_dropped', [])
+            report['hours_rolled_up'] += step['hours_rolled_up']
+            report['rows_expired'] += step['rows_expired']
+
+    return report
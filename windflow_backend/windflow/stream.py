@@ -0,0 +1,54 @@
+from functools import lru_cache
+import redis
+from django.conf import settings
+
+STREAM_KEY = 'windflow:broadcast:stream'
+
+
+@lru_cache(maxsize=1)
+def stream_client():
+    return redis.Redis.from_url(settings.NOTIFICATION_STREAM_URL, decode_responses=True)
+
+def entry_id(seq):
+    return f'{seq}-0'
+
+def entry_seq(entry_id):
+    return int(entry_id.split('-')[0])
+
+def append_cycle(seq, full, delta):
+    # Every broadcast cycle under its sequence number, trimmed to roughly the last NOTIFICATION_STREAM_LENGTH cycles.
+    # A length of 0 turns the stream off and reconnecting clients always get a snapshot
+    if not settings.NOTIFICATION_STREAM_LENGTH:
+        return
+    client = stream_client()
+    fields = {'full': full, 'delta': delta}
+    try:
+        try:
+            client.xadd(STREAM_KEY, fields, id=entry_id(seq), maxlen=settings.NOTIFICATION_STREAM_LENGTH, approximate=True)
+        except redis.ResponseError:
+            # The sequence started over, so what the stream holds belongs to the old one
+            client.delete(STREAM_KEY)
+            client.xadd(STREAM_KEY, fields, id=entry_id(seq), maxlen=settings.NOTIFICATION_STREAM_LENGTH, approximate=True)
+    except Exception as e:
+        print(f"Could not append broadcast {seq} to the notification stream: {e}")
+
+def cycles_since(last_seq, current_seq):
+    # The cycles a client missed after last_seq, oldest first, or None when they can no longer all be replayed
+    if not settings.NOTIFICATION_STREAM_LENGTH:
+        return None
+    if last_seq > current_seq:
+        # The sequence was reset since the client last saw it
+        return None
+    if last_seq == current_seq:
+        return []
+    if current_seq - last_seq > settings.NOTIFICATION_REPLAY_LIMIT:
+        return None
+    try:
+        entries = stream_client().xrange(STREAM_KEY, min=entry_id(last_seq + 1), max=entry_id(current_seq))
+    except Exception as e:
+        print(f"Could not read the notification stream: {e}")
+        return None
+    if len(entries) != current_seq - last_seq:
+        # Trimmed away already, or a cycle never made it into the stream
+        return None
+    return [(entry_seq(id), fields) for id, fields in entries]
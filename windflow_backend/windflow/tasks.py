@@ -1,29 +1,120 @@
+import time
 from .utils import fetch_weather_data, update_daily_summary_for_today, check_thresholds
-from .models import ConnectionStatus
+from .models import City, ConnectionStatus
+from .serializers import weather_data_payload, weather_data_from_payload
+from .providers import get_provider
+from .health import PROVIDER_WIDE, circuit_state, load_health, settle_provider, save_health
+from .storage import maintain_weather_storage
+from .cache import bump_version
+from .freshness import remember_connection_status
+from .broadcast import broadcast_cycle
+from .tracing import trace, span
+from .metrics import cycle_duration, cycle_rows, rows_total
+from .profiler import profiled
+from django.conf import settings
 from django.utils import timezone
 from celery.utils.log import get_task_logger
-from celery import shared_task
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-import json
+from celery import shared_task, chord
 
 logger = get_task_logger(__name__)
 
+REPORT_COUNTS = ['inserted', 'skipped', 'failed', 'fetched', 'short_circuited', 'deferred']
+
+def shard_cities(names):
+    size = max(1, settings.WEATHER_FETCH_SHARD_SIZE)
+    return [names[start:start + size] for start in range(0, len(names), size)]
+
 @shared_task
 def fetch_weather_data_task():
+    # Splits the cycle into shards of cities fetched and stored in parallel by any worker,
+    # then joins them into one round of summaries, threshold checks and a single broadcast.
+    # Every task of the cycle exports its spans under the dispatcher's trace id
+    started = time.time()
+    with profiled('fetch_weather_data_task'), trace('cycle') as cycle:
+        try:
+            names = list(City.objects.order_by('name').values_list('name', flat=True))
+            shards = shard_cities(names)
+            cycle.set(cities=len(names), shards=len(shards))
+            provider = load_health(get_provider().name, [])[PROVIDER_WIDE]
+            if len(shards) <= 1 or circuit_state(provider) != 'closed':
+                # Small enough for one worker, or the provider is down and gets a single probe call
+                shard = fetch_weather_shard(None, provider_wide=True)
+                with span('finish'):
+                    finish_weather_cycle([shard], provider_wide=True, started=started)
+                return
+            chord(fetch_weather_shard_task.s(shard, cycle.trace_id) for shard in shards)(finish_weather_cycle_task.s(cycle.trace_id, started))
+        except Exception as e:
+            update_connection_status(False)
+            print("error",e)
+            logger.error(f'Error fetching weather data: {e}')
+
+@shared_task
+def fetch_weather_shard_task(city_names, trace_id=None):
+    with profiled('fetch_weather_shard_task'):
+        return fetch_weather_shard(city_names, trace_id=trace_id)
+
+@shared_task
+def finish_weather_cycle_task(shards, trace_id=None, started=None):
+    with profiled('finish_weather_cycle_task'), trace('finish', trace_id):
+        finish_weather_cycle(shards, started=started)
+
+def fetch_weather_shard(city_names, provider_wide=False, trace_id=None):
+    # Results travel through the Celery result backend, so the stored rows go back as payloads
+    with trace('shard', trace_id, cities=len(city_names) if city_names is not None else None) as shard:
+        try:
+            rows, report = fetch_weather_data(city_names, provider_wide=provider_wide)
+        except Exception as e:
+            logger.error(f'Error fetching weather data for {len(city_names or [])} cities: {e}')
+            return {'weather': [], 'report': None}
+        result = {'weather': [weather_data_payload(row) for row in rows], 'report': report}
+        shard.measure('payload_bytes', result)
+        return result
+
+def finish_weather_cycle(shards, provider_wide=False, started=None):
     try:
-        weather_data = fetch_weather_data()
-        updated_data = update_daily_summary_for_today()
-        update_connection_status(True)
-        logger.info('Successfully fetched weather data')
-        alerts = check_thresholds()
+        reports = [shard['report'] for shard in shards if shard['report'] is not None]
+        if not reports:
+            raise RuntimeError('every shard of the cycle failed')
+        ingest_report = {count: sum(report[count] for report in reports) for count in REPORT_COUNTS}
+        if not provider_wide:
+            error = next((report['error'] for report in reports if report['error']), None)
+            provider = load_health(get_provider().name, [])[PROVIDER_WIDE]
+            settle_provider(provider, ingest_report['fetched'] > 0, error, ingest_report['short_circuited'], timezone.now())
+            save_health([provider])
+
+        weather_data = [payload for shard in shards for payload in shard['weather']]
+        rows = [weather_data_from_payload(payload) for payload in weather_data]
+        with span('summaries', rows=len(rows)):
+            updated_data = update_daily_summary_for_today(rows)
+        # Connected as long as the provider answered for at least one city, or nothing needed fetching
+        update_connection_status(ingest_report['fetched'] > 0 or not (ingest_report['failed'] or ingest_report['short_circuited']))
+        logger.info(
+            f"Successfully fetched weather data in {len(shards)} shards: {ingest_report['inserted']} inserted, {ingest_report['skipped']} skipped, "
+            f"{ingest_report['failed']} failed, {ingest_report['short_circuited']} skipped behind an open circuit, "
+            f"{ingest_report['deferred']} deferred by the rate limit"
+        )
+        with span('thresholds', rows=len(rows)) as checking:
+            alerts = check_thresholds(rows)
+            checking.set(alerts=len(alerts or []))
+        if rows:
+            # Cached responses built from the previous cycle's data are dropped
+            bump_version('data')
 
         notification_data = {
-            'weather': weather_data,
+            'weather': weather_data or None,
             'roll_ups': updated_data,
             'alerts': alerts
         }
-        send_weather(notification_data)
+        with span('broadcast'):
+            send_weather(notification_data)
+
+        for count in REPORT_COUNTS:
+            if count != 'fetched':
+                rows_total.labels(count).inc(ingest_report[count])
+        cycle_rows.observe(ingest_report['inserted'])
+        if started is not None:
+            # Dispatched at started, on whichever worker; clocks of the workers are assumed in sync
+            cycle_duration.observe(time.time() - started)
             
     except Exception as e:
         update_connection_status(False)
@@ -31,6 +122,19 @@ def fetch_weather_data_task():
         logger.error(f'Error fetching weather data: {e}')
 
 
+@shared_task
+def maintain_weather_storage_task():
+    try:
+        report = maintain_weather_storage()
+        logger.info(
+            f"Weather data storage maintained: {len(report['partitions_created'])} partitions created, "
+            f"{report['hours_rolled_up']} city-hours rolled up, {len(report['partitions_dropped'])} partitions dropped, "
+            f"{report['rows_expired']} raw rows expired"
+        )
+    except Exception as e:
+        logger.error(f'Error maintaining weather data storage: {e}')
+
+
 def update_connection_status(success):
     status, created = ConnectionStatus.objects.get_or_create(id=1)
     if success:
@@ -39,15 +143,8 @@ def update_connection_status(success):
     else:
         status.status = False
     status.save()
+    remember_connection_status(status)
 
 
 def send_weather(data):
-    channel_layer = get_channel_layer()
-    data = json.dumps(data)
-    async_to_sync(channel_layer.group_send)(
-        "notifications",
-        {
-            "type": "weather",
-            "message": data,
-        }
-    )
+    broadcast_cycle(data)
@@ -1,3 +1,445 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import random
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from unittest import mock, skipIf
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.db import transaction
+from django.utils import timezone
+from . import ratelimit, thresholds
+from .cache import bump_version, get_version, version_key
+from .broadcast import ALL_GROUP, DELTA_GROUP, STATE_KEY, cycle_frames
+from .consumers import NotificationConsumer
+from .models import City, DailySummary, WeatherData, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from .ratelimit import TokenBucket
+from .serializers import weather_data_payload
+from .utils import check_thresholds, DAILY_SUMMARY_FIELDS, compute_daily_summaries, ingest_weather_data, update_daily_summary_for_today
 
-# Create your tests here.
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def observation(city, dt, temp=20, condition='Clear', **values):
+    return WeatherData(
+        city=city, dt=dt, temp=temp, dominant_condition=condition,
+        feels_like=values.get('feels_like', temp), humidity=values.get('humidity', 50), wind_speed=values.get('wind_speed', 3),
+        wind_deg=values.get('wind_deg', 180), clouds=values.get('clouds', 10),
+    )
+
+def daily_summary(city, day, temp=20):
+    return DailySummary.objects.create(
+        city=city, date=day, avg_temp=temp, max_temp=temp, min_temp=temp, avg_feels_like=temp, max_feels_like=temp,
+        min_feels_like=temp, avg_humidity=50, avg_wind_speed=3, avg_wind_deg=180, avg_clouds=10, dominant_condition='Clear',
+    )
+
+def full_scan_alerts():
+    # The check every rule used to get on every cycle: breached when all of its last N readings were
+    alerts = []
+    for threshold_type, (model, field, alert_type) in thresholds.THRESHOLD_TYPES.items():
+        for rule in model.objects.order_by('id'):
+            values = list(WeatherData.objects.filter(city=rule.city).order_by('-dt').values_list(field, flat=True)[:rule.consecutive_updates])
+            if not rule.consecutive_updates or len(values) < rule.consecutive_updates:
+                continue
+            if threshold_type == 'condition':
+                if all(value == rule.condition for value in values):
+                    alerts.append({'type': alert_type, 'city': rule.city, 'threshold': rule.condition, 'consecutive_updates': rule.consecutive_updates})
+                continue
+            min_breached = bool(rule.min_threshold) and all(value < rule.min_threshold for value in values)
+            max_breached = bool(rule.max_threshold) and all(value > rule.max_threshold for value in values)
+            if min_breached or max_breached:
+                threshold_value = rule.min_threshold if min_breached else rule.max_threshold
+                alerts.append({
+                    'type': alert_type,
+                    'city': rule.city,
+                    'breach': 'below' if min_breached else 'above',
+                    'threshold': threshold_value,
+                    'consecutive_updates': rule.consecutive_updates,
+                    'difference': abs(sum(values) / len(values) - threshold_value),
+                })
+    return alerts
+
+def ingest_cycle(observations):
+    # What finish_weather_cycle hands to the broadcaster, for observations stored like a fetch cycle would
+    rows, _ = ingest_weather_data(observations)
+    return {'weather': [weather_data_payload(row) for row in rows], 'roll_ups': update_daily_summary_for_today(rows), 'alerts': []}
+
+
+@skipIf(fakeredis is None, 'needs fakeredis with Lua support: pip install fakeredis[lua]')
+class TokenBucketTests(SimpleTestCase):
+    # Runs the Lua script against an in-process Redis stand-in, no Redis server needed
+    def setUp(self):
+        self.client = fakeredis.FakeRedis(decode_responses=True)
+        # One call per second, up to 5 back to back
+        self.bucket = TokenBucket('test', per_minute=60, burst=5, client=self.client)
+
+    def age(self, bucket, seconds):
+        # As if the bucket was last touched this many seconds earlier
+        self.client.hincrbyfloat(bucket.key, 'updated', -seconds)
+
+    def test_burst_goes_out_without_waiting(self):
+        self.assertEqual(self.bucket.reserve(5, max_wait=0), [0.0] * 5)
+        self.assertEqual(self.bucket.reserve(1, max_wait=0), [])
+
+    def test_refills_over_time(self):
+        self.bucket.reserve(5, max_wait=0)
+        self.age(self.bucket, 3)
+        self.assertEqual(len(self.bucket.reserve(5, max_wait=0)), 3)
+
+    def test_refill_is_capped_at_the_burst(self):
+        self.bucket.reserve(5, max_wait=0)
+        self.age(self.bucket, 3600)
+        self.assertEqual(len(self.bucket.reserve(10, max_wait=0)), 5)
+        self.assertLess(self.bucket.stats()['tokens'], 1)
+
+    def test_calls_past_max_wait_are_deferred(self):
+        waits = self.bucket.reserve(8, max_wait=2)
+        self.assertEqual(len(waits), 7)
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertAlmostEqual(waits[5], 1, places=1)
+        self.assertAlmostEqual(waits[6], 2, places=1)
+
+        stats = self.bucket.stats()
+        self.assertEqual(stats['calls'], 7)
+        self.assertEqual(stats['throttled_calls'], 2)
+        self.assertAlmostEqual(stats['throttled_seconds'], 3, places=1)
+        self.assertEqual(stats['deferred_calls'], 1)
+        # The granted calls are queued up behind the quota
+        self.assertAlmostEqual(stats['tokens'], -2, places=1)
+
+    def test_acquire_waits_for_its_turn(self):
+        self.bucket.reserve(5, max_wait=0)
+        with mock.patch.object(ratelimit.time, 'sleep') as sleep:
+            wait = self.bucket.acquire()
+        self.assertAlmostEqual(wait, 1, places=1)
+        sleep.assert_called_once_with(wait)
+
+    def test_buckets_are_independent(self):
+        other = TokenBucket('other', per_minute=60, burst=2, client=self.client)
+        self.bucket.reserve(5, max_wait=0)
+        self.assertEqual(other.reserve(3, max_wait=0), [0.0, 0.0])
+        self.assertEqual(self.bucket.stats()['calls'], 5)
+        self.assertEqual(other.stats()['calls'], 2)
+        self.assertEqual(other.stats()['deferred_calls'], 1)
+
+
+@override_settings(CACHES=LOCAL_CACHE, NOTIFICATION_STREAM_LENGTH=0)
+class BroadcastStateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now().replace(microsecond=0)
+        for name in ('Delhi', 'Mumbai', 'Pune'):
+            City.objects.create(name=name, latitude=0, longitude=0)
+
+    def delta_event(self, frames):
+        return next(event for group, event in frames if group == DELTA_GROUP)
+
+    def test_lost_state_is_followed_by_a_snapshot(self):
+        ingest_cycle([observation(name, self.now - timedelta(minutes=10)) for name in ('Delhi', 'Mumbai', 'Pune')])
+        cache.delete(STATE_KEY)
+        data = ingest_cycle([observation(name, self.now, temp=30) for name in ('Delhi', 'Mumbai', 'Pune')])
+
+        event = self.delta_event(cycle_frames(data))
+        frame = json.loads(event['text'])
+        self.assertTrue(event['snapshot'])
+        self.assertNotIn('prev_seq', event)
+        self.assertEqual(frame['type'], 'snapshot')
+        self.assertEqual(sorted(frame['cities']), ['Delhi', 'Mumbai', 'Pune'])
+        self.assertEqual(frame['cities']['Delhi']['weather']['temp'], 30)
+
+        # Back to deltas once the state is stored again
+        data = ingest_cycle([observation('Pune', self.now + timedelta(minutes=10), temp=31)])
+        delta = self.delta_event(cycle_frames(data))
+        self.assertEqual(delta['prev_seq'], event['seq'])
+        self.assertEqual(list(json.loads(delta['text'])['cities']), ['Pune'])
+
+    def test_delta_client_in_sync_takes_the_snapshot(self):
+        first = self.delta_event(cycle_frames(ingest_cycle([observation('Delhi', self.now - timedelta(minutes=10))])))
+        consumer = NotificationConsumer()
+        consumer.pending, consumer.replies, consumer.behind_since, consumer.wakeup = OrderedDict(), 0, None, asyncio.Event()
+        consumer.protocol, consumer.seq, consumer.replayed_to = 'delta', first['seq'], None
+
+        cache.delete(STATE_KEY)
+        event = self.delta_event(cycle_frames(ingest_cycle([observation('Delhi', self.now, temp=30)])))
+        asyncio.run(consumer.forward(event))
+        frame = json.loads(consumer.pending['delta'])
+        self.assertEqual(consumer.seq, event['seq'])
+        self.assertEqual(frame['type'], 'snapshot')
+        self.assertEqual(frame['cities']['Delhi']['weather']['temp'], 30)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RuleIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        thresholds._rule_index = None
+
+    def test_rule_saved_and_deleted_in_one_transaction(self):
+        kept = TemperatureThreshold.objects.create(city='Delhi', max_threshold=35)
+        index = thresholds.get_rule_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                rule = TemperatureThreshold.objects.create(city='Delhi', max_threshold=30)
+                rule.delete()
+        self.assertIs(thresholds.get_rule_index(), index)
+        self.assertEqual(set(index.rules), {('temperature', kept.id)})
+        self.assertEqual(index.breached('temperature', 'Delhi', 40), {kept.id})
+
+
+@override_settings(CACHES=LOCAL_CACHE, ALLOWED_HOSTS=['*'])
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        City.objects.create(name='Delhi', latitude=0, longitude=0)
+        for days_ago in range(10):
+            daily_summary('Delhi', timezone.localdate() - timedelta(days=days_ago))
+
+    def test_hosts_are_cached_apart(self):
+        internal = self.client.get('/api/get-rollups/', HTTP_HOST='backend:8000')
+        public = self.client.get('/api/get-rollups/', HTTP_HOST='weather.example.com')
+        self.assertEqual(internal['X-Cache'], 'MISS')
+        self.assertEqual(public['X-Cache'], 'MISS')
+        self.assertTrue(internal.json()['next'].startswith('http://backend:8000/'))
+        self.assertTrue(public.json()['next'].startswith('http://weather.example.com/'))
+        self.assertEqual(self.client.get('/api/get-rollups/', HTTP_HOST='weather.example.com')['X-Cache'], 'HIT')
+
+    def test_lost_version_never_comes_back(self):
+        before = get_version('data')
+        self.assertEqual(self.client.get('/api/get-rollups/')['X-Cache'], 'MISS')
+        cache.delete(version_key('data'))
+        DailySummary.objects.filter(date=timezone.localdate()).update(avg_temp=40)
+        self.assertNotEqual(bump_version('data'), before)
+
+        response = self.client.get('/api/get-rollups/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['results']['Delhi'][0]['avg_temp'], 40)
+
+
+class DailySummaryAccumulatorTests(TestCase):
+    def setUp(self):
+        for name in ('Delhi', 'Mumbai', 'Pune'):
+            City.objects.create(name=name, latitude=0, longitude=0)
+        self.today = timezone.localdate()
+        self.start = timezone.make_aware(datetime.combine(self.today, time(1)))
+
+    def assertMatchesRawData(self, day):
+        expected = {summary.city: summary for summary in compute_daily_summaries(day)}
+        stored = {summary.city: summary for summary in DailySummary.objects.filter(date=day)}
+        self.assertEqual(set(stored), set(expected))
+        for city, summary in expected.items():
+            for field in DAILY_SUMMARY_FIELDS:
+                value, stored_value = getattr(summary, field), getattr(stored[city], field)
+                if isinstance(value, float):
+                    self.assertAlmostEqual(stored_value, value, places=6, msg=f'{city} {field}')
+                else:
+                    self.assertEqual(stored_value, value, msg=f'{city} {field}')
+
+    def test_running_summaries_match_a_rebuild(self):
+        conditions = ['Clear', 'Rain', 'Clouds', 'Rain']
+        # Mumbai is backfilled without accumulators, and Pune only reports from the third cycle on
+        daily_summary('Mumbai', self.today, temp=99)
+        for cycle in range(6):
+            dt = self.start + timedelta(minutes=10 * cycle)
+            cities = ['Delhi', 'Mumbai'] + (['Pune'] if cycle >= 2 else [])
+            ingest_cycle([
+                observation(city, dt, temp=15 + cycle * 1.5 + offset, condition=conditions[(cycle + offset) % 4], humidity=40 + cycle, wind_speed=cycle / 3)
+                for offset, city in enumerate(cities)
+            ])
+            # The same readings again, as the provider returns them until the station reports again
+            ingest_cycle([observation('Delhi', dt, temp=15 + cycle * 1.5, condition=conditions[cycle % 4], humidity=40 + cycle, wind_speed=cycle / 3)])
+            self.assertMatchesRawData(self.today)
+
+        self.assertEqual(DailySummary.objects.get(city='Pune', date=self.today).sample_count, 4)
+
+    def test_late_reading_updates_its_own_day(self):
+        yesterday = self.start - timedelta(days=1)
+        ingest_cycle([observation('Delhi', yesterday, temp=10), observation('Delhi', self.start, temp=20)])
+        ingest_cycle([observation('Delhi', yesterday + timedelta(hours=1), temp=14), observation('Delhi', self.start + timedelta(hours=1), temp=24)])
+        self.assertMatchesRawData(self.today)
+        self.assertMatchesRawData(self.today - timedelta(days=1))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class StreakThresholdTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        thresholds._rule_index = None
+        self.rng = random.Random(5)
+        self.dt = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        self.rules = [
+            TemperatureThreshold.objects.create(city='Delhi', max_threshold=30, consecutive_updates=3),
+            TemperatureThreshold.objects.create(city='Delhi', min_threshold=18, max_threshold=0, consecutive_updates=2),
+            TemperatureThreshold.objects.create(city='Mumbai', min_threshold=20, max_threshold=32, consecutive_updates=2),
+            HumidityThreshold.objects.create(city='Mumbai', max_threshold=70, consecutive_updates=2),
+            WindSpeedThreshold.objects.create(city='Delhi', min_threshold=4, consecutive_updates=3),
+            ConditionThreshold.objects.create(city='Delhi', condition='Rain', consecutive_updates=2),
+            ConditionThreshold.objects.create(city='Mumbai', condition='Clouds', consecutive_updates=1),
+        ]
+
+    def run_cycles(self, count):
+        for _ in range(count):
+            self.dt += timedelta(minutes=10)
+            rows, _ = ingest_weather_data([
+                observation(
+                    city, self.dt, temp=self.rng.uniform(12, 38), condition=self.rng.choice(['Rain', 'Clear', 'Clouds']),
+                    humidity=self.rng.uniform(50, 90), wind_speed=self.rng.uniform(0, 8),
+                )
+                for city in ('Delhi', 'Mumbai') if self.rng.random() < 0.9
+            ])
+            self.assertEqual(check_thresholds(rows), full_scan_alerts())
+
+    def test_streaks_match_the_full_scan(self):
+        self.run_cycles(40)
+
+    def test_edited_and_deleted_rules(self):
+        self.run_cycles(10)
+        with self.captureOnCommitCallbacks(execute=True):
+            rule = self.rules[0]
+            rule.max_threshold, rule.consecutive_updates = 25, 2
+            rule.save()
+            self.rules[3].delete()
+            ConditionThreshold.objects.create(city='Mumbai', condition='Rain', consecutive_updates=2)
+        self.run_cycles(10)
+
+        # Edited again and deleted in one go, as a bulk edit would
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            rule = self.rules[4]
+            rule.min_threshold = 6
+            rule.save()
+            rule.delete()
+            self.rules[2].consecutive_updates = 4
+            self.rules[2].save()
+        self.run_cycles(10)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RollupPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.today = timezone.localdate()
+        for name in ('Delhi', 'Mumbai', 'Pune'):
+            City.objects.create(name=name, latitude=0, longitude=0)
+            for days_ago in range(7):
+                daily_summary(name, self.today - timedelta(days=days_ago))
+        # Summaries of a city no longer tracked are never listed
+        daily_summary('Gone', self.today)
+        self.expected = [
+            (str(self.today - timedelta(days=days_ago)), name)
+            for days_ago in range(7) for name in ('Delhi', 'Mumbai', 'Pune')
+        ]
+
+    def rows(self, body):
+        # Newest day first, then by city
+        rows = sorted((summary['date'], city) for city, summaries in body['results'].items() for summary in summaries)
+        return sorted(rows, key=lambda row: row[0], reverse=True)
+
+    def test_forward_and_backward_cover_every_row_once(self):
+        pages, url = [], '/api/get-rollups/?page_size=4'
+        while url:
+            body = self.client.get(url).json()
+            pages.append(self.rows(body))
+            url = body['next']
+        self.assertEqual([row for page in pages for row in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 4, 4, 1])
+
+        # And back again from the last page, through the previous links
+        backwards, url = [pages[-1]], body['previous']
+        while url:
+            body = self.client.get(url).json()
+            backwards.insert(0, self.rows(body))
+            url = body['previous']
+        self.assertEqual(backwards, pages)
+
+    def test_date_range_and_cities(self):
+        start = self.today - timedelta(days=3)
+        rows, url = [], f'/api/get-rollups/?page_size=2&city=Mumbai,Pune&start_date={start}&end_date={self.today - timedelta(days=1)}'
+        while url:
+            body = self.client.get(url).json()
+            rows += self.rows(body)
+            url = body['next']
+        self.assertEqual(rows, [row for row in self.expected if row[1] != 'Delhi' and str(start) <= row[0] < str(self.today)])
+
+    def test_bad_cursor(self):
+        missing_city = base64.urlsafe_b64encode(json.dumps({'d': str(self.today), 'r': False}).encode()).decode()
+        for cursor in ('not-a-cursor', missing_city):
+            response = self.client.get('/api/get-rollups/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+
+@skipIf(fakeredis is None, 'needs fakeredis: pip install fakeredis[lua]')
+@override_settings(CACHES=LOCAL_CACHE, NOTIFICATION_STREAM_LENGTH=50, NOTIFICATION_REPLAY_LIMIT=10)
+class ResumeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('windflow.stream.stream_client', return_value=fakeredis.FakeRedis(decode_responses=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = timezone.now().replace(microsecond=0)
+        for name in ('Delhi', 'Mumbai'):
+            City.objects.create(name=name, latitude=0, longitude=0)
+        self.cycles = [self.broadcast(cycle) for cycle in range(5)]
+
+    def broadcast(self, cycle):
+        data = ingest_cycle([observation('Delhi', self.now + timedelta(minutes=cycle), temp=20 + cycle)])
+        return dict(cycle_frames(data))
+
+    def consumer(self, protocol, subscriptions=('*',)):
+        consumer = NotificationConsumer()
+        consumer.pending, consumer.replies, consumer.behind_since, consumer.wakeup = OrderedDict(), 0, None, asyncio.Event()
+        consumer.protocol, consumer.seq, consumer.replayed_to = protocol, None, None
+        consumer.subscriptions = set(subscriptions)
+        return consumer
+
+    def pending_frames(self, consumer):
+        return [json.loads(text) for text in consumer.pending.values()]
+
+    def test_missed_deltas_are_replayed(self):
+        consumer = self.consumer('delta')
+        last_seq = self.cycles[1][DELTA_GROUP]['seq']
+        asyncio.run(consumer.resume(last_seq))
+
+        # Queued deltas are folded into one frame, which carries every missed change
+        frame, = self.pending_frames(consumer)
+        self.assertEqual(frame['type'], 'delta')
+        self.assertEqual(frame['prev_seq'], last_seq)
+        self.assertEqual(frame['seq'], self.cycles[-1][DELTA_GROUP]['seq'])
+        self.assertEqual(frame['cities']['Delhi']['weather']['temp'], 24)
+        self.assertEqual(consumer.seq, frame['seq'])
+
+        # The live copy of the last replayed cycle is not sent twice, the next one is
+        consumer.pending.clear()
+        asyncio.run(consumer.forward(self.cycles[-1][DELTA_GROUP]))
+        self.assertEqual(consumer.pending, {})
+        live = self.broadcast(5)[DELTA_GROUP]
+        asyncio.run(consumer.forward(live))
+        self.assertEqual(consumer.seq, live['seq'])
+        self.assertEqual(self.pending_frames(consumer)[0]['type'], 'delta')
+
+    def test_full_and_city_clients_get_what_they_missed(self):
+        last_seq = self.cycles[2][ALL_GROUP]['seq']
+        consumer = self.consumer('full')
+        asyncio.run(consumer.resume(last_seq))
+        self.assertEqual([frame['type'] for frame in self.pending_frames(consumer)], ['weather'])
+        self.assertEqual(self.pending_frames(consumer)[0]['seq'], self.cycles[-1][ALL_GROUP]['seq'])
+
+        consumer = self.consumer('full', [('weather', 'Delhi')])
+        asyncio.run(consumer.resume(last_seq))
+        frame, = self.pending_frames(consumer)
+        self.assertEqual((frame['type'], frame['city'], frame['message']['temp']), ('city_update', 'Delhi', 24))
+
+    def test_too_far_behind_gets_a_snapshot(self):
+        for cycle in range(5, 15):
+            self.broadcast(cycle)
+        consumer = self.consumer('delta')
+        asyncio.run(consumer.resume(self.cycles[1][DELTA_GROUP]['seq']))
+        frame, = self.pending_frames(consumer)
+        self.assertEqual(frame['type'], 'snapshot')
+        self.assertEqual(frame['cities']['Delhi']['weather']['temp'], 34)
@@ -0,0 +1,278 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from django.db.models import Q
+from .cache import get_version, bump_version
+from .models import WeatherData, ThresholdState, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+
+# threshold type -> (model, observed field, alert type)
+THRESHOLD_TYPES = {
+    'temperature': (TemperatureThreshold, 'temp', 'Temperature'),
+    'humidity': (HumidityThreshold, 'humidity', 'Temperature'),
+    'wind_speed': (WindSpeedThreshold, 'wind_speed', 'Wind Speed'),
+    'condition': (ConditionThreshold, 'dominant_condition', 'Condition'),
+}
+THRESHOLD_ORDER = {threshold_type: index for index, threshold_type in enumerate(THRESHOLD_TYPES)}
+
+STATE_FIELDS = ['city', 'signature', 'min_streak', 'min_values', 'max_streak', 'max_values', 'match_streak', 'last_dt', 'alert']
+
+_rule_index = None
+_rule_index_version = None
+_rule_index_lock = threading.Lock()
+
+
+class RuleIndex:
+    # Threshold rules compiled per city and metric. Min and max bounds are kept in sorted
+    # (bound, rule id) arrays, so the rules a reading breaches are found by binary search
+    def __init__(self):
+        self.rules = {}
+        self.min_bounds = defaultdict(list)
+        self.max_bounds = defaultdict(list)
+        self.conditions = defaultdict(set)
+        self.unseeded = set()
+
+    def add(self, threshold_type, rule):
+        self.rules[(threshold_type, rule.id)] = rule
+        if not rule.consecutive_updates or rule.consecutive_updates < 1:
+            return
+        if threshold_type == 'condition':
+            self.conditions[(rule.city, rule.condition)].add(rule.id)
+            return
+        # Unset and zero bounds are both ignored, as they always have been
+        if rule.min_threshold:
+            insort(self.min_bounds[(rule.city, threshold_type)], (rule.min_threshold, rule.id))
+        if rule.max_threshold:
+            insort(self.max_bounds[(rule.city, threshold_type)], (rule.max_threshold, rule.id))
+
+    def remove(self, threshold_type, rule_id):
+        self.unseeded.discard((threshold_type, rule_id))
+        rule = self.rules.pop((threshold_type, rule_id), None)
+        if rule is None:
+            return
+        if threshold_type == 'condition':
+            self.conditions[(rule.city, rule.condition)].discard(rule_id)
+            return
+        for bounds, bound in ((self.min_bounds, rule.min_threshold), (self.max_bounds, rule.max_threshold)):
+            if not bound:
+                continue
+            entries = bounds[(rule.city, threshold_type)]
+            position = bisect_left(entries, (bound, rule_id))
+            if position < len(entries) and entries[position] == (bound, rule_id):
+                del entries[position]
+
+    def breached(self, threshold_type, city, value):
+        if threshold_type == 'condition':
+            return self.conditions.get((city, value), set())
+        # value < min for every bound above the value, value > max for every bound below it
+        mins = self.min_bounds.get((city, threshold_type), [])
+        maxs = self.max_bounds.get((city, threshold_type), [])
+        return (
+            {rule_id for _, rule_id in mins[bisect_right(mins, (value, float('inf'))):]}
+            | {rule_id for _, rule_id in maxs[:bisect_left(maxs, (value, float('-inf')))]}
+        )
+
+
+
+def rule_signature(threshold_type, rule):
+    if threshold_type == 'condition':
+        return f"{rule.city}|{rule.condition}|{rule.consecutive_updates}"
+    return f"{rule.city}|{rule.min_threshold}|{rule.max_threshold}|{rule.consecutive_updates}"
+
+def reset_state(state, threshold_type, rule):
+    state.city = rule.city
+    state.signature = rule_signature(threshold_type, rule)
+    state.min_streak = 0
+    state.min_values = []
+    state.max_streak = 0
+    state.max_values = []
+    state.match_streak = 0
+    state.last_dt = None
+    state.alert = None
+    return state
+
+def fold_value(state, threshold_type, rule, value):
+    # Streaks are capped at the rule's window: reaching it is all an alert needs to know
+    window = rule.consecutive_updates
+    if threshold_type == 'condition':
+        state.match_streak = min(state.match_streak + 1, window) if value == rule.condition else 0
+        return
+
+    # Unset and zero bounds are both ignored, as they always have been
+    bounds = (
+        ('min', rule.min_threshold, lambda bound: value < bound),
+        ('max', rule.max_threshold, lambda bound: value > bound),
+    )
+    for side, bound, breached in bounds:
+        if bound and breached(bound):
+            setattr(state, f'{side}_streak', min(getattr(state, f'{side}_streak') + 1, window))
+            setattr(state, f'{side}_values', (getattr(state, f'{side}_values') + [value])[-window:])
+        else:
+            setattr(state, f'{side}_streak', 0)
+            setattr(state, f'{side}_values', [])
+
+def build_alert(threshold_type, rule, state):
+    window = rule.consecutive_updates
+    alert_type = THRESHOLD_TYPES[threshold_type][2]
+
+    if threshold_type == 'condition':
+        if state.match_streak < window:
+            return None
+        return {
+            'type': alert_type,
+            'city': rule.city,
+            'threshold': rule.condition,
+            'consecutive_updates': window
+        }
+
+    min_breached = state.min_streak >= window
+    max_breached = state.max_streak >= window
+    if not (min_breached or max_breached):
+        return None
+
+    values = state.min_values if min_breached else state.max_values
+    threshold_value = rule.min_threshold if min_breached else rule.max_threshold
+    return {
+        'type': alert_type,
+        'city': rule.city,
+        'breach': 'below' if min_breached else 'above',
+        'threshold': threshold_value,
+        'consecutive_updates': window,
+        # Summed newest first, the order the readings were always averaged in
+        'difference': abs(sum(reversed(values)) / len(values) - threshold_value)
+    }
+
+def seed_state(state, threshold_type, rule):
+    # Replays the rule's window from stored history; only needed for new or changed rules
+    reset_state(state, threshold_type, rule)
+    if not rule.consecutive_updates or rule.consecutive_updates < 1:
+        return state
+
+    field = THRESHOLD_TYPES[threshold_type][1]
+    recent_data = list(
+        WeatherData.objects.filter(city=rule.city).order_by('-dt').values_list('dt', field)[:rule.consecutive_updates]
+    )
+    for _, value in reversed(recent_data):
+        fold_value(state, threshold_type, rule, value)
+    if recent_data:
+        state.last_dt = recent_data[0][0]
+    state.alert = build_alert(threshold_type, rule, state)
+    return state
+
+def build_rule_index():
+    index = RuleIndex()
+    for threshold_type, (model, _, _) in THRESHOLD_TYPES.items():
+        evaluated = set(ThresholdState.objects.filter(threshold_type=threshold_type).values_list('threshold_id', flat=True))
+        for rule in model.objects.all():
+            index.add(threshold_type, rule)
+            if rule.id not in evaluated:
+                index.unseeded.add((threshold_type, rule.id))
+    return index
+
+def get_rule_index():
+    # Rebuilt whenever another process changed the rules since this one compiled them
+    global _rule_index, _rule_index_version
+    version = get_version('thresholds')
+    with _rule_index_lock:
+        if _rule_index is None or version is None or version != _rule_index_version:
+            _rule_index = build_rule_index()
+            _rule_index_version = version
+        return _rule_index
+
+def rule_changed(threshold_type, model, rule_id, deleted=False):
+    global _rule_index, _rule_index_version
+    forget_threshold(threshold_type, rule_id)
+    version = bump_version('thresholds')
+
+    with _rule_index_lock:
+        # Patch the local index in place unless another process changed the rules in between
+        if _rule_index is None or version is None or _rule_index_version is None or version != _rule_index_version + 1:
+            _rule_index = None
+            return
+        _rule_index.remove(threshold_type, rule_id)
+        # A rule saved and then deleted in the same transaction is gone by the time this runs
+        rule = None if deleted else model.objects.filter(pk=rule_id).first()
+        if rule is not None:
+            _rule_index.add(threshold_type, rule)
+            _rule_index.unseeded.add((threshold_type, rule.id))
+        _rule_index_version = version
+
+def is_streaking(state):
+    return bool(state.min_streak or state.max_streak or state.match_streak)
+
+def evaluate_thresholds(observations=()):
+    index = get_rule_index()
+    by_city = defaultdict(list)
+    for observation in sorted(observations, key=lambda observation: observation.dt):
+        by_city[observation.city].append(observation)
+
+    # Rules breached by this cycle's readings, looked up in the index
+    breached = set()
+    for city, city_observations in by_city.items():
+        for observation in city_observations:
+            for threshold_type, (_, field, _) in THRESHOLD_TYPES.items():
+                breached.update((threshold_type, rule_id) for rule_id in index.breached(threshold_type, city, getattr(observation, field)))
+
+    # Their states, plus the ongoing streaks of the same cities that a non-breaching reading resets
+    condition = Q(city__in=list(by_city)) & (Q(min_streak__gt=0) | Q(max_streak__gt=0) | Q(match_streak__gt=0))
+    ids_by_type = defaultdict(list)
+    for threshold_type, rule_id in breached | index.unseeded:
+        ids_by_type[threshold_type].append(rule_id)
+    for threshold_type, ids in ids_by_type.items():
+        condition |= Q(threshold_type=threshold_type, threshold_id__in=ids)
+    states = {(state.threshold_type, state.threshold_id): state for state in ThresholdState.objects.filter(condition)}
+
+    updated = {}
+    to_seed = set(index.unseeded) | {key for key in breached if key not in states}
+    for key, state in states.items():
+        rule = index.rules.get(key)
+        if rule is not None and state.signature != rule_signature(key[0], rule):
+            to_seed.add(key)
+    for key in to_seed:
+        rule = index.rules.get(key)
+        if rule is None:
+            continue
+        state = states.get(key) or ThresholdState(threshold_type=key[0], threshold_id=key[1])
+        states[key] = updated[key] = seed_state(state, key[0], rule)
+
+    streaking = defaultdict(set)
+    for key, state in states.items():
+        if key in index.rules and is_streaking(state):
+            streaking[state.city].add(key)
+
+    for city, city_observations in by_city.items():
+        for observation in city_observations:
+            for threshold_type, (_, field, _) in THRESHOLD_TYPES.items():
+                value = getattr(observation, field)
+                keys = {(threshold_type, rule_id) for rule_id in index.breached(threshold_type, city, value)}
+                keys |= {key for key in streaking[city] if key[0] == threshold_type}
+                for key in keys:
+                    rule = index.rules[key]
+                    state = states[key]
+                    if state.last_dt is not None and observation.dt <= state.last_dt:
+                        continue
+                    fold_value(state, threshold_type, rule, value)
+                    state.last_dt = observation.dt
+                    state.alert = build_alert(threshold_type, rule, state)
+                    updated[key] = state
+                    if is_streaking(state):
+                        streaking[city].add(key)
+                    else:
+                        streaking[city].discard(key)
+
+    if updated:
+        ThresholdState.objects.bulk_create(
+            list(updated.values()),
+            update_conflicts=True,
+            unique_fields=['threshold_type', 'threshold_id'],
+            update_fields=STATE_FIELDS,
+        )
+    index.unseeded -= to_seed
+
+    return active_alerts()
+
+def active_alerts():
+    active = ThresholdState.objects.filter(alert__isnull=False).values_list('threshold_type', 'threshold_id', 'alert')
+    return [alert for _, _, alert in sorted(active, key=lambda row: (THRESHOLD_ORDER.get(row[0], len(THRESHOLD_ORDER)), row[1]))]
+
+def forget_threshold(threshold_type, threshold_id):
+    ThresholdState.objects.filter(threshold_type=threshold_type, threshold_id=threshold_id).delete()
@@ -0,0 +1,157 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import connection
+
+_current_span = contextvars.ContextVar('windflow_span', default=None)
+_export_lock = threading.Lock()
+
+
+class Trace:
+    # One task's share of a fetch cycle. The tasks of a fanned out cycle share the trace id
+    def __init__(self, trace_id):
+        self.id = trace_id or uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+class Span:
+    def __init__(self, name, trace, parent, attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.duration = None
+        self.queries = None
+
+    @property
+    def trace_id(self):
+        return self.trace.id
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, amount):
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def measure(self, name, payload):
+        # Size of a payload as JSON, only worked out when tracing
+        self.attributes[name] = len(json.dumps(payload, default=str))
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace.id,
+            'span_id': self.id,
+            'parent_id': self.parent.id if self.parent else None,
+            'name': self.name,
+            'started_at': datetime.fromtimestamp(self.started_at, tz=dt_timezone.utc).isoformat(),
+            'duration_ms': round(self.duration * 1000, 3),
+            'queries': self.queries,
+            **self.attributes,
+        }
+
+
+class NoSpan:
+    # Stands in for a span when nothing is being traced
+    id = None
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, amount):
+        pass
+
+    def measure(self, name, payload):
+        pass
+
+NO_SPAN = NoSpan()
+
+
+def current_span():
+    return _current_span.get() or NO_SPAN
+
+@contextmanager
+def open_span(name, trace, parent, attributes):
+    span = Span(name, trace, parent, attributes)
+    token = _current_span.set(span)
+    queries = trace.queries
+    started = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span.set(error=str(e))
+        raise
+    finally:
+        span.duration = time.perf_counter() - started
+        span.queries = trace.queries - queries
+        _current_span.reset(token)
+        with trace.lock:
+            trace.spans.append(span)
+
+@contextmanager
+def span(name, **attributes):
+    # A timed step inside whatever is being traced; does nothing outside a trace
+    parent = _current_span.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+    with open_span(name, parent.trace, parent, attributes) as child:
+        yield child
+
+@contextmanager
+def trace(name, trace_id=None, **attributes):
+    # Root span of a task: counts the queries of this thread's connection and exports
+    # every span of the task when it ends. Inside another trace it is just a span
+    if _current_span.get() is not None:
+        with span(name, **attributes) as child:
+            yield child
+        return
+    if not settings.WEATHER_TRACE_FILE:
+        yield NO_SPAN
+        return
+
+    current = Trace(trace_id)
+    try:
+        with connection.execute_wrapper(current.count_query), open_span(name, current, None, attributes) as root:
+            yield root
+    finally:
+        export(current)
+
+def export(trace):
+    # Every span of the task as one JSON line each, written in a single append
+    lines = ''.join(json.dumps(span.as_dict(), default=str) + '\n' for span in sorted(trace.spans, key=lambda span: span.started_at))
+    path = settings.WEATHER_TRACE_FILE
+    try:
+        with _export_lock:
+            if os.path.exists(path) and os.path.getsize(path) > settings.WEATHER_TRACE_MAX_BYTES:
+                os.replace(path, f'{path}.1')
+            with open(path, 'a') as trace_file:
+                trace_file.write(lines)
+    except OSError as e:
+        print(f"Could not export trace {trace.id}: {e}")
+
+def read_spans(path, cycles):
+    # Spans of the last `cycles` traces in the file, oldest first
+    traces = {}
+    with open(path) as trace_file:
+        for line in trace_file:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            traces.setdefault(span['trace_id'], []).append(span)
+    return [span for spans in list(traces.values())[-cycles:] for span in spans]
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import get_rollups, get_current_weather, get_cities, get_interval, set_interval, check_connection_status, get_thresholds, set_thresholds, delete_threshold
+from .views import get_rollups, get_current_weather, get_cities, get_interval, set_interval, check_connection_status, get_thresholds, set_thresholds, delete_threshold, get_cache_stats, get_notification_stats, get_rate_limit_stats
 
 urlpatterns = [
     path('get-rollups/', get_rollups),
@@ -10,5 +10,8 @@ urlpatterns = [
     path('set-interval/', set_interval),
     path('get-thresholds/', get_thresholds),
     path('set-thresholds/', set_thresholds),
-    path('delete-threshold/', delete_threshold)
+    path('delete-threshold/', delete_threshold),
+    path('cache-stats/', get_cache_stats),
+    path('notification-stats/', get_notification_stats),
+    path('rate-limit-stats/', get_rate_limit_stats)
 ]
\ No newline at end of file
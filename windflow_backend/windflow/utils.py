@@ -1,207 +1,351 @@
-import os
+import io
+import time
+import csv
+import threading
+import contextvars
 import requests
-from datetime import datetime
-from collections import Counter
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Avg, Max, Min
-from .models import WeatherData, City, DailySummary, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
-from .serializers import DailySummarySerializer, WeatherDataSerializer
+from django.db import connection, transaction
+from django.db.models import Max, Min, Sum, Count
+from .models import WeatherData, LatestWeatherData, City, DailySummary
+from .serializers import DailySummarySerializer
+from .thresholds import evaluate_thresholds
+from .health import load_health, plan_calls, settle_cycle
+from .ratelimit import TokenBucket, wait_until
+from .providers import get_provider
+from .tracing import span
+from .metrics import provider_call_duration
 
-def kelvin_to_celsius(kelvin):
-    return kelvin - 273.15
+SUMMARY_METRICS = ['temp', 'feels_like', 'humidity', 'wind_speed', 'wind_deg', 'clouds']
+SUMMARY_EXTREMA_METRICS = ['temp', 'feels_like']
+# Running totals the averages are derived from, kept up to date as observations come in
+DAILY_SUMMARY_ACCUMULATOR_FIELDS = ['sample_count', 'condition_counts'] + [f'sum_{metric}' for metric in SUMMARY_METRICS]
+DAILY_SUMMARY_FIELDS = (
+    [f'avg_{metric}' for metric in SUMMARY_METRICS]
+    + [f'{bound}_{metric}' for metric in SUMMARY_EXTREMA_METRICS for bound in ('max', 'min')]
+    + ['dominant_condition']
+    + DAILY_SUMMARY_ACCUMULATOR_FIELDS
+)
 
-def fetch_weather_data():
-    api_key = os.getenv('OPENWEATHERMAP_API_KEY')
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
-    
-    cities = City.objects.all()
-    new_data = []
+WEATHER_DATA_COLUMNS = ['city', 'dominant_condition', 'temp', 'feels_like', 'dt', 'humidity', 'wind_speed', 'wind_deg', 'clouds']
 
-    for city in cities:
-        params = {
-            'lat': city.latitude,
-            'lon': city.longitude,
-            'appid': api_key
-        }
-        response = requests.get(base_url, params=params)
-        data = response.json()
-        
-        try:
-            response.raise_for_status()
-            weather_data = WeatherData(
-            city=city.name,
-            dominant_condition=data['weather'][0]['main'],
-            temp=kelvin_to_celsius(data['main']['temp']),
-            feels_like=kelvin_to_celsius(data['main']['feels_like']),
-            dt=timezone.make_aware(datetime.fromtimestamp(data['dt']), timezone.get_current_timezone()),
-            humidity=data['main']['humidity'],
-            wind_speed=data['wind']['speed'],
-            wind_deg=data['wind']['deg'],
-            clouds=data['clouds']['all']
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    # One keep-alive session per process, with enough pooled connections for every fetch worker
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.WEATHER_FETCH_CONCURRENCY)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _http_session = session
+    return _http_session
+
+def provider_rate_limiter(provider=None):
+    provider = provider or get_provider()
+    per_minute = settings.WEATHER_RATE_LIMIT_PER_MINUTE if provider.rate_limited else 0
+    return TokenBucket(provider.name, per_minute, settings.WEATHER_RATE_LIMIT_BURST)
+
+def batched(names, size):
+    return [names[start:start + size] for start in range(0, len(names), size)]
+
+def fetch_batch_at(started, wait, provider, session, cities):
+    # Holds the call back until its turn under the provider quota
+    wait_until(started, wait)
+    with span('provider_call', city=cities[0].name if len(cities) == 1 else None, cities=len(cities), wait=round(wait, 3)), \
+            provider_call_duration.labels(provider.name).time():
+        return provider.fetch_current(session, cities)
+
+def copy_weather_data(rows):
+    # Postgres only: stream the rows through COPY into a staging table, then move them with one INSERT
+    table = WeatherData._meta.db_table
+    columns = ', '.join(WEATHER_DATA_COLUMNS)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row.dt.isoformat() if column == 'dt' else getattr(row, column) for column in WEATHER_DATA_COLUMNS])
+    buffer.seek(0)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE weatherdata_staging ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA")
+        cursor.copy_expert(f"COPY weatherdata_staging ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM weatherdata_staging RETURNING id, city, dt")
+        ids = {(city, dt): pk for pk, city, dt in cursor.fetchall()}
+        cursor.execute("DROP TABLE weatherdata_staging")
+
+    for row in rows:
+        row.id = ids[(row.city, row.dt)]
+    return rows
+
+def update_latest_weather(rows):
+    # Keeps each city's newest observation; an older reading arriving late never replaces a newer one
+    newest = {}
+    for row in rows:
+        if row.city not in newest or row.dt > newest[row.city].dt:
+            newest[row.city] = row
+    if not newest:
+        return
+
+    fields = [column for column in WEATHER_DATA_COLUMNS if column != 'city']
+    if connection.vendor == 'postgresql':
+        table = LatestWeatherData._meta.db_table
+        columns = ', '.join(['city', 'weather_data_id'] + fields)
+        placeholders = ', '.join(['(' + ', '.join(['%s'] * (len(fields) + 2)) + ')'] * len(newest))
+        updates = ', '.join(f"{field} = EXCLUDED.{field}" for field in ['weather_data_id'] + fields)
+        params = [value for row in newest.values() for value in [row.city, row.id] + [getattr(row, field) for field in fields]]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) VALUES {placeholders} "
+                f"ON CONFLICT (city) DO UPDATE SET {updates} WHERE {table}.dt < EXCLUDED.dt",
+                params,
             )
-            weather_data.save()
-            new_data.append(WeatherDataSerializer(weather_data).data)
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred for {city.name}: {http_err}")
-        except Exception as err:
-            print(f"An error occurred for {city.name}: {err}")
-    
-    if new_data:
-        return new_data
-
-def update_daily_summary_for_today():
-    today = timezone.now().date()
-    cities = City.objects.all()
+        return
 
-    updated_data = {}
-
-    for city in cities:
-        city_data = WeatherData.objects.filter(city=city, dt__date=today)
-        try:
-            if city_data.exists():
-                weather_data = {
-                    'avg_temp' : city_data.aggregate(Avg('temp'))['temp__avg'],
-                    'max_temp' : city_data.aggregate(Max('temp'))['temp__max'],
-                    'min_temp' : city_data.aggregate(Min('temp'))['temp__min'],
-                    'avg_feels_like' : city_data.aggregate(Avg('feels_like'))['feels_like__avg'],
-                    'max_feels_like' : city_data.aggregate(Max('feels_like'))['feels_like__max'],
-                    'min_feels_like' : city_data.aggregate(Min('feels_like'))['feels_like__min'],
-                    'avg_humidity' : city_data.aggregate(Avg('humidity'))['humidity__avg'],
-                    'avg_wind_speed' : city_data.aggregate(Avg('wind_speed'))['wind_speed__avg'],
-                    'avg_wind_deg' : city_data.aggregate(Avg('wind_deg'))['wind_deg__avg'],
-                    'avg_clouds' : city_data.aggregate(Avg('clouds'))['clouds__avg'],
-                    'dominant_condition' : Counter(city_data.values_list('dominant_condition', flat=True)).most_common(3)[0][0]
-                }
-                summary, _ = DailySummary.objects.update_or_create(
-                    city=city,
-                    date=today,
-                    defaults=weather_data
-                )
-
-                updated_data[city.name] = DailySummarySerializer(summary).data
-
-        except Exception as e:
-            print(f"An error occurred while updating summary for {city} on {today}: {e}")
-            return None
-
-    return updated_data
-
-def check_thresholds():
-    alerts = []
-
-    # Check temperature thresholds
-    temp_thresholds = TemperatureThreshold.objects.all()
-    for threshold in temp_thresholds:
-        recent_data = WeatherData.objects.filter(city=threshold.city).order_by('-dt')[:threshold.consecutive_updates]
-        if not threshold.consecutive_updates or recent_data.count() < threshold.consecutive_updates:
-            continue
+    with transaction.atomic():
+        current = dict(LatestWeatherData.objects.select_for_update().filter(city__in=newest).values_list('city', 'dt'))
+        LatestWeatherData.objects.bulk_create(
+            [
+                LatestWeatherData(city=city, weather_data_id=row.id, **{field: getattr(row, field) for field in fields})
+                for city, row in newest.items()
+                if city not in current or current[city] < row.dt
+            ],
+            update_conflicts=True,
+            unique_fields=['city'],
+            update_fields=['weather_data_id'] + fields,
+        )
 
-        temperatures = [data.temp for data in recent_data]
+def ingest_weather_data(observations):
+    report = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    if not observations:
+        return [], report
 
-        if threshold.min_threshold:
-            min_breached = all(temp < threshold.min_threshold for temp in temperatures)
-        else:
-            min_breached = False
-        if threshold.max_threshold:
-            max_breached = all(temp > threshold.max_threshold for temp in temperatures)
-        else:
-            max_breached = False
-
-        if min_breached or max_breached:
-            breach = 'below' if min_breached else 'above'
-            threshold_value = threshold.min_threshold if min_breached else threshold.max_threshold
-            average_temp = sum(temperatures) / len(temperatures)
-            difference = abs(average_temp - threshold_value)
-
-            alerts.append({
-                'type': 'Temperature',
-                'city': threshold.city,
-                'breach': breach,
-                'threshold': threshold_value,
-                'consecutive_updates': threshold.consecutive_updates,
-                'difference': difference
-            })
-
-    # Check humidity thresholds
-    humidity_thresholds = HumidityThreshold.objects.all()
-    for threshold in humidity_thresholds:
-        recent_data = WeatherData.objects.filter(city=threshold.city).order_by('-dt')[:threshold.consecutive_updates]
-        if not threshold.consecutive_updates or recent_data.count() < threshold.consecutive_updates:
+    # The provider keeps returning the same reading until the station reports again, so drop what is already stored
+    existing = set(
+        WeatherData.objects.filter(
+            city__in={observation.city for observation in observations},
+            dt__in={observation.dt for observation in observations},
+        ).values_list('city', 'dt')
+    )
+    rows = []
+    for observation in observations:
+        key = (observation.city, observation.dt)
+        if key in existing:
+            report['skipped'] += 1
             continue
-        humidity = [data.humidity for data in recent_data]
+        existing.add(key)
+        rows.append(observation)
 
-        if threshold.min_threshold:
-            min_breached = all(data.humidity < threshold.min_threshold for data in recent_data)
-        else:
-            min_breached = False
-        if threshold.max_threshold:
-            max_breached = all(data.humidity > threshold.max_threshold for data in recent_data)
-        else:
-            max_breached = False
-
-        if min_breached or max_breached:
-            breach = 'below' if min_breached else 'above'
-            threshold_value = threshold.min_threshold if min_breached else threshold.max_threshold
-            average_humidity = sum(humidity) / len(humidity)
-            difference = abs(average_humidity - threshold_value)
-
-            alerts.append({
-                'type': 'Temperature',
-                'city': threshold.city,
-                'breach': breach,
-                'threshold': threshold_value,
-                'consecutive_updates': threshold.consecutive_updates,
-                'difference': difference
-            })
-
-    # Check wind speed thresholds
-    wind_speed_thresholds = WindSpeedThreshold.objects.all()
-    for threshold in wind_speed_thresholds:
-        recent_data = WeatherData.objects.filter(city=threshold.city).order_by('-dt')[:threshold.consecutive_updates]
-        if not threshold.consecutive_updates or recent_data.count() < threshold.consecutive_updates:
-            continue
+    if not rows:
+        return [], report
 
-        wind_speed = [data.wind_speed for data in recent_data]
-        if threshold.min_threshold:
-            min_breached = all(data.wind_speed < threshold.min_threshold for data in recent_data)
-        else:
-            min_breached = False
-        if threshold.max_threshold:
-            max_breached = all(data.wind_speed > threshold.max_threshold for data in recent_data)
-        else:
-            max_breached = False
-
-        if min_breached or max_breached:
-            breach = 'below' if min_breached else 'above'
-            threshold_value = threshold.min_threshold if min_breached else threshold.max_threshold
-            average_wind_speed = sum(wind_speed) / len(wind_speed)
-            difference = abs(average_wind_speed - threshold_value)
-
-            alerts.append({
-                'type': 'Wind Speed',
-                'city': threshold.city,
-                'breach': breach,
-                'threshold': threshold_value,
-                'consecutive_updates': threshold.consecutive_updates,
-                'difference': difference
-            })
-
-    # Check condition thresholds
-    condition_thresholds = ConditionThreshold.objects.all()
-    for threshold in condition_thresholds:
-        recent_data = WeatherData.objects.filter(city=threshold.city).order_by('-dt')[:threshold.consecutive_updates]
-        if not threshold.consecutive_updates or recent_data.count() < threshold.consecutive_updates:
-            continue
+    try:
+        # The observations and the latest-observation snapshot are written together
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                rows = copy_weather_data(rows)
+            else:
+                rows = WeatherData.objects.bulk_create(rows)
+            update_latest_weather(rows)
+    except Exception as err:
+        print(f"An error occurred while storing weather data: {err}")
+        report['failed'] += len(rows)
+        return [], report
+
+    report['inserted'] = len(rows)
+    return rows, report
+
+def fetch_weather_data(city_names=None, provider_wide=True):
+    # Fetches every city, or only city_names when called for one shard of a cycle
+    provider = get_provider()
+    cities = City.objects.all()
+    if city_names is not None:
+        cities = cities.filter(name__in=city_names)
+    cities = {city.name: city for city in cities}
+    observations = []
+    failed = 0
+    if not cities:
+        return [], {'inserted': 0, 'skipped': 0, 'failed': 0, 'fetched': 0, 'short_circuited': 0, 'deferred': 0, 'error': None}
 
-        condition_breached = all(data.dominant_condition == threshold.condition for data in recent_data)
-        if condition_breached:
-            alerts.append(
-                {
-                    'type': 'Condition',
-                    'city': threshold.city,
-                    'threshold': threshold.condition,
-                    'consecutive_updates': threshold.consecutive_updates
-                }
+    # Cities behind an open circuit breaker are not called until their backoff runs out
+    now = timezone.now()
+    with span('plan', cities=len(cities)) as planning:
+        health = load_health(provider.name, list(cities))
+        calls, short_circuited = plan_calls(health, list(cities), now)
+        results = {}
+
+        # Calls, of up to batch_size cities each, are spread out under the provider quota shared by every
+        # worker. Those that would wait too long are left for the next cycle, the cities that went longest
+        # without data first
+        started = time.monotonic()
+        batches = batched(calls, provider.batch_size)
+        waits = provider_rate_limiter(provider).reserve(len(batches))
+        deferred = []
+        if len(waits) < len(batches):
+            calls.sort(key=lambda name: (health[name].last_success is not None, health[name].last_success or now))
+            batches = batched(calls, provider.batch_size)
+            deferred = [name for batch in batches[len(waits):] for name in batch]
+            batches = batches[:len(waits)]
+        planning.set(calls=len(batches), short_circuited=len(short_circuited), deferred=len(deferred))
+
+    session = get_http_session()
+    max_workers = max(1, min(settings.WEATHER_FETCH_CONCURRENCY, len(batches)))
+
+    # Provider calls run concurrently; the database is only touched from this thread, once per cycle
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            # Each call runs in a copy of this context, so its span lands in the current trace
+            (batch, executor.submit(contextvars.copy_context().run, fetch_batch_at, started, wait, provider, session, [cities[name] for name in batch]))
+            for batch, wait in zip(batches, waits)
+        ]
+
+        for batch, future in futures:
+            fetched, error = {}, None
+            described = batch[0] if len(batch) == 1 else f"{len(batch)} cities from {batch[0]}"
+            try:
+                fetched = {observation.city: observation for observation in future.result()}
+            except requests.exceptions.HTTPError as http_err:
+                error = http_err
+                print(f"HTTP error occurred for {described}: {http_err}")
+            except Exception as err:
+                error = err
+                print(f"An error occurred for {described}: {err}")
+
+            for name in batch:
+                if name in fetched:
+                    observations.append(fetched[name])
+                    results[name] = None
+                else:
+                    failed += 1
+                    results[name] = error or ValueError(f"{provider.name} returned no data for {name}")
+
+    with span('settle_health'):
+        settle_cycle(health, results, short_circuited, now, provider_wide=provider_wide)
+
+    with span('ingest', observations=len(observations)) as ingesting:
+        rows, report = ingest_weather_data(observations)
+        ingesting.set(inserted=report['inserted'], skipped=report['skipped'])
+    report['failed'] += failed
+    report['fetched'] = len(observations)
+    report['short_circuited'] = len(short_circuited)
+    report['deferred'] = len(deferred)
+    report['error'] = next((str(error) for error in results.values() if error is not None), None)
+    return rows, report
+
+def dominant_condition(condition_counts):
+    # Most frequent condition, ties broken alphabetically
+    if not condition_counts:
+        return None
+    return min(condition_counts.items(), key=lambda item: (-item[1], item[0]))[0]
+
+def derive_daily_summary(summary):
+    for metric in SUMMARY_METRICS:
+        setattr(summary, f'avg_{metric}', getattr(summary, f'sum_{metric}') / summary.sample_count)
+    summary.dominant_condition = dominant_condition(summary.condition_counts)
+    return summary
+
+def fold_observation(summary, observation):
+    summary.sample_count += 1
+    for metric in SUMMARY_METRICS:
+        setattr(summary, f'sum_{metric}', getattr(summary, f'sum_{metric}') + getattr(observation, metric))
+    for metric in SUMMARY_EXTREMA_METRICS:
+        value = getattr(observation, metric)
+        setattr(summary, f'max_{metric}', max(getattr(summary, f'max_{metric}'), value))
+        setattr(summary, f'min_{metric}', min(getattr(summary, f'min_{metric}'), value))
+    summary.condition_counts[observation.dominant_condition] = summary.condition_counts.get(observation.dominant_condition, 0) + 1
+
+def compute_daily_summaries(date, cities=None):
+    # Rebuild the summaries of a day from the raw observations: one grouped query for the
+    # metrics and one for the condition counts, whatever the number of cities
+    # The day's bounds in the current timezone, so the dt index is used rather than casting every row to a date
+    start = timezone.make_aware(datetime.combine(date, datetime.min.time()))
+    end = timezone.make_aware(datetime.combine(date + timedelta(days=1), datetime.min.time()))
+    day_data = WeatherData.objects.filter(dt__gte=start, dt__lt=end, city__in=City.objects.values('name'))
+    if cities is not None:
+        day_data = day_data.filter(city__in=cities)
+
+    aggregates = {'sample_count': Count('id')}
+    for metric in SUMMARY_METRICS:
+        aggregates[f'sum_{metric}'] = Sum(metric)
+    for metric in SUMMARY_EXTREMA_METRICS:
+        aggregates[f'max_{metric}'] = Max(metric)
+        aggregates[f'min_{metric}'] = Min(metric)
+
+    condition_counts = defaultdict(dict)
+    for row in day_data.values('city', 'dominant_condition').annotate(occurrences=Count('id')).order_by():
+        condition_counts[row['city']][row['dominant_condition']] = row['occurrences']
+
+    summaries = []
+    for row in day_data.values('city').annotate(**aggregates).order_by('city'):
+        summary = DailySummary(date=date, condition_counts=condition_counts[row['city']], **row)
+        summaries.append(derive_daily_summary(summary))
+    return summaries
+
+def save_daily_summaries(summaries, update_fields=DAILY_SUMMARY_FIELDS):
+    return DailySummary.objects.bulk_create(
+        summaries,
+        update_conflicts=True,
+        unique_fields=['city', 'date'],
+        update_fields=update_fields,
+    )
+
+def apply_observations_to_summaries(observations):
+    by_day = defaultdict(list)
+    for observation in sorted(observations, key=lambda observation: observation.dt):
+        by_day[(observation.city, timezone.localdate(observation.dt))].append(observation)
+    if not by_day:
+        return []
+
+    with transaction.atomic():
+        summaries = {
+            (summary.city, summary.date): summary
+            for summary in DailySummary.objects.select_for_update().filter(
+                city__in={city for city, _ in by_day},
+                date__in={date for _, date in by_day},
             )
+        }
+
+        updated = []
+        to_seed = defaultdict(set)
+        for (city, date), day_observations in by_day.items():
+            summary = summaries.get((city, date))
+            # Days without accumulators yet (new, backfilled or created before they existed)
+            # are seeded from the raw rows, which already include this cycle's observations
+            if summary is None or summary.sample_count == 0:
+                to_seed[date].add(city)
+                continue
+            for observation in day_observations:
+                fold_observation(summary, observation)
+            updated.append(derive_daily_summary(summary))
+
+        for date, cities in to_seed.items():
+            updated.extend(compute_daily_summaries(date, cities))
+
+        updated.sort(key=lambda summary: (summary.date, summary.city))
+        return save_daily_summaries(updated)
+
+def update_daily_summary_for_today(observations=None):
+    today = timezone.localdate()
+
+    try:
+        if observations is None:
+            summaries = save_daily_summaries(compute_daily_summaries(today))
+        else:
+            summaries = apply_observations_to_summaries(observations)
+    except Exception as e:
+        print(f"An error occurred while updating summaries for {today}: {e}")
+        return None
+
+    return {summary.city: DailySummarySerializer(summary).data for summary in summaries}
 
-    return alerts
+def check_thresholds(observations=()):
+    return evaluate_thresholds(observations)
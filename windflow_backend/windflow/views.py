@@ -3,24 +3,47 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from datetime import date as date_cls
 from django_celery_beat.models import PeriodicTask, IntervalSchedule
-from .models import WeatherData, DailySummary, City, ConnectionStatus, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
-from .serializers import WeatherDataSerializer, DailySummarySerializer, CitySerializer, ConnectionStatusSerializer, TemperatureThresholdSerializer, HumidityThresholdSerializer, WindSpeedThresholdSerializer, ConditionThresholdSerializer
-from .tasks import fetch_weather_data_task
+from .models import LatestWeatherData, DailySummary, City, TemperatureThreshold, HumidityThreshold, WindSpeedThreshold, ConditionThreshold
+from .serializers import LatestWeatherDataSerializer, DailySummarySerializer, CitySerializer, TemperatureThresholdSerializer, HumidityThresholdSerializer, WindSpeedThresholdSerializer, ConditionThresholdSerializer
+from .freshness import serve_stale_while_revalidate, data_freshness, forget_connection_status, provider_health
+from .pagination import RollupCursorPagination
+from .cache import cached_response, response_cache_stats, get_versions
+from .consumers import fanout_stats
+from .utils import provider_rate_limiter
+
+ROLLUP_DAYS_PER_PAGE = 6
+
+def requested_cities(request):
+    # ?city=A&city=B or ?city=A,B
+    return [city.strip() for value in request.query_params.getlist('city') for city in value.split(',') if city.strip()]
+
+def latest_weather_for(cities):
+    latest_weather_data = LatestWeatherData.objects.order_by('city')
+    if cities:
+        latest_weather_data = latest_weather_data.filter(city__in=cities)
+    return latest_weather_data
 
 @swagger_auto_schema(
     method='get',
+    manual_parameters=[
+        openapi.Parameter('city', openapi.IN_QUERY, description='Only include these cities (repeatable or comma separated)', type=openapi.TYPE_STRING),
+        openapi.Parameter('start_date', openapi.IN_QUERY, description='First day to include (YYYY-MM-DD)', type=openapi.TYPE_STRING),
+        openapi.Parameter('end_date', openapi.IN_QUERY, description='Last day to include (YYYY-MM-DD)', type=openapi.TYPE_STRING),
+        openapi.Parameter('page_size', openapi.IN_QUERY, description='Number of daily summaries per page, defaults to 6 days for every city', type=openapi.TYPE_INTEGER),
+        openapi.Parameter('cursor', openapi.IN_QUERY, description='Opaque cursor taken from the next or previous link', type=openapi.TYPE_STRING),
+    ],
     responses={
         200: openapi.Response('rollups/aggrigations',
             openapi.Schema(
                 type=openapi.TYPE_OBJECT,
                 properties={
-                    'count': openapi.Schema(type=openapi.TYPE_INTEGER, description='Total number of days'),
                     'next': openapi.Schema(type=openapi.TYPE_STRING, description='URL to the next page of results'),
                     'previous': openapi.Schema(type=openapi.TYPE_STRING, description='URL to the previous page of results'),
                     'results': openapi.Schema(
-                        type=openapi.TYPE_OBJECT, description='Dictionary containing the list of rules for each city',
+                        type=openapi.TYPE_OBJECT, description='Dictionary containing the daily summaries on this page for each city, newest first',
                     )
                 }
             )
@@ -44,22 +67,46 @@ from .tasks import fetch_weather_data_task
     }
 )
 @api_view(['GET'])
+@cached_response('data', 'cities')
 def get_rollups(request):
-    paginator = PageNumberPagination()
-    paginator.page_size = 6
-    cities = City.objects.all()
-    paginated_rollups = {}
     try:
-        for city in cities:
-            rollups = DailySummary.objects.filter(city=city).order_by('-date')
-            serialized_rollups = DailySummarySerializer(rollups, many=True).data
-            paginated_rollups[city.name] = paginator.paginate_queryset(serialized_rollups, request)
+        cities = requested_cities(request)
+        try:
+            start_date = request.query_params.get('start_date')
+            start_date = date_cls.fromisoformat(start_date) if start_date else None
+            end_date = request.query_params.get('end_date')
+            end_date = date_cls.fromisoformat(end_date) if end_date else None
+        except ValueError:
+            return Response(
+                {'error': 'Dates must be in YYYY-MM-DD format'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # The running accumulators are never serialized, so they aren't loaded either
+        rollups = DailySummary.objects.defer(*DailySummarySerializer.Meta.exclude)
+        if cities:
+            rollups = rollups.filter(city__in=cities)
+            city_count = len(set(cities))
+        else:
+            rollups = rollups.filter(city__in=City.objects.values('name'))
+            city_count = City.objects.count()
+        if start_date:
+            rollups = rollups.filter(date__gte=start_date)
+        if end_date:
+            rollups = rollups.filter(date__lte=end_date)
+
+        paginator = RollupCursorPagination(page_size=ROLLUP_DAYS_PER_PAGE * max(city_count, 1))
+        page = paginator.paginate_queryset(rollups, request)
+
+        paginated_rollups = {}
+        for rollup in DailySummarySerializer(page, many=True).data:
+            paginated_rollups.setdefault(rollup['city'], []).append(rollup)
 
         return paginator.get_paginated_response(paginated_rollups)
-    except DailySummary.DoesNotExist as e:
+    except ValidationError as e:
         return Response(
-            {'error':str(e)},
-            status=status.HTTP_404_NOT_FOUND,
+            {'error': e.detail[0] if isinstance(e.detail, list) else str(e.detail)},
+            status=status.HTTP_400_BAD_REQUEST,
         )
     except Exception as e:
         return Response(
@@ -69,10 +116,13 @@ def get_rollups(request):
     
 @swagger_auto_schema(
     method='get',
+    manual_parameters=[
+        openapi.Parameter('city', openapi.IN_QUERY, description='Only include these cities (repeatable or comma separated)', type=openapi.TYPE_STRING),
+    ],
     responses={
         200: openapi.Response('weather data',
             openapi.Schema(
-                type=openapi.TYPE_OBJECT, description='Dictionary containing the list of latest weather data for each city',
+                type=openapi.TYPE_OBJECT, description='Dictionary containing the list of latest weather data for each city. X-Data-Age, X-Data-Stale and X-Data-Refreshing headers describe how fresh it is',
             )
         ),
         400: openapi.Response('Bad Request', 
@@ -83,14 +133,6 @@ def get_rollups(request):
                 }
             )
         ),
-        404: openapi.Response('Not Found', 
-            openapi.Schema(
-                type=openapi.TYPE_OBJECT,
-                properties={
-                    'error': openapi.Schema(type=openapi.TYPE_STRING, description='Error message')
-                }
-            )
-        ),
         500: openapi.Response('Internal server error', 
             openapi.Schema(
                 type=openapi.TYPE_OBJECT,
@@ -102,37 +144,13 @@ def get_rollups(request):
     }
 )
 @api_view(['GET'])
+@serve_stale_while_revalidate
+@cached_response('data')
 def get_current_weather(request):
     try:
-        connection_status = ConnectionStatus.objects.get(pk=1)
-        if connection_status.status == False:
-            fetch_weather_data_task()
-            connection_status = ConnectionStatus.objects.get(pk=1)
-        if connection_status.status == True:
-            latest_weather_data = WeatherData.objects.order_by('city', '-dt').distinct('city')
-
-            if not latest_weather_data.exists():
-                fetch_weather_data_task()
-                connection_status = ConnectionStatus.objects.get(pk=1)
-                if connection_status.status == True:
-                    latest_weather_data = WeatherData.objects.order_by('city', '-dt').distinct('city')
-                else:
-                    return Response(
-                        {'error':f'server is not connected to the weather station {connection_status.status}'},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
-            serialized_weather_data = WeatherDataSerializer(latest_weather_data, many=True)
-            return Response(serialized_weather_data.data, status=status.HTTP_200_OK)
-        else:
-            return Response(
-                {'error':f'server is not connected to the weather station {connection_status.status}'},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-    except ConnectionStatus.DoesNotExist as e:
-        return Response(
-            {'error':str(e)},
-            status=status.HTTP_404_NOT_FOUND,
-        )
+        latest_weather_data = latest_weather_for(requested_cities(request))
+        serialized_weather_data = LatestWeatherDataSerializer(latest_weather_data, many=True)
+        return Response(serialized_weather_data.data, status=status.HTTP_200_OK)
     except Exception as e:
         return Response(
             {'error':str(e)},
@@ -171,6 +189,7 @@ def get_current_weather(request):
     }
 )
 @api_view(['GET'])
+@cached_response('cities')
 def get_cities(request):
     try:
         cities = City.objects.all()
@@ -196,6 +215,11 @@ def get_cities(request):
                 properties={
                     'status': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Connection status'),
                     'last_successful_connection': openapi.Schema(type=openapi.TYPE_STRING, description='Last successful connection time'),
+                    'data_age': openapi.Schema(type=openapi.TYPE_NUMBER, description='Seconds since the weather data was last refreshed'),
+                    'stale': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Whether the stored weather data is out of date'),
+                    'refreshing': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Whether this request queued a background refresh'),
+                    'providers': openapi.Schema(type=openapi.TYPE_OBJECT, description='Circuit breaker state of each weather provider'),
+                    'cities': openapi.Schema(type=openapi.TYPE_OBJECT, description='Circuit breaker state of each city, per provider'),
                 }
             )
         ),
@@ -220,16 +244,16 @@ def get_cities(request):
 @api_view(['GET'])
 def check_connection_status(request):
     try:
-        connection_status = ConnectionStatus.objects.get(pk=1)
-        if connection_status.status == False:
-            fetch_weather_data_task()
-            connection_status = ConnectionStatus.objects.get(pk=1)
-        serialized_connection_status = ConnectionStatusSerializer(connection_status)
-        return Response(serialized_connection_status.data, status=status.HTTP_200_OK)
-    except ConnectionStatus.DoesNotExist as e:
+        freshness = data_freshness()
         return Response(
-            {'error':str(e)},
-            status=status.HTTP_404_NOT_FOUND,
+            {
+                **freshness['status_snapshot'],
+                **provider_health(),
+                'data_age': freshness['data_age'],
+                'stale': freshness['stale'],
+                'refreshing': freshness['refreshing'],
+            },
+            status=status.HTTP_200_OK,
         )
     except Exception as e:
         return Response(
@@ -351,6 +375,8 @@ def set_interval(request):
                 'interval': schedule
             }
         )
+        # Staleness is judged against the fetch interval
+        forget_connection_status()
 
         return Response({'interval': interval_value}, status=status.HTTP_200_OK)
     except ValueError as e:
@@ -382,6 +408,7 @@ def set_interval(request):
     }
 )
 @api_view(['GET'])
+@cached_response('thresholds', 'cities')
 def get_thresholds(request):
     try:
         cities = City.objects.all()
@@ -603,4 +630,106 @@ def delete_threshold(request):
         return Response(
             {'error': str(e)},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-        )
\ No newline at end of file
+        )
+
+@swagger_auto_schema(
+    method='get',
+    responses={
+        200: openapi.Response('response cache statistics',
+            openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'versions': openapi.Schema(type=openapi.TYPE_OBJECT, description='Current version of each cached data set'),
+                    'views': openapi.Schema(type=openapi.TYPE_OBJECT, description='Cache hits, misses and hit ratio for each cached view'),
+                }
+            )
+        ),
+        500: openapi.Response('Internal server error', 
+            openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'error': openapi.Schema(type=openapi.TYPE_STRING, description='Error message')
+                }
+            )
+        )
+    }
+)
+@api_view(['GET'])
+def get_cache_stats(request):
+    try:
+        versions = ['data', 'cities', 'thresholds']
+        return Response(
+            {
+                'versions': dict(zip(versions, get_versions(versions))),
+                'views': response_cache_stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
+    except Exception as e:
+        return Response(
+            {'error': str(e)},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+@swagger_auto_schema(
+    method='get',
+    responses={
+        200: openapi.Response('notification fan-out statistics of this server process',
+            openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'connections': openapi.Schema(type=openapi.TYPE_INTEGER, description='Open WebSocket connections'),
+                    'queued': openapi.Schema(type=openapi.TYPE_INTEGER, description='Frames waiting to be sent across all connections'),
+                    'queue_depth': openapi.Schema(type=openapi.TYPE_INTEGER, description='Frames waiting on the most backed up connection'),
+                    'max_queue_depth': openapi.Schema(type=openapi.TYPE_INTEGER, description='Deepest any connection queue has been'),
+                    'sent': openapi.Schema(type=openapi.TYPE_INTEGER, description='Frames sent'),
+                    'coalesced': openapi.Schema(type=openapi.TYPE_INTEGER, description='Frames merged into or replaced by a newer one before being sent'),
+                    'dropped': openapi.Schema(type=openapi.TYPE_INTEGER, description='Frames dropped because a connection queue was full'),
+                    'slow_disconnects': openapi.Schema(type=openapi.TYPE_INTEGER, description='Clients disconnected for falling behind'),
+                    'send_latency_avg': openapi.Schema(type=openapi.TYPE_NUMBER, description='Average seconds per send'),
+                    'send_latency_max': openapi.Schema(type=openapi.TYPE_NUMBER, description='Slowest send in seconds'),
+                }
+            )
+        ),
+    }
+)
+@api_view(['GET'])
+def get_notification_stats(request):
+    return Response(fanout_stats.report(), status=status.HTTP_200_OK)
+
+@swagger_auto_schema(
+    method='get',
+    responses={
+        200: openapi.Response('weather provider rate limiter statistics, shared by every worker',
+            openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'per_minute': openapi.Schema(type=openapi.TYPE_NUMBER, description='Calls allowed per minute'),
+                    'burst': openapi.Schema(type=openapi.TYPE_INTEGER, description='Calls allowed back to back'),
+                    'tokens': openapi.Schema(type=openapi.TYPE_NUMBER, description='Tokens left when the bucket was last used, negative while calls are queued'),
+                    'calls': openapi.Schema(type=openapi.TYPE_INTEGER, description='Calls let through'),
+                    'throttled_calls': openapi.Schema(type=openapi.TYPE_INTEGER, description='Calls that had to wait for their turn'),
+                    'throttled_seconds': openapi.Schema(type=openapi.TYPE_NUMBER, description='Total time calls were held back'),
+                    'deferred_calls': openapi.Schema(type=openapi.TYPE_INTEGER, description='Calls left for a later fetch cycle'),
+                }
+            )
+        ),
+        500: openapi.Response('Internal server error', 
+            openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'error': openapi.Schema(type=openapi.TYPE_STRING, description='Error message')
+                }
+            )
+        )
+    }
+)
+@api_view(['GET'])
+def get_rate_limit_stats(request):
+    try:
+        return Response(provider_rate_limiter().stats(), status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response(
+            {'error': str(e)},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
@@ -0,0 +1,24 @@
+import sys
+from daphne import server
+from daphne.cli import CommandLineInterface
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+
+
+def accept_permessage_deflate(offers):
+    # Browsers offer permessage-deflate on every WebSocket handshake; accepting it compresses each frame
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+class CompressingWebSocketFactory(server.WebSocketFactory):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setProtocolOptions(perMessageCompressionAccept=accept_permessage_deflate)
+
+
+if __name__ == '__main__':
+    # Daphne with WebSocket compression: its factory is created inside Server.run, so the class is swapped first
+    server.WebSocketFactory = CompressingWebSocketFactory
+    sys.exit(CommandLineInterface.entrypoint())
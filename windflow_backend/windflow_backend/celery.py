@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_shutdown
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'windflow_backend.settings')
 
@@ -8,3 +9,9 @@ app = Celery('windflow_backend')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 app.autodiscover_tasks()
+
+
+@worker_process_shutdown.connect
+def forget_worker_metrics(pid=None, **kwargs):
+    from windflow.metrics import mark_process_dead
+    mark_process_dead(pid)
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -55,8 +56,31 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Per WebSocket connection: how many frames may wait to be sent, how long one send may take,
+# and how long a client may stay behind before it is disconnected (seconds)
+WS_QUEUE_SIZE = int(os.getenv('WS_QUEUE_SIZE', '200'))
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', '5'))
+WS_SLOW_CLIENT_TIMEOUT = float(os.getenv('WS_SLOW_CLIENT_TIMEOUT', '30'))
+
+# Broadcast cycles are kept in a Redis stream so reconnecting clients can catch up on what they missed.
+# Clients further behind than NOTIFICATION_REPLAY_LIMIT cycles get a snapshot instead
+NOTIFICATION_STREAM_URL = os.getenv('NOTIFICATION_STREAM_URL', 'redis://redis:6379/1')
+NOTIFICATION_STREAM_LENGTH = int(os.getenv('NOTIFICATION_STREAM_LENGTH', '1000'))
+NOTIFICATION_REPLAY_LIMIT = int(os.getenv('NOTIFICATION_REPLAY_LIMIT', '100'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://redis:6379/1',
+    },
+}
+
+# Read endpoint responses are cached until the data they were built from changes
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', '3600'))
+
 
 MIDDLEWARE = [
+    'windflow.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -66,6 +90,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'windflow.profiler.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'windflow_backend.urls'
@@ -147,9 +172,53 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+CORS_EXPOSE_HEADERS = ['X-Cache', 'X-Data-Age', 'X-Data-Stale', 'X-Data-Refreshing']
 
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+# Weather provider fetching
+# openweathermap, or synthetic for generated observations that need no network or API key,
+# with a new reading per city every WEATHER_SYNTHETIC_INTERVAL seconds
+WEATHER_PROVIDER = os.getenv('WEATHER_PROVIDER', 'openweathermap')
+WEATHER_SYNTHETIC_INTERVAL = int(os.getenv('WEATHER_SYNTHETIC_INTERVAL', '60'))
+WEATHER_FETCH_CONCURRENCY = int(os.getenv('WEATHER_FETCH_CONCURRENCY', '16'))
+WEATHER_FETCH_TIMEOUT = float(os.getenv('WEATHER_FETCH_TIMEOUT', '10'))
+# Cities per fetch subtask: a cycle over more cities than this is spread across the Celery workers
+WEATHER_FETCH_SHARD_SIZE = int(os.getenv('WEATHER_FETCH_SHARD_SIZE', '100'))
+# Provider quota shared by every worker and command through Redis: calls per minute, how many may go
+# out back to back, and how long (seconds) a fetch cycle waits for its turn before leaving a city to the next one
+WEATHER_RATE_LIMIT_URL = os.getenv('WEATHER_RATE_LIMIT_URL', 'redis://redis:6379/1')
+WEATHER_RATE_LIMIT_PER_MINUTE = float(os.getenv('WEATHER_RATE_LIMIT_PER_MINUTE', '60'))
+WEATHER_RATE_LIMIT_BURST = int(os.getenv('WEATHER_RATE_LIMIT_BURST', '60'))
+WEATHER_RATE_LIMIT_MAX_WAIT = float(os.getenv('WEATHER_RATE_LIMIT_MAX_WAIT', '300'))
+# Data older than this many fetch intervals is served as stale while a background refresh runs,
+# and at most one refresh is queued per cooldown (seconds)
+WEATHER_DATA_STALE_INTERVALS = float(os.getenv('WEATHER_DATA_STALE_INTERVALS', '2'))
+WEATHER_REFRESH_COOLDOWN = int(os.getenv('WEATHER_REFRESH_COOLDOWN', '60'))
+# A city (or the whole provider) is skipped after this many consecutive failures, for a backoff
+# starting at WEATHER_CIRCUIT_BACKOFF_BASE seconds and doubling up to WEATHER_CIRCUIT_BACKOFF_MAX
+WEATHER_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('WEATHER_CIRCUIT_FAILURE_THRESHOLD', '3'))
+WEATHER_CIRCUIT_BACKOFF_BASE = int(os.getenv('WEATHER_CIRCUIT_BACKOFF_BASE', '60'))
+WEATHER_CIRCUIT_BACKOFF_MAX = int(os.getenv('WEATHER_CIRCUIT_BACKOFF_MAX', '3600'))
+# Per-stage timings of each fetch cycle, appended as JSON lines to this file; off while empty.
+# The file is moved aside to <file>.1 once it grows past WEATHER_TRACE_MAX_BYTES
+WEATHER_TRACE_FILE = os.getenv('WEATHER_TRACE_FILE', '')
+WEATHER_TRACE_MAX_BYTES = int(os.getenv('WEATHER_TRACE_MAX_BYTES', str(50 * 1024 * 1024)))
+
+# Sampling profiler, armed per view or task with the profile command: collapsed stacks are written to
+# PROFILER_DIR, sampling every PROFILER_INTERVAL seconds. Processes pick up a change within PROFILER_POLL_SECONDS
+PROFILER_DIR = os.getenv('PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'windflow_profiles'))
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', '0.005'))
+PROFILER_POLL_SECONDS = float(os.getenv('PROFILER_POLL_SECONDS', '5'))
+
+
+# Raw weather data storage
+WEATHER_DATA_RETENTION_DAYS = int(os.getenv('WEATHER_DATA_RETENTION_DAYS', '90'))
+WEATHER_DATA_PARTITION_MONTHS_AHEAD = int(os.getenv('WEATHER_DATA_PARTITION_MONTHS_AHEAD', '3'))
+
+# Cities finished by an interrupted backfill_daily_summary run, kept outside the source tree
+BACKFILL_CHECKPOINT_FILE = os.getenv('BACKFILL_CHECKPOINT_FILE', os.path.join(tempfile.gettempdir(), 'windflow_backfill_daily_summary.checkpoint.json'))
\ No newline at end of file
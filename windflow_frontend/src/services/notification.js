@@ -2,55 +2,99 @@ import { useEffect } from 'react';
 
 const Notifications = ({ handleAlert, handleWeatherUpdate, handleRollups }) => {
   useEffect(() => {
-    const ws = new WebSocket('ws://localhost:8000/ws/notifications/');
-    ws.onopen = () => {
-      console.log('WebSocket connected');
-    };
+    let ws;
+    let lastSeq = null;
+    let reconnectTimer = null;
+    let closed = false;
+
+    const connect = () => {
+      // After a reconnect the server replays what was missed since lastSeq
+      ws = new WebSocket('ws://localhost:8000/ws/notifications/' + (lastSeq === null ? '' : `?last_seq=${lastSeq}`));
+      ws.onopen = () => {
+        console.log('WebSocket connected');
+      };
 
-    ws.onmessage = (event) => {
-      try {
-        const data = JSON.parse(event.data);
+      ws.onmessage = (event) => {
+        try {
+          const data = JSON.parse(event.data);
+          if (data.seq !== undefined) {
+            lastSeq = data.seq;
+          }
     
-        if (data.type === 'weather') {
-          const message = JSON.parse(data.message);
-          const new_weather = (message.weather);
-          const alerts = (message.alerts);
-          const roll_ups = (message.roll_ups);
-
-          const updated_weather = {};
-
-          for(const dataa of new_weather){
-            updated_weather[dataa.city]={
-              date:dataa.dt,
-              temp:dataa.temp,
-              feels_like:dataa.feels_like,
-              humidity:dataa.humidity,
-              wind_speed:dataa.wind_speed,
-              wind_deg:dataa.wind_deg,
-              condition:dataa.dominant_condition
+          if (data.type === 'snapshot') {
+            // Sent instead of a replay when too much was missed
+            const updated_weather = {};
+            const alerts = [];
+            const roll_ups = {};
+            for (const [city, topics] of Object.entries(data.cities)) {
+              const dataa = topics.weather;
+              if (dataa) {
+                updated_weather[city] = {
+                  date:dataa.dt,
+                  temp:dataa.temp,
+                  feels_like:dataa.feels_like,
+                  humidity:dataa.humidity,
+                  wind_speed:dataa.wind_speed,
+                  wind_deg:dataa.wind_deg,
+                  condition:dataa.dominant_condition
+                }
+              }
+              if (topics.roll_ups) {
+                roll_ups[city] = topics.roll_ups;
+              }
+              alerts.push(...(topics.alerts || []));
+            }
+            handleWeatherUpdate(updated_weather);
+            handleAlert(alerts);
+            handleRollups(roll_ups);
+          }else if (data.type === 'weather') {
+            const message = data.message;
+            const new_weather = (message.weather);
+            const alerts = (message.alerts);
+            const roll_ups = (message.roll_ups);
+
+            const updated_weather = {};
+
+            for(const dataa of new_weather){
+              updated_weather[dataa.city]={
+                date:dataa.dt,
+                temp:dataa.temp,
+                feels_like:dataa.feels_like,
+                humidity:dataa.humidity,
+                wind_speed:dataa.wind_speed,
+                wind_deg:dataa.wind_deg,
+                condition:dataa.dominant_condition
+              }
             }
+            handleWeatherUpdate(updated_weather);
+            handleAlert(alerts);
+            console.log('rollups1: ', roll_ups);
+            handleRollups(roll_ups);
+          }else{  
+            console.log('Unknown message type:', data.type);
           }
-          handleWeatherUpdate(updated_weather);
-          handleAlert(alerts);
-          console.log('rollups1: ', roll_ups);
-          handleRollups(roll_ups);
-        }else{  
-          console.log('Unknown message type:', data.type);
+        } catch (error) {
+          console.error('Error fetching current weather:', error);
         }
-      } catch (error) {
-        console.error('Error fetching current weather:', error);
-      }
-    };
+      };
 
-    ws.onclose = () => {
-      console.log('WebSocket closed');
-    };
+      ws.onclose = () => {
+        console.log('WebSocket closed');
+        if (!closed) {
+          reconnectTimer = setTimeout(connect, 2000);
+        }
+      };
 
-    ws.onerror = (error) => {
-      console.error('WebSocket error:', error);
+      ws.onerror = (error) => {
+        console.error('WebSocket error:', error);
+      };
     };
 
+    connect();
+
     return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
       ws.close();
     };
   }, []);